@@ -1,6 +1,6 @@
 # pylint: disable=no-member,unused-argument,too-many-lines,c-extension-no-member
 from __future__ import unicode_literals
-from typing import Dict, List
+from typing import Dict, List, Iterable, Optional
 import json
 import uuid
 try:
@@ -19,6 +19,7 @@ from vstutils.api.base import Response
 from ...main.utils import AnsibleArgumentsReference, AnsibleInventoryParser
 
 from ...main.models import Inventory
+from ...main.executions import start_execution
 from ...main import models
 from ..signals import api_post_save, api_pre_save
 
@@ -112,6 +113,19 @@ class ExecuteResponseSerializer(ActionResponseSerializer):
     executor = serializers.IntegerField(default=None, allow_null=True)
 
 
+def execute_response(detail: str, history_id: Optional[int], user: User) -> Response:
+    rdata = ExecuteResponseSerializer(data=dict(
+        detail=detail, history_id=history_id, executor=user.id
+    ))
+    rdata.is_valid(raise_exception=True)
+    return Response(rdata.data, status.HTTP_201_CREATED)
+
+
+class ExecuteManyResponseSerializer(ActionResponseSerializer):
+    history_ids = serializers.ListField(child=serializers.IntegerField(allow_null=True), default=list)
+    executor = serializers.IntegerField(default=None, allow_null=True)
+
+
 class SetOwnerSerializer(DataSerializer):
     perms_msg = 'Permission denied. Only owner can change owner.'
     user_id = vst_fields.FkField(required=True, select='User',
@@ -317,6 +331,8 @@ class OneHistorySerializer(_SignalSerializer):
     status = serializers.ChoiceField(choices=models.History.statuses, required=False)
     raw_stdout = serializers.SerializerMethodField(read_only=True)
     execution_time = vst_fields.UptimeField()
+    queue_position = serializers.IntegerField(read_only=True)
+    priority = serializers.IntegerField(read_only=True)
 
     class Meta:
         model = models.History
@@ -330,6 +346,8 @@ class OneHistorySerializer(_SignalSerializer):
                   "mode",
                   "execute_args",
                   "execution_time",
+                  "queue_position",
+                  "priority",
                   "start_time",
                   "stop_time",
                   "initiator",
@@ -342,6 +360,13 @@ class OneHistorySerializer(_SignalSerializer):
     def get_raw(self, request) -> str:
         return self.instance.get_raw(request.query_params.get("color", "no") == "yes")
 
+    def iter_raw(self, request) -> Iterable[bytes]:
+        raw = self.instance.iter_raw(request.query_params.get("color", "no") == "yes")
+        return (block.encode('utf-8') for block in raw)
+
+    def get_raw_size(self, request) -> int:
+        return self.instance.get_raw_size(request.query_params.get("color", "no") == "yes")
+
     def get_raw_stdout(self, obj: models.History):
         return self.context.get('request').build_absolute_uri("raw/")
 
@@ -428,6 +453,7 @@ class ProjectVariableSerializer(VariableSerializer):
         'repo_password': 'password',
         'repo_key': 'secretfile',
         'repo_sync_on_run_timeout': 'uptime',
+        'execution_concurrency': 'integer',
         'ci_template': 'fk'
     })
 
@@ -541,6 +567,12 @@ class PeriodictaskSerializer(_WithVariablesSerializer):
         default=models.PeriodicTask.types[0],
         label='Interval type'
     )
+    overlap_policy = serializers.ChoiceField(
+        choices=[(k, k) for k in models.PeriodicTask.overlap_policies],
+        required=False,
+        default=models.PeriodicTask.overlap_policies[0],
+        label='Overlap policy'
+    )
 
     template_opt = vst_fields.DependEnumField(
         allow_blank=True, required=False, field='kind', types={
@@ -585,7 +617,8 @@ class PeriodictaskSerializer(_WithVariablesSerializer):
                   'template_opt',
                   'enabled',
                   'type',
-                  'schedule',)
+                  'schedule',
+                  'overlap_policy',)
 
     @transaction.atomic
     def _do_with_vars(self, *args, **kwargs):
@@ -613,6 +646,7 @@ class OnePeriodictaskSerializer(PeriodictaskSerializer):
                   'enabled',
                   'type',
                   'schedule',
+                  'overlap_policy',
                   'notes',)
 
     def execute(self) -> Response:
@@ -697,8 +731,29 @@ class OneTemplateSerializer(TemplateSerializer):
             'options_list',
         )
 
-    def execute(self, request):
-        return self.instance.execute(request.user, request.data.get('option', None))
+    def execute(self, request) -> Response:
+        history_id = self.instance.execute(request.user, request.data.get('option', None))
+        return execute_response('Start template [id={}].'.format(self.instance.id), history_id, request.user)
+
+    def execute_many(self, request) -> Response:
+        serializer = TemplateExecManySerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        inventories = []
+        for inventory in serializer.validated_data['inventories']:
+            if inventory.isdigit():
+                inventories.append(int(inventory))
+            else:
+                self.instance.project.check_path(inventory)
+                inventories.append(inventory)
+        history_ids = self.instance.execute_many(
+            request.user, inventories, serializer.validated_data.get('option', None) or None
+        )
+        rdata = ExecuteManyResponseSerializer(data=dict(
+            detail='Start template [id={}] in {} inventories.'.format(self.instance.id, len(inventories)),
+            history_ids=history_ids, executor=request.user.id
+        ))
+        rdata.is_valid(raise_exception=True)
+        return Response(rdata.data, status.HTTP_201_CREATED)
 
 
 class TemplateExecSerializer(DataSerializer):
@@ -709,6 +764,19 @@ class TemplateExecSerializer(DataSerializer):
     )
 
 
+class TemplateExecManySerializer(EmptySerializer):
+    option = vst_fields.VSTCharField(
+        help_text='Option name from template options.',
+        min_length=0, allow_blank=True,
+        required=False
+    )
+    inventories = serializers.ListField(
+        child=serializers.CharField(),
+        help_text='Inventory ids or paths to inventory files in project.',
+        min_length=1
+    )
+
+
 ###################################
 # Subclasses for operations
 # with hosts and groups
@@ -959,32 +1027,15 @@ class OneProjectSerializer(ProjectSerializer, _InventoryOperations):
             inventory if inventory else 'specified in the project configuration.'
         )
         if template is not None:
-            init_type = "template"
-            obj_id = template
             msg = 'Start template [id={}].'.format(template)
         else:
-            init_type = "project"
-            obj_id = self.instance.id
             serializer = self._get_ansible_serializer(kind.lower())
             data = {
                 k: v for k, v in serializer.to_internal_value(data).items()
                 if k in data.keys() or v
             }
-        target = data.pop(kind)
-        try:
-            target = str(target)
-        except UnicodeEncodeError:  # nocv
-            target = target.encode('utf-8')
-        history_id = self.instance.execute(
-            kind, str(target),
-            initiator=obj_id, initiator_type=init_type, executor=user, **data
-        )
-        rdata = ExecuteResponseSerializer(data=dict(
-            detail=msg,
-            history_id=history_id, executor=user.id
-        ))
-        rdata.is_valid(raise_exception=True)
-        return Response(rdata.data, status.HTTP_201_CREATED)
+        history_id = start_execution(self.instance, kind, data, user, template=template)
+        return execute_response(msg, history_id, user)
 
     def execute_playbook(self, request) -> Response:
         return self._execution("playbook", dict(request.data), request.user)
@@ -1112,6 +1163,7 @@ class InventoryImportSerializer(DataSerializer):
     raw_data = vst_fields.VSTCharField()
 
     @transaction.atomic()
+    @models.collect_hooks()
     def create(self, validated_data: Dict) -> Dict:
         parser = AnsibleInventoryParser()
         inv_json = parser.get_inventory_data(validated_data['raw_data'])
@@ -1,9 +1,16 @@
 # pylint: disable=unused-argument,protected-access,too-many-ancestors
+import re
+import json
+import time
 from collections import OrderedDict
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
+from django.middleware.gzip import re_accepts_gzip as gzip_regex
+from django.utils.cache import patch_vary_headers
 from django.utils.decorators import method_decorator
+from django.utils.text import compress_sequence
 from rest_framework import exceptions as excepts, status, permissions
 from rest_framework.authtoken import views as token_views
+from django_filters.utils import translate_validation
 from drf_yasg.utils import swagger_auto_schema
 from vstutils.api.permissions import StaffPermission
 from vstutils.api import base, views, serializers as vstsers, decorators as deco
@@ -26,6 +33,15 @@ execute_kw.update(dict(
     response_serializer=sers.ExecuteResponseSerializer,
     response_code=status.HTTP_201_CREATED
 ))
+execute_many_kw = dict(**execute_kw)
+execute_many_kw.update(dict(response_serializer=sers.ExecuteManyResponseSerializer))
+
+
+class RawStreamingResponse(StreamingHttpResponse):
+    @property
+    def content(self):
+        # Bulk requests read whole content of response.
+        return b''.join(self.streaming_content)
 
 
 class _VariablesCopyMixin(base.CopyMixin):
@@ -256,9 +272,26 @@ class __HistoryLineViewSet(base.ReadOnlyModelViewSet):
     serializer_class = sers.HistoryLinesSerializer
     filter_class = filters.HistoryLinesFilter
 
+    def filter_queryset(self, queryset):
+        output = self.nested_parent_object.output
+        if output.is_queryset:
+            return super().filter_queryset(queryset)
+        # Output stored not in rows, so filter only by global line numbers.
+        filterset = self.filter_class(self.request.query_params, queryset=queryset)
+        if not filterset.is_valid():
+            raise translate_validation(filterset.errors)
+        data = filterset.form.cleaned_data
+        after, before, gnumber = data.get('after'), data.get('before'), data.get('line_gnumber')
+        if gnumber is not None:
+            after = gnumber - 1 if after is None else max(after, gnumber - 1)
+            before = gnumber + 1 if before is None else min(before, gnumber + 1)
+        ordering = self.request.query_params.get('ordering', '-line_gnumber')
+        return output.get_lines(after, before, reverse=ordering.startswith('-'))
+
 
 @method_decorator(name='lines_list', decorator=swagger_auto_schema(auto_schema=None))
 @method_decorator(name='raw', decorator=swagger_auto_schema(auto_schema=None))
+@method_decorator(name='live', decorator=swagger_auto_schema(auto_schema=None))
 @deco.nested_view('lines', manager_name='raw_history_line', view=__HistoryLineViewSet)
 class HistoryViewSet(base.HistoryModelViewSet):
     '''
@@ -278,14 +311,90 @@ class HistoryViewSet(base.HistoryModelViewSet):
     serializer_class_one = sers.OneHistorySerializer
     filter_class = filters.HistoryFilter
     POST_WHITE_LIST = ['cancel']
+    range_regex = re.compile(r'^bytes=(\d*)-(\d*)$')
 
     @deco.action(["get"], detail=yes, serializer_class=sers.EmptySerializer)
     def raw(self, request, *args, **kwargs):
         '''
         RAW executions output.
         '''
-        result = self.get_serializer(self.get_object()).get_raw(request)
-        return HttpResponse(result, content_type="text/plain")
+        obj = self.get_object()
+        serializer = self.get_serializer(obj)
+        range_match = self.range_regex.match(request.META.get('HTTP_RANGE', ''))
+        # Output of working execution is growing, so ranges are served
+        # only for finished executions. Otherwise whole output is sent.
+        if range_match and any(range_match.groups()) and not obj.working:
+            return self._get_range_response(serializer, request, *range_match.groups())
+        response = RawStreamingResponse(serializer.iter_raw(request), content_type="text/plain")
+        if gzip_regex.search(request.META.get('HTTP_ACCEPT_ENCODING', '')):
+            response.streaming_content = compress_sequence(response.streaming_content)
+            response['Content-Encoding'] = 'gzip'
+        response['Accept-Ranges'] = 'none' if obj.working else 'bytes'
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
+
+    def _get_range_response(self, serializer, request, start, end):
+        size = serializer.get_raw_size(request)
+        if start:
+            start, end = int(start), min(int(end or size - 1), size - 1)
+        else:
+            start, end = max(size - int(end), 0), size - 1
+        if start > end:
+            response = HttpResponse(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+            response['Content-Range'] = 'bytes */{}'.format(size)
+            return response
+        response = RawStreamingResponse(
+            self._slice_stream(serializer.iter_raw(request), start, end + 1),
+            status=status.HTTP_206_PARTIAL_CONTENT, content_type="text/plain"
+        )
+        response['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, size)
+        response['Content-Length'] = end - start + 1
+        response['Accept-Ranges'] = 'bytes'
+        return response
+
+    @staticmethod
+    def _slice_stream(stream, start, stop):
+        position = 0
+        for block in stream:
+            block_start, position = position, position + len(block)
+            if position <= start:
+                continue
+            yield block[max(start - block_start, 0):stop - block_start]
+            if position >= stop:
+                break
+
+    @deco.action(["get"], detail=yes, serializer_class=sers.EmptySerializer)
+    def live(self, request, *args, **kwargs):
+        '''
+        Stream of new execution output lines (Server-Sent Events).
+        '''
+        obj = self.get_object()
+        after = request.META.get('HTTP_LAST_EVENT_ID') or request.query_params.get('after', 0)
+        try:
+            after = int(after)
+        except ValueError:
+            raise excepts.ValidationError({'after': 'Should be integer.'})
+        response = StreamingHttpResponse(
+            self._get_live_events(obj, after), content_type="text/event-stream"
+        )
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    def _get_live_events(self, obj, after):
+        last_send = time.time()
+        for lines in obj.follow_output(after):
+            if lines:
+                data = sers.HistoryLinesSerializer(lines, many=True).data
+                yield 'id: {}\ndata: {}\n\n'.format(lines[-1].line_gnumber, json.dumps(data))
+            elif time.time() - last_send < 15:
+                continue
+            else:
+                yield ': keep-alive\n\n'
+            last_send = time.time()
+        obj.refresh_from_db(fields=['status'])
+        if not obj.working:
+            yield 'event: end\ndata: {}\n\n'.format(obj.status)
 
     @deco.subaction(serializer_class=sers.EmptySerializer, **action_kw)
     def cancel(self, request, *args, **kwargs):
@@ -537,7 +646,7 @@ class __TemplateViewSet(base.ModelViewSetSet):
     serializer_class = sers.TemplateSerializer
     serializer_class_one = sers.OneTemplateSerializer
     filter_class = filters.TemplateFilter
-    POST_WHITE_LIST = ['execute']
+    POST_WHITE_LIST = ['execute', 'execute_many']
 
     @deco.subaction(serializer_class=sers.TemplateExecSerializer, **execute_kw)
     def execute(self, request, *args, **kwargs):
@@ -545,7 +654,15 @@ class __TemplateViewSet(base.ModelViewSetSet):
         Execute template with option.
         '''
         obj = self.get_object()
-        return self.get_serializer(obj).execute(request)
+        return self.get_serializer(obj).execute(request).resp
+
+    @deco.subaction(serializer_class=sers.TemplateExecManySerializer, **execute_many_kw)
+    def execute_many(self, request, *args, **kwargs):
+        '''
+        Execute template with option in every inventory from list.
+        '''
+        obj = self.get_object()
+        return self.get_serializer(obj).execute_many(request).resp
 
 
 class __ProjectHistoryViewSet(HistoryViewSet):
@@ -684,7 +801,7 @@ class StatisticViewSet(base.ListNonModelViewSet):
         return model.objects.all().count()
 
     def _get_history_stats(self, request):
-        qs = sers.models.History.objects.all()
+        qs = sers.models.HistoryStatistic.objects.all()
         qs = qs.user_filter(self.request.user)
         return qs.stats(int(request.query_params.get("last", "14")))
 
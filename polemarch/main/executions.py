@@ -0,0 +1,372 @@
+from __future__ import unicode_literals
+from typing import Dict, Text, List, Tuple, Optional, Iterable, Callable, Any, NoReturn
+import time
+import uuid
+import logging
+import threading
+from contextlib import contextmanager
+from django.conf import settings
+from django.utils import timezone
+from vstutils.utils import KVExchanger
+from .utils import PMObject, CmdExecutor, Metrics
+
+logger = logging.getLogger('polemarch')
+
+
+Limits = List[Tuple[Text, int]]
+RunningRow = Tuple[int, Optional[int], Optional[int], Optional[int]]
+
+
+def get_message_priority(priority: int = None) -> int:
+    '''
+    Priority of celery message for execution with given priority.
+    Redis transport delivers messages with less number first.
+    '''
+    if priority is None:
+        priority = settings.EXECUTION_DEFAULT_PRIORITY
+    if settings.CELERY_BROKER_URL.startswith('redis'):
+        return settings.CELERY_TASK_QUEUE_MAX_PRIORITY - priority  # nocv
+    return priority
+
+
+def start_execution(project, kind: Text, data: Dict[Text, Any], user, template: int = None) -> Optional[int]:
+    '''
+    Start execution of playbook or module (`kind`) in project by user.
+    Data should be already validated and contains target by `kind` key.
+    Returns id of history (None when result is not saved).
+    '''
+    data = dict(data)
+    if template is not None:
+        initiator, initiator_type = template, 'template'
+    else:
+        initiator, initiator_type = project.id, 'project'
+    target = data.pop(kind)
+    try:
+        target = str(target)
+    except UnicodeEncodeError:  # nocv
+        target = target.encode('utf-8')
+    return project.execute(
+        kind, target, initiator=initiator, initiator_type=initiator_type, executor=user, **data
+    )
+
+
+class ExecutionSlots(PMObject):
+    '''
+    Limits of concurrently running executions: globally, per project and
+    per inventory. Slot is taken by switching history from `DELAY` to `RUN`
+    under lock, so running executions are counted in database and slot is
+    freed when execution is finished. Running execution also refreshes its
+    lease key, so `RUN` history of killed worker doesn't hold slot.
+
+    Executions which wait for slot are registered in cache, so free slot
+    is given to waiter with the highest priority and then to owner with
+    the least running executions per weight.
+    '''
+    __slots__ = 'history',
+    lock_id = 'execution-slots'
+    lock_timeout = 10
+    waiters_key = 'execution-waiters'
+    lease_prefix = 'execution-lease-'
+
+    def __init__(self, history):
+        self.history = history
+
+    @property
+    def cache(self):
+        return self.get_django_cache('locks')
+
+    @classmethod
+    def get_project_limit(cls, project) -> int:
+        try:
+            return int(project.vars.get('execution_concurrency', settings.EXECUTION_PROJECT_CONCURRENCY))
+        except (TypeError, ValueError):  # nocv
+            return settings.EXECUTION_PROJECT_CONCURRENCY
+
+    @contextmanager
+    def locked(self):
+        '''
+        Lock of slots in `locks` cache. Lock is taken by atomic `add`
+        and released only by its owner. Yields False on timeout.
+        '''
+        token, deadline = uuid.uuid4().hex, time.time() + self.lock_timeout
+        locked = self.cache.add(self.lock_id, token, self.lock_timeout)
+        while not locked and time.time() < deadline:
+            time.sleep(0.05)
+            locked = self.cache.add(self.lock_id, token, self.lock_timeout)
+        try:
+            yield locked
+        finally:
+            if locked and self.cache.get(self.lock_id) == token:
+                self.cache.delete(self.lock_id)
+
+    def get_lease_key(self, history_id: int) -> Text:
+        return self.lease_prefix + str(history_id)
+
+    def refresh(self) -> NoReturn:
+        self.cache.set(self.get_lease_key(self.history.id), 1, settings.EXECUTION_LEASE_TIMEOUT)
+
+    def release(self) -> NoReturn:
+        self.cache.delete(self.get_lease_key(self.history.id))
+
+    @contextmanager
+    def hold(self):
+        '''
+        Refresh lease of running execution in background thread
+        and free slot at the end.
+        '''
+        stop = threading.Event()
+
+        def refresh():
+            while not stop.wait(settings.EXECUTION_LEASE_TIMEOUT / 3):
+                self.refresh()
+
+        thread = threading.Thread(target=refresh, daemon=True)
+        self.refresh()
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+            self.release()
+
+    def get_limits(self) -> Limits:
+        history, limits = self.history, []
+        if settings.EXECUTION_CONCURRENCY > 0:
+            limits.append(('total', settings.EXECUTION_CONCURRENCY))
+        if history.project_id is not None:
+            project_limit = self.get_project_limit(history.project)
+            if project_limit > 0:
+                limits.append(('project_{}'.format(history.project_id), project_limit))
+        if history.inventory_id is not None and settings.EXECUTION_INVENTORY_CONCURRENCY > 0:
+            limits.append((
+                'inventory_{}'.format(history.inventory_id), settings.EXECUTION_INVENTORY_CONCURRENCY
+            ))
+        return limits
+
+    def get_running_rows(self) -> List[RunningRow]:
+        '''
+        Running executions (except current) with alive leases.
+        '''
+        queryset = self.history.__class__.objects.filter(status='RUN').exclude(pk=self.history.pk)
+        rows = list(queryset.order_by().values_list('id', 'project_id', 'inventory_id', 'executor_id'))
+        alive = self.cache.get_many([self.get_lease_key(row[0]) for row in rows])
+        return [row for row in rows if self.get_lease_key(row[0]) in alive]
+
+    @staticmethod
+    def get_running(rows: List[RunningRow], keys: Iterable[Text]) -> Dict[Text, int]:
+        running = dict.fromkeys(keys, 0)
+        for _, project_id, inventory_id, _ in rows:
+            for key in ('total', 'project_{}'.format(project_id), 'inventory_{}'.format(inventory_id)):
+                if key in running:
+                    running[key] += 1
+        return running
+
+    @staticmethod
+    def get_running_by_owner(rows: List[RunningRow]) -> Dict[Optional[int], int]:
+        owners = dict()  # type: Dict[Optional[int], int]
+        for row in rows:
+            owners[row[3]] = owners.get(row[3], 0) + 1
+        return owners
+
+    @staticmethod
+    def get_owner_weight(username: Optional[Text]) -> float:
+        return settings.EXECUTION_OWNER_WEIGHTS.get(username, 1.0) if username else 1.0
+
+    def get_weight(self) -> float:
+        if not settings.EXECUTION_OWNER_WEIGHTS or self.history.executor_id is None:
+            return 1.0
+        return self.get_owner_weight(self.history.executor.username)
+
+    def get_waiter(self, limits: Limits) -> Dict[Text, Any]:
+        return dict(
+            priority=self.history.priority, owner=self.history.executor_id,
+            weight=self.get_weight(), limits=limits, time=time.time()
+        )
+
+    def get_waiters(self) -> Dict[int, Dict[Text, Any]]:
+        deadline = time.time() - settings.EXECUTION_QUEUE_RETRY_INTERVAL * 3 - self.lock_timeout
+        return {
+            history_id: waiter
+            for history_id, waiter in (self.cache.get(self.waiters_key) or {}).items()
+            if waiter['time'] > deadline
+        }
+
+    @staticmethod
+    def fits(limits: Limits, running: Dict[Text, int]) -> bool:
+        return all(running[key] < limit for key, limit in limits)
+
+    @staticmethod
+    def get_rank(history_id: int, waiter: Dict[Text, Any], owners: Dict[Optional[int], int]) -> Tuple:
+        return -waiter['priority'], owners.get(waiter['owner'], 0) / waiter['weight'], history_id
+
+    def is_first(self, waiter: Dict[Text, Any], competitors: Dict[int, Dict], rows: List[RunningRow]) -> bool:
+        running = self.get_running(rows, set(key for other in competitors.values() for key, _ in other['limits']))
+        competitors = {
+            history_id: other for history_id, other in competitors.items()
+            if self.fits(other['limits'], running)
+        }
+        if not competitors:
+            return True
+        owners = self.get_running_by_owner(rows)
+        rank = self.get_rank(self.history.id, waiter, owners)
+        return all(rank < self.get_rank(i, other, owners) for i, other in competitors.items())
+
+    def get_position(self) -> int:
+        '''
+        Position of waiting execution in queue of its project
+        by the same order as free slots are given.
+        '''
+        queryset = self.history.__class__.objects.filter(status='DELAY', project_id=self.history.project_id)
+        owners = self.get_running_by_owner(self.get_running_rows())
+        ranks = {
+            history_id: self.get_rank(history_id, dict(
+                priority=priority, owner=owner, weight=self.get_owner_weight(username)
+            ), owners)
+            for history_id, priority, owner, username in queryset.values_list(
+                'id', 'priority', 'executor_id', 'executor__username'
+            )
+        }
+        rank = ranks.get(self.history.id) or self.get_rank(self.history.id, self.get_waiter([]), owners)
+        return sum(1 for other in ranks.values() if other < rank) + 1
+
+    def acquire(self) -> bool:
+        '''
+        Take slot for execution. Returns False when any limit is reached
+        or free slot belongs to more urgent waiter, so execution should
+        wait in `DELAY` status.
+        '''
+        limits = self.get_limits()
+        if not limits:
+            self.refresh()
+            return True
+        with self.locked() as locked:
+            if not locked:
+                return False
+            waiters = self.get_waiters()
+            waiters.pop(self.history.id, None)
+            keys = set(key for key, _ in limits)
+            competitors = {
+                history_id: other for history_id, other in waiters.items()
+                if keys.intersection(key for key, _ in other['limits'])
+            }
+            rows = self.get_running_rows()
+            waiter = self.get_waiter(limits)
+            acquired = self.fits(limits, self.get_running(rows, keys)) and self.is_first(waiter, competitors, rows)
+            if acquired:
+                self.refresh()
+                self.history.status = 'RUN'
+                self.history.save(update_fields=['status'])
+            else:
+                waiters[self.history.id] = waiter
+            self.cache.set(self.waiters_key, waiters, None)
+        return acquired
+
+    def is_cancelled(self) -> bool:
+        exchanger = KVExchanger(CmdExecutor.CANCEL_PREFIX + str(self.history.id))
+        return exchanger.get() is not None
+
+    def interrupt(self) -> NoReturn:
+        '''
+        Mark waiting execution as interrupted and remove it from waiters.
+        '''
+        with self.locked() as locked:
+            # Without lock waiter is removed from waiters by expiration.
+            waiters = self.get_waiters() if locked else dict()
+            if waiters.pop(self.history.id, None) is not None:
+                self.cache.set(self.waiters_key, waiters, None)
+        self.history.status = 'INTERRUPTED'
+        self.history.stop_time = timezone.now()
+        self.history.save()
+
+
+class PeriodicTaskRun(PMObject):
+    '''
+    Run of periodic task with its overlap policy. Running and queued runs
+    are marked by keys in `locks` cache, so policy works for all workers.
+    Running key keeps id of started history until it is finished, because
+    execution could wait for free slot after task returns.
+    Queued run is checked again by `requeue()` callback later.
+    '''
+    __slots__ = 'task', 'cache', 'metrics', 'requeue'
+    cache_name = 'locks'
+
+    def __init__(self, task, requeue: Callable[[], Any] = None):
+        self.task = task
+        self.cache = self.get_django_cache(self.cache_name)
+        self.metrics = Metrics()
+        self.requeue = requeue
+
+    def get_key(self, state: Text) -> Text:
+        return 'periodic-task-{}-{}'.format(self.task.id, state)
+
+    def acquire(self, state: Text) -> bool:
+        return self.cache.add(self.get_key(state), 0, settings.EXECUTION_PERIODIC_LOCK_TIMEOUT)
+
+    def release(self, state: Text) -> NoReturn:
+        self.cache.delete(self.get_key(state))
+
+    @staticmethod
+    def is_finished(history_id: Optional[int]) -> bool:
+        # pylint: disable=cyclic-import
+        from .models import History
+        if not history_id:
+            return history_id is None
+        return not History.objects.filter(id=history_id, status__in=History.working_statuses).exists()
+
+    def acquire_running(self) -> bool:
+        '''
+        Take running key. Key with finished history is taken over
+        by only one run, which wins takeover key of that history.
+        '''
+        if self.acquire('running'):
+            return True
+        history_id = self.cache.get(self.get_key('running'))
+        if not self.is_finished(history_id):
+            return False
+        takeover = self.get_key('takeover-{}'.format(history_id))
+        if not self.cache.add(takeover, 1, settings.EXECUTION_PERIODIC_LOCK_TIMEOUT):
+            return False
+        self.release('running')
+        return self.acquire('running')
+
+    def hold_running(self, history_id: Optional[int]) -> NoReturn:
+        '''
+        Keep running key until started history is finished.
+        '''
+        if self.is_finished(history_id):
+            self.release('running')
+        else:
+            self.cache.set(self.get_key('running'), history_id, settings.EXECUTION_PERIODIC_LOCK_TIMEOUT)
+
+    def wait(self, queued: bool = False) -> bool:
+        '''
+        Mark run as queued and check it again later, so worker is not held
+        until the end of running one. Returns False when other run is already queued.
+        '''
+        if self.requeue is None or not (queued or self.acquire('queued')):
+            return False
+        self.requeue()
+        return True
+
+    def execute(self, queued: bool = False) -> Any:
+        policy = self.task.overlap_policy
+        if queued and policy != 'coalesce':
+            self.release('queued')
+        if policy not in ('skip', 'coalesce'):
+            return self.task.execute()
+        if not self.acquire_running():
+            if policy == 'coalesce' and self.wait(queued):
+                return None
+            result = 'skipped' if policy == 'skip' else 'coalesced'
+            self.metrics.incr('periodic_task_{}'.format(result))
+            logger.info('Run of periodic task {} is {}.'.format(self.task.id, result))
+            return None
+        if queued:
+            self.release('queued')
+        history_id = None
+        try:
+            history_id = self.task.execute()
+            return history_id
+        finally:
+            self.hold_running(history_id)
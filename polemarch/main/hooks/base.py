@@ -1,8 +1,41 @@
-from typing import Dict
+from typing import Dict, Tuple, Text, Callable, Iterable, List
+import os
+import logging
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 from django.conf import settings
 
 
+logger = logging.getLogger("polemarch")
+_pools = dict()
+_pools_lock = threading.Lock()
+
+
+def get_pool(workers: int) -> ThreadPoolExecutor:
+    '''
+    Thread pool of current process for concurrent sending to recipients.
+    Pools inherited from parent process (e.g. by celery worker) are dropped.
+    '''
+    key = (os.getpid(), workers)
+    with _pools_lock:
+        if key not in _pools:
+            for old_key in [k for k in _pools if k[0] != key[0]]:
+                del _pools[old_key]
+            _pools[key] = ThreadPoolExecutor(max_workers=workers)
+        return _pools[key]
+
+
+class DeliveryError(Exception):
+    '''
+    Recipient got message, but answered with error which could be retried.
+    '''
+
+
 class BaseHook:
+    # Errors which mean that recipient is temporarily unavailable.
+    retry_exceptions = (DeliveryError,)
+
     def __init__(self, hook_object, when_types=None, **kwargs):
         self.when_types = when_types or []
         self.hook_object = hook_object
@@ -16,6 +49,8 @@ class BaseHook:
     def setup(self, **kwargs):
         self.conf = dict()
         self.conf.update(kwargs)
+        self.conf.setdefault('timeout', self.get_settings('HOOKS_TIMEOUT', None))
+        self.conf.setdefault('workers', 1)
 
     def validate(self) -> Dict:
         errors = {}
@@ -31,12 +66,33 @@ class BaseHook:
     def execute(self, recipient, when, message):  # nocv
         raise NotImplementedError
 
+    def deliver(self, recipient, when, message) -> Tuple[Text, Text]:
+        '''
+        Send prepared message to one recipient. Returns status of sending
+        (`OK`, `RETRY` for temporary errors or `ERROR`) and its result.
+        '''
+        try:
+            return 'OK', self.execute(recipient, when, message)
+        except Exception as err:
+            logger.error(traceback.format_exc())
+            logger.error("Details:\nRECIPIENT:{}\nWHEN:{}\n".format(recipient, when))
+            return ('RETRY' if isinstance(err, self.retry_exceptions) else 'ERROR'), str(err)
+
+    def map(self, func: Callable, items: Iterable) -> List:
+        '''
+        Call `func` for every item on thread pool with `workers` threads.
+        Results are returned in order of items.
+        '''
+        items = list(items)
+        if self.conf['workers'] < 2 or len(items) < 2:
+            return list(map(func, items))
+        return list(get_pool(self.conf['workers']).map(func, items))
+
     def send(self, message, when: str) -> str:
         self.when = when
         filtered = filter(lambda r: r, self.conf['recipients'])
-        execute = self.execute
         message = self.modify_message(message)
-        mapping = map(lambda r: execute(r, when, message), filtered)
+        mapping = self.map(lambda r: self.deliver(r, when, message)[1], filtered)
         return '\n'.join(mapping)
 
     def on_execution(self, message):
@@ -1,23 +1,54 @@
-import logging
-import traceback
+import os
+import threading
 import requests
-from .base import BaseHook
+from requests.adapters import HTTPAdapter
+from .base import BaseHook, DeliveryError
 
 
-logger = logging.getLogger("polemarch")
+class Backend(BaseHook):
+    retry_exceptions = (DeliveryError, requests.ConnectionError, requests.Timeout)
+    # Answers with these codes mean that recipient is temporarily unavailable.
+    retry_codes = (408, 429)
+    # Sessions by process id, so connections are not shared with forks.
+    sessions = dict()
+    sessions_lock = threading.Lock()
 
+    def setup(self, **kwargs):
+        super(Backend, self).setup(**kwargs)
+        self.conf['workers'] = self.get_settings('HOOKS_HTTP_WORKERS', 1)
+        self.conf['connect_timeout'] = self.get_settings('HOOKS_CONNECT_TIMEOUT', self.conf['timeout'])
+        self.conf['pool_size'] = self.get_settings('HOOKS_HTTP_POOL_SIZE', 10)
+        self.conf['keepalive'] = self.get_settings('HOOKS_HTTP_KEEPALIVE', True)
+        # Backend in batch mode gets coalesced events as one message.
+        self.conf.setdefault('batch', self.get_settings('HOOKS_BATCH', False))
+
+    def get_session(self) -> requests.Session:
+        session = requests.Session()
+        # Adapter keeps separate pool of connections for every host.
+        adapter = HTTPAdapter(pool_connections=self.conf['pool_size'], pool_maxsize=self.conf['pool_size'])
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if not self.conf['keepalive']:
+            session.headers['Connection'] = 'close'
+        return session
+
+    @property
+    def session(self) -> requests.Session:
+        pid = os.getpid()
+        with self.sessions_lock:
+            if pid not in self.sessions:
+                self.sessions.clear()
+                self.sessions[pid] = self.get_session()
+            return self.sessions[pid]
 
-class Backend(BaseHook):
     def execute(self, url, when, message) -> str:
         data = dict(type=when, payload=message)
-        try:
-            response = requests.post(url, data=data)
-            return "{} {}: {}".format(
-                response.status_code, response.reason, response.text
-            )
-        except BaseException as err:
-            logger.error(traceback.format_exc())
-            logger.error("Details:\nURL:{}\nWHEN:{}\n".format(
-                url, when
-            ))
-            return str(err)
+        response = self.session.post(
+            url, data=data, timeout=(self.conf['connect_timeout'], self.conf['timeout'])
+        )
+        result = "{} {}: {}".format(
+            response.status_code, response.reason, response.text
+        )
+        if response.status_code >= 500 or response.status_code in self.retry_codes:
+            raise DeliveryError(result)
+        return result
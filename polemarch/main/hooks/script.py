@@ -2,35 +2,26 @@ from __future__ import unicode_literals
 from typing import Dict
 import os
 import json
-import traceback
-import logging
 import subprocess
-from .base import BaseHook
-
-
-logger = logging.getLogger("polemarch")
+from .base import BaseHook, DeliveryError
 
 
 class Backend(BaseHook):
+    retry_exceptions = (DeliveryError, subprocess.CalledProcessError, subprocess.TimeoutExpired)
 
     def execute(self, script, when, file) -> str:
-        try:
-            work_dir = self.conf['HOOKS_DIR']
-            script = '{}/{}'.format(work_dir, script)
-            return subprocess.check_output(
-                [script, when],
-                cwd=work_dir, universal_newlines=True, input=file
-            )
-        except BaseException as err:
-            logger.error(traceback.format_exc())
-            logger.error("Details:\nSCRIPT:{}\nWHEN:{}\nCWD:{}\n".format(
-                script, when, self.conf['HOOKS_DIR']
-            ))
-            return str(err)
+        work_dir = self.conf['HOOKS_DIR']
+        return subprocess.check_output(
+            ['{}/{}'.format(work_dir, script), when],
+            cwd=work_dir, universal_newlines=True, input=file,
+            timeout=self.conf['timeout']
+        )
 
     def setup(self, **kwargs):
         super(Backend, self).setup(**kwargs)
         self.conf['HOOKS_DIR'] = self.get_settings('HOOKS_DIR', '/tmp/')
+        # Backend in batch mode gets coalesced events as one message.
+        self.conf.setdefault('batch', self.get_settings('HOOKS_BATCH', False))
 
     def validate(self) -> Dict:
         errors = super(Backend, self).validate()
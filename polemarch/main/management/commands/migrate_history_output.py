@@ -0,0 +1,32 @@
+from django.conf import settings
+from ..base import ServiceCommand
+from ...models import History
+
+
+class Command(ServiceCommand):
+    help = "Move output of finished executions to another output storage."
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument(
+            '--storage', action='store', dest='storage', type=str,
+            default=settings.HISTORY_OUTPUT_STORAGE,
+            help='Output storage name [{}].'.format('|'.join(History.output_handlers.list()))
+        )
+        parser.add_argument(
+            '--limit', action='store', dest='limit', type=int, default=None,
+            help='Max count of executions to migrate.'
+        )
+
+    def handle(self, *args, **options):
+        super(Command, self).handle(*args, **options)
+        storage = options['storage'].upper()
+        if storage not in History.output_handlers.list():
+            raise self.CommandError('Unknown output storage "{}".'.format(storage))
+        qs = History.objects.exclude(output_storage=storage)
+        qs = qs.exclude(status__in=History.working_statuses).order_by('id')
+        ids = list(qs.values_list('id', flat=True)[:options['limit']])
+        # Every history migrates in own transaction.
+        for history_id in ids:
+            History.objects.get(pk=history_id).set_output_storage(storage)
+        self._print('Output of {} executions moved to {}.'.format(len(ids), storage), 'SUCCESS')
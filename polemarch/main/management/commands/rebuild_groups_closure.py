@@ -0,0 +1,28 @@
+from ..base import ServiceCommand
+from ...models import GroupClosure
+
+
+class Command(ServiceCommand):
+    help = "Rebuild closure table of groups tree or check its consistency."
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument(
+            '--check', action='store_true', dest='check', default=False,
+            help='Only check consistency of closure table.'
+        )
+
+    def handle(self, *args, **options):
+        super(Command, self).handle(*args, **options)
+        if options['check']:
+            errors = GroupClosure.objects.check_consistency()
+            for ancestor_id, descendant_id, depth in errors:
+                self._print('Wrong paths count from group {} to group {} with depth {}.'.format(
+                    ancestor_id, descendant_id, depth
+                ), 'ERROR')
+            if errors:
+                raise self.CommandError('Closure table of groups is inconsistent.')
+            self._print('Closure table of groups is consistent.', 'SUCCESS')
+            return
+        count = GroupClosure.objects.rebuild()
+        self._print('Closure table of groups rebuilt with {} rows.'.format(count), 'SUCCESS')
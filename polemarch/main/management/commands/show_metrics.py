@@ -0,0 +1,22 @@
+from ..base import ServiceCommand
+from ...utils import Metrics
+
+
+class Command(ServiceCommand):
+    help = "Show service counters (workspace pool hits, etc.)."
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument(
+            '--clear', action='store_true', dest='clear', default=False,
+            help='Reset all counters.'
+        )
+
+    def handle(self, *args, **options):
+        super(Command, self).handle(*args, **options)
+        metrics = Metrics()
+        for name, value in metrics.all().items():
+            self._print('{} = {}'.format(name, value))
+        if options['clear']:
+            metrics.clear()
+            self._print('Counters were cleared.', 'SUCCESS')
@@ -0,0 +1,35 @@
+# Generated by Django 2.2.28 on 2026-10-18 18:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0006_migrate_django_22'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='history',
+            name='output_storage',
+            field=models.CharField(default='LINES', max_length=32),
+        ),
+        migrations.CreateModel(
+            name='HistoryChunk',
+            fields=[
+                ('id', models.AutoField(max_length=20, primary_key=True, serialize=False)),
+                ('hidden', models.BooleanField(default=False)),
+                ('first_gnumber', models.IntegerField(default=0)),
+                ('last_gnumber', models.IntegerField(default=0)),
+                ('lines_count', models.IntegerField(default=0)),
+                ('data', models.BinaryField()),
+                ('history', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='output_chunks', related_query_name='output_chunks', to='main.History')),
+            ],
+            options={
+                'default_related_name': 'output_chunks',
+                'index_together': {('history', 'first_gnumber')},
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.2.28 on 2026-10-18 18:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0007_history_output_chunks'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GroupClosure',
+            fields=[
+                ('id', models.AutoField(max_length=20, primary_key=True, serialize=False)),
+                ('hidden', models.BooleanField(default=False)),
+                ('depth', models.PositiveIntegerField(default=1)),
+                ('paths', models.PositiveIntegerField(default=1)),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='descendants_closure', related_query_name='descendants_closure', to='main.Group')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ancestors_closure', related_query_name='ancestors_closure', to='main.Group')),
+            ],
+            options={
+                'unique_together': {('ancestor', 'descendant', 'depth')},
+                'index_together': {('descendant', 'ancestor')},
+            },
+        ),
+    ]
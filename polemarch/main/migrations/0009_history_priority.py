@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0008_group_closure'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='history',
+            name='priority',
+            field=models.PositiveSmallIntegerField(default=5),
+        ),
+    ]
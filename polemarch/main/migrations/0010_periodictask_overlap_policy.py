@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0009_history_priority'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='periodictask',
+            name='overlap_policy',
+            field=models.CharField(default='allow', max_length=16),
+        ),
+    ]
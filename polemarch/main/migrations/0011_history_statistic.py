@@ -0,0 +1,44 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:48
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+from django.db.models.functions import TruncDate
+import django.db.models.deletion
+
+
+def fill_history_statistic(apps, schema_editor):
+    History = apps.get_registered_model('main', 'History')
+    HistoryStatistic = apps.get_registered_model('main', 'HistoryStatistic')
+    qs = History.objects.annotate(date=TruncDate('start_time')).order_by()
+    qs = qs.values('date', 'status', 'project_id', 'executor_id').annotate(count=Count('id'))
+    HistoryStatistic.objects.bulk_create(
+        [HistoryStatistic(**values) for values in qs.iterator()], batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('main', '0010_periodictask_overlap_policy'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HistoryStatistic',
+            fields=[
+                ('id', models.AutoField(max_length=20, primary_key=True, serialize=False)),
+                ('hidden', models.BooleanField(default=False)),
+                ('date', models.DateField(db_index=True)),
+                ('status', models.CharField(max_length=50)),
+                ('count', models.IntegerField(default=0)),
+                ('executor', models.ForeignKey(blank=True, default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='history_statistic', to=settings.AUTH_USER_MODEL)),
+                ('project', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='history_statistic', related_query_name='history_statistic', to='main.Project')),
+            ],
+            options={
+                'default_related_name': 'history_statistic',
+            },
+        ),
+        migrations.RunPython(fill_history_statistic, migrations.RunPython.noop),
+    ]
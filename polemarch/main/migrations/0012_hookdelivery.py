@@ -0,0 +1,34 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0011_history_statistic'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HookDelivery',
+            fields=[
+                ('id', models.AutoField(max_length=20, primary_key=True, serialize=False)),
+                ('hidden', models.BooleanField(default=False)),
+                ('recipient', models.TextField()),
+                ('when', models.CharField(max_length=32)),
+                ('message', models.TextField()),
+                ('status', models.CharField(db_index=True, default='PENDING', max_length=16)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('result', models.TextField(default='')),
+                ('created', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('sent', models.DateTimeField(default=None, null=True)),
+                ('hook', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='deliveries', to='main.Hook')),
+            ],
+            options={
+                'default_related_name': 'deliveries',
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+from django.db import migrations
+from django.db.models import Count, Min, Sum
+
+
+def merge_history_statistic(apps, schema_editor):
+    HistoryStatistic = apps.get_registered_model('main', 'HistoryStatistic')
+    fields = ('date', 'status', 'project_id', 'executor_id')
+    duplicates = HistoryStatistic.objects.order_by().values(*fields).annotate(
+        rows=Count('id'), first=Min('id'), sum=Sum('count')
+    ).filter(rows__gt=1)
+    for values in duplicates.iterator():
+        rows = HistoryStatistic.objects.filter(**{field: values[field] for field in fields})
+        rows.exclude(id=values['first']).delete()
+        rows.filter(id=values['first']).update(count=values['sum'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0012_hookdelivery'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_history_statistic, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='historystatistic',
+            unique_together={('date', 'status', 'project', 'executor')},
+        ),
+    ]
@@ -1,6 +1,6 @@
 # pylint: disable=unused-argument,no-member
 from __future__ import absolute_import
-from typing import Any, Text, NoReturn, Iterable
+from typing import Any, Text, NoReturn, Iterable, Dict, Tuple
 import sys
 import json
 import logging
@@ -12,17 +12,18 @@ from django.dispatch import receiver
 from django.db.models.functions import Cast
 from django.core.validators import ValidationError
 from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
 from vstutils.utils import raise_context, KVExchanger
 
-from .vars import Variable
-from .hosts import Host, Group, Inventory
+from .vars import Variable, pre_set_vars, post_set_vars
+from .hosts import Host, Group, GroupClosure, Inventory
 from .projects import Project, Task, Module, ProjectTemplate, list_to_choices
 from .users import BaseUser, UserGroup, ACLPermission, UserSettings
-from .tasks import PeriodicTask, History, HistoryLines, Template
-from .hooks import Hook
+from .tasks import PeriodicTask, History, HistoryLines, HistoryChunk, HistoryStatistic, Template
+from .hooks import Hook, HookDelivery, HookEvents, collect_hooks
 from ..validators import RegexValidator, validate_hostname
 from ..exceptions import UnknownTypeException, Conflict
-from ..utils import AnsibleArgumentsReference, CmdExecutor
+from ..utils import AnsibleArgumentsReference, CmdExecutor, InventoryCache
 
 
 logger = logging.getLogger('polemarch')
@@ -31,11 +32,20 @@ logger = logging.getLogger('polemarch')
 #####################################
 # FUNCTIONS
 #####################################
-def send_hook(when: Text, target: Any) -> NoReturn:
+def send_hook(when: Text, target: Any, key: Tuple = None) -> NoReturn:
+    '''
+    Send hook message about `target`. Events of object with `key` are
+    collected until commit when they are triggered in `collect_hooks` scope.
+    '''
+    if 'loaddata' in sys.argv:
+        return
+    events = HookEvents.current()
+    if events is not None and key is not None:
+        events.add(when, key, target)
+        return
     msg = OrderedDict(when=when)
     msg['target'] = target
-    if 'loaddata' not in sys.argv:
-        Hook.objects.all().execute(when, msg)
+    Hook.router.execute(when, msg)
 
 
 @raise_context()
@@ -45,14 +55,15 @@ def send_user_hook(when: Text, instance: Any) -> None:
             user_id=instance.id,
             username=instance.username,
             admin=instance.is_staff
-        )
+        ),
+        key=('User', instance.id)
     )
 
 
 @raise_context()
 def send_polemarch_models(when: Text, instance: Any, **kwargs) -> None:
     target = OrderedDict(id=instance.id, name=instance.name, **kwargs)
-    send_hook(when, target)
+    send_hook(when, target, key=(instance.__class__.__name__, instance.id))
 
 
 def raise_linked_error(exception_class=ValidationError, **kwargs):
@@ -73,17 +84,41 @@ def remove_existed(instance: Variable, **kwargs) -> NoReturn:
     ).exclude(pk=instance.id).delete()
 
 
+def validate_variables(content_object: Any, variables: Dict) -> NoReturn:
+    if isinstance(content_object, PeriodicTask):
+        cmd = "module" if content_object.kind == "MODULE" else "playbook"
+        AnsibleArgumentsReference().validate_args(cmd, variables)
+    elif isinstance(content_object, Host):
+        if 'ansible_host' in variables:
+            validate_hostname(variables['ansible_host'])
+
+
+def validate_project_variables(project: Project, variables: Dict, keys: Iterable[Text]) -> NoReturn:
+    '''
+    :param variables: -- new variables of project.
+    :param keys: -- all variables keys of project after update.
+    '''
+    msg = 'Unknown variable key \'{}\'. Key must be in {} or starts from \'env_\' or \'ci_\'.'
+    for key in variables.keys():
+        if not key.startswith('env_') and not key.startswith('ci_') and key not in Project.VARS_KEY:
+            raise ValidationError(msg.format(key, Project.VARS_KEY))
+    keys = set(keys)
+    has_ci = any(key.startswith('ci_') for key in keys)
+    if has_ci and any(key.startswith('repo_sync_on_run') for key in keys):
+        if any(key.startswith('ci_') for key in variables.keys()):
+            raise Conflict('Couldnt install CI/CD to project with "repo_sync_on_run" settings.')
+        raise Conflict('Couldnt install "repo_sync_on_run" settings for CI/CD project.')
+    if 'ci_template' in variables and not project.template.filter(pk=variables['ci_template']).exists():
+        raise ValidationError('Template does not exists in this project.')
+    if not str(variables.get('execution_concurrency', 0)).isdigit():
+        raise ValidationError('Value of \'execution_concurrency\' should be positive integer or 0.')
+
+
 @receiver(signals.pre_save, sender=Variable)
 def check_variables_values(instance: Variable, *args, **kwargs) -> NoReturn:
     if 'loaddata' in sys.argv or kwargs.get('raw', False):  # nocv
         return
-    content_object = instance.content_object
-    if isinstance(content_object, PeriodicTask):
-        cmd = "module" if content_object.kind == "MODULE" else "playbook"
-        AnsibleArgumentsReference().validate_args(cmd, {instance.key: instance.value})
-    elif isinstance(content_object, Host):
-        if instance.key == 'ansible_host':
-            validate_hostname(instance.value)
+    validate_variables(instance.content_object, {instance.key: instance.value})
 
 
 @receiver(signals.pre_save, sender=Variable)
@@ -92,24 +127,16 @@ def check_project_variables_values(instance: Variable, *args, **kwargs) -> NoRet
         return
     if not isinstance(instance.content_object, Project):
         return
-
     project_object = instance.content_object
+    keys = list(project_object.variables.values_list('key', flat=True)) + [instance.key]
+    validate_project_variables(project_object, {instance.key: instance.value}, keys)
 
-    is_ci_var = instance.key.startswith('ci_')
-    key_startswith = instance.key.startswith('env_') or is_ci_var
-    if not key_startswith and instance.key not in Project.VARS_KEY:
-        msg = 'Unknown variable key \'{}\'. Key must be in {} or starts from \'env_\' or \'ci_\'.'
-        raise ValidationError(msg.format(instance.key, Project.VARS_KEY))
-
-    is_ci_template = instance.key == 'ci_template'
-    qs_variables = project_object.variables.all()
 
-    if is_ci_var and qs_variables.filter(key__startswith='repo_sync_on_run').exists():
-        raise Conflict('Couldnt install CI/CD to project with "repo_sync_on_run" settings.')
-    if instance.key.startswith('repo_sync_on_run') and project_object.get_vars_prefixed('ci'):
-        raise Conflict('Couldnt install "repo_sync_on_run" settings for CI/CD project.')
-    if is_ci_template and not project_object.template.filter(pk=instance.value).exists():
-        raise ValidationError('Template does not exists in this project.')
+@receiver(pre_set_vars)
+def check_set_variables_values(instance: Any, variables: Dict, keys: Iterable[Text], **kwargs) -> NoReturn:
+    validate_variables(instance, variables)
+    if isinstance(instance, Project):
+        validate_project_variables(instance, variables, keys)
 
 
 @receiver(signals.pre_save, sender=Group)
@@ -130,12 +157,44 @@ def check_circular_deps(instance: Group, action: Text, pk_set: Iterable, *args,
     if (action in ["pre_add", "post_add"]) and ('loaddata' not in sys.argv):
         if instance.id in pk_set:
             raise instance.CiclicDependencyError("The group can not refer to itself.")
+        if settings.GROUPS_CLOSURE:
+            # New child must not be ancestor and new parent must not be descendant.
+            relation = (pk_set, [instance.id]) if kwargs['reverse'] else ([instance.id], pk_set)
+            if action == "pre_add" and GroupClosure.objects.has_relation(*relation):
+                raise instance.CiclicDependencyError("The group has a dependence on itself.")
+            return
         parents = instance.parents.all().get_parents()
         childrens = instance.groups.all().get_subgroups()
         if instance in (parents | childrens) or parents.filter(id__in=pk_set).count():
             raise instance.CiclicDependencyError("The group has a dependence on itself.")
 
 
+@receiver(signals.m2m_changed, sender=Group.parents.through)
+def update_groups_closure(instance: Group, action: Text, pk_set: Iterable, reverse: bool, **kwargs) -> NoReturn:
+    # Closure must be consistent even on loaddata.
+    if not settings.GROUPS_CLOSURE:
+        return
+    if action in ["pre_remove", "pre_clear"]:
+        related = instance.groups if reverse else instance.parents
+        if pk_set is not None:
+            related = related.filter(id__in=pk_set)
+        pk_set, count = list(related.values_list('id', flat=True)), -1
+    elif action == "post_add":
+        count = 1
+    else:
+        return
+    for pk in pk_set:
+        parent_id, child_id = (instance.id, pk) if reverse else (pk, instance.id)
+        GroupClosure.objects.update_relation(parent_id, child_id, count)
+
+
+@receiver(signals.pre_delete, sender=Group)
+def clean_groups_closure(instance: Group, **kwargs) -> NoReturn:
+    if settings.GROUPS_CLOSURE:
+        instance.parents.clear()
+        instance.groups.clear()
+
+
 @receiver(signals.pre_save, sender=PeriodicTask)
 def validate_types(instance: PeriodicTask, **kwargs) -> NoReturn:
     if 'loaddata' in sys.argv or kwargs.get('raw', False):  # nocv
@@ -306,6 +365,11 @@ def check_hook(instance: Hook, **kwargs) -> NoReturn:
         raise ValidationError(errors)
 
 
+@receiver([signals.post_save, signals.post_delete], sender=Hook)
+def update_hooks_version(**kwargs) -> NoReturn:
+    Hook.router.update_version()
+
+
 @receiver([signals.post_save, signals.post_delete], sender=BaseUser,
           dispatch_uid='user_add_hook')
 def user_add_hook(instance: BaseUser, **kwargs) -> NoReturn:
@@ -346,6 +410,44 @@ def polemarch_hook(instance: Any, **kwargs) -> NoReturn:
     send_polemarch_models(when, instance)
 
 
+@receiver(post_set_vars)
+def polemarch_vars_hook(instance: Any, **kwargs) -> NoReturn:
+    send_polemarch_models("on_object_upd", instance)
+
+
+@receiver(post_set_vars)
+@receiver([signals.post_save, signals.post_delete], sender=Variable)
+@receiver([signals.post_save, signals.post_delete], sender=Inventory)
+@receiver([signals.post_save, signals.post_delete], sender=Group)
+@receiver([signals.post_save, signals.post_delete], sender=Host)
+def update_inventory_version(instance: Any, **kwargs) -> NoReturn:
+    # Compiled inventories must be invalidated even on loaddata.
+    model, object_id = instance.__class__, instance.id
+    if isinstance(instance, Variable):
+        model = ContentType.objects.get_for_id(instance.content_type_id).model_class()
+        object_id = instance.object_id
+    if model == Inventory:
+        InventoryCache.update_version(object_id)
+    elif model in (Host, Group):
+        InventoryCache.update_version()
+
+
+@receiver(signals.m2m_changed, sender=Inventory.hosts.through)
+@receiver(signals.m2m_changed, sender=Inventory.groups.through)
+@receiver(signals.m2m_changed, sender=Group.hosts.through)
+@receiver(signals.m2m_changed, sender=Group.parents.through)
+def update_inventory_version_on_links(instance: Any, action: Text, pk_set: Iterable, **kwargs) -> NoReturn:
+    if action not in ["post_add", "post_remove", "post_clear"]:
+        return
+    if isinstance(instance, Inventory):
+        InventoryCache.update_version(instance.id)
+    elif kwargs['model'] == Inventory and pk_set:
+        for inventory_id in pk_set:
+            InventoryCache.update_version(inventory_id)
+    else:
+        InventoryCache.update_version()
+
+
 @receiver(signals.post_save, sender=BaseUser)
 def create_settings_for_user(instance: BaseUser, **kwargs) -> NoReturn:
     if 'loaddata' in sys.argv or kwargs.get('raw', False):  # noce
@@ -360,12 +462,48 @@ def update_ptasks_with_templates(instance: Template, **kwargs) -> NoReturn:
     instance.periodic_task.all().update(project=instance.project)
 
 
+@receiver(signals.pre_delete, sender=BaseUser)
+def clear_statistic_executor(instance: BaseUser, **kwargs) -> NoReturn:
+    HistoryStatistic.objects.clear_executor(instance.id)
+
+
 @receiver(signals.pre_delete, sender=History)
 def cancel_task_on_delete_history(instance: History, **kwargs) -> NoReturn:
     exchange = KVExchanger(CmdExecutor.CANCEL_PREFIX + str(instance.id))
     exchange.send(True, 60) if instance.working else None
 
 
+@receiver(signals.pre_save, sender=History)
+def load_history_statistic_key(instance: History, **kwargs) -> NoReturn:
+    if instance._state.adding or instance.statistic_saved_key is not None:
+        return
+    # History was loaded with deferred fields, so key is taken from database.
+    saved = History.objects.filter(pk=instance.pk).values_list(*History.statistic_fields).first()
+    if saved is not None:
+        instance.statistic_saved_key = History(
+            **dict(zip(History.statistic_fields, saved))
+        ).statistic_key
+
+
+@receiver(signals.post_save, sender=History)
+def update_history_statistic(instance: History, created: bool, **kwargs) -> NoReturn:
+    if kwargs.get('raw', False):  # noce
+        return
+    old_key, new_key = None if created else instance.statistic_saved_key, instance.statistic_key
+    if old_key == new_key:
+        return
+    if old_key is not None:
+        HistoryStatistic.objects.change(old_key, -1)
+    HistoryStatistic.objects.change(new_key, 1)
+    instance.statistic_saved_key = new_key
+
+
+@receiver(signals.post_delete, sender=History)
+def remove_history_statistic(instance: History, **kwargs) -> NoReturn:
+    key = instance.statistic_saved_key or instance.statistic_key
+    HistoryStatistic.objects.change(key, -1)
+
+
 @receiver(signals.post_migrate)
 def update_crontab_timezone_ptasks(*args, **kwargs):
     qs = CrontabSchedule.objects.exclude(timezone=settings.TIME_ZONE)
@@ -1,13 +1,24 @@
 from __future__ import unicode_literals
-from typing import NoReturn, Text, Any, List
+from typing import NoReturn, Text, Any, List, Iterable, Tuple, Dict, Optional
+import json
+import contextlib
 import logging
+import threading
 import collections
 import uuid
+from datetime import timedelta
+from functools import partial
+from itertools import groupby
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
 from vstutils.utils import raise_context, ModelHandlers
+from ..utils import Metrics, PMObject, VersionUpdate
 from .base import BModel, BQuerySet, models
 
 
 logger = logging.getLogger('polemarch')
+Route = Tuple['Hook', Any]
 
 
 class HookHandlers(ModelHandlers):
@@ -37,20 +48,184 @@ class HookHandlers(ModelHandlers):
 
 class HooksQuerySet(BQuerySet):
     use_for_related_fields = True
+    task_handlers = ModelHandlers("TASKS_HANDLERS", "Unknown execution type!")
 
     def when(self, when: Text) -> BQuerySet:
         return self.filter(enable=True).filter(models.Q(when=when) | models.Q(when=None))
 
+    def routes(self, when: Text) -> List[Route]:
+        return [(hook, Hook.handlers.get_handler(hook)) for hook in self.when(when).order_by('id')]
+
+    def send(self, when: Text, messages: List, routes: List[Route]) -> NoReturn:
+        '''
+        Send messages to hooks with their prepared handlers.
+        '''
+        if not routes or not messages:
+            return
+        if not settings.HOOKS_ASYNC:
+            for hook, handler in routes:
+                logger.debug("Send hook {} triggered by {}.".format(hook.name, when))
+                for message in messages:
+                    with raise_context():
+                        getattr(handler, when)(message)
+            return
+        with raise_context():
+            self.task_handlers.backend("HOOKS").apply_async(
+                kwargs=dict(when=when, messages=messages, hooks=[hook.id for hook, _ in routes]),
+                **HookDelivery.get_task_options()
+            )
+
+    def execute(self, when: Text, message: Any) -> NoReturn:
+        self.send(when, [message], self.routes(when))
+
+
+class HooksRouter(PMObject):
+    '''
+    In-process table of enabled hooks with prepared handlers by `when`.
+    Table is rebuilt when hooks version in shared `locks` cache is changed
+    (after commit of changes), so events cost no queries while hooks are not changed.
+    Transaction which changes hooks routes by its own data without table.
+    '''
+    __slots__ = 'version', 'table', 'lock'
+    versions_cache_name = 'locks'
+    version_key = 'hooks-version'
+
+    def __init__(self):
+        self.version, self.table = None, dict()  # type: Any, Dict[Text, List[Route]]
+        self.lock = threading.Lock()
+
+    @property
+    def versions(self):
+        return self.get_django_cache(self.versions_cache_name)
+
+    def get_version(self) -> Text:
+        version = self.versions.get(self.version_key)
+        if version is None:
+            self.versions.add(self.version_key, uuid.uuid4().hex, None)
+            version = self.versions.get(self.version_key)
+        return version
+
+    @property
+    def update(self) -> VersionUpdate:
+        return VersionUpdate(self.versions, self.version_key)
+
+    def update_version(self) -> NoReturn:
+        '''
+        Invalidate tables of all processes after commit.
+        '''
+        self.update.schedule()
+
+    def build(self) -> Dict[Text, List[Route]]:
+        table = collections.OrderedDict((when, []) for when in Hook.handlers.when_types)
+        for hook in Hook.objects.filter(enable=True).order_by('id'):
+            handler = Hook.handlers.get_handler(hook)
+            for when in ([hook.when] if hook.when is not None else table.keys()):
+                table.setdefault(when, []).append((hook, handler))
+        return table
+
+    def get(self, when: Text) -> List[Route]:
+        if self.update.pending:
+            return self.build().get(when, [])
+        version = self.get_version()
+        with self.lock:
+            if version != self.version:
+                self.table, self.version = self.build(), version
+            return self.table.get(when, [])
+
     def execute(self, when: Text, message: Any) -> NoReturn:
-        for hook in self.when(when):
+        routes = self.get(when)
+        if routes:
+            Hook.objects.send(when, [message], routes)
+
+    def execute_many(self, when: Text, messages: List[Dict]) -> NoReturn:
+        '''
+        Send messages of one type. Hooks with batch mode get one message
+        with `targets` list instead of many messages with `target`.
+        '''
+        routes = self.get(when)
+        if not routes:
+            return
+        batch = [route for route in routes if route[1].conf.get('batch')]
+        if batch and len(messages) > 1:
+            routes = [route for route in routes if not route[1].conf.get('batch')]
+            message = collections.OrderedDict(when=when)
+            message['targets'] = [item['target'] for item in messages]
+            Hook.objects.send(when, [message], batch)
+        Hook.objects.send(when, messages, routes)
+
+
+class HookEvents(object):
+    '''
+    Object-change events collected in scope of transaction (see `collect`).
+    Events of the same object are coalesced to one and all events are sent
+    once after commit.
+    '''
+    __slots__ = 'events',
+    local = threading.local()
+
+    def __init__(self):
+        # Object key -> [first event type, last event type, last target].
+        self.events = collections.OrderedDict()  # type: Dict[Tuple, List]
+
+    @classmethod
+    def current(cls) -> Optional['HookEvents']:
+        return getattr(cls.local, 'events', None)
+
+    def add(self, when: Text, key: Tuple, target: Any) -> NoReturn:
+        event = self.events.get(key, None)
+        if event is None:
+            self.events[key] = [when, when, target]
+        else:
+            event[1:] = [when, target]
+
+    @staticmethod
+    def get_when(first: Text, last: Text) -> Optional[Text]:
+        prefix, first_action = first.rsplit('_', 1)
+        last_action = last.rsplit('_', 1)[1]
+        if last_action == 'del':
+            # Object created and removed in one transaction is never seen by recipients.
+            return None if first_action == 'add' else last
+        return '{}_{}'.format(prefix, 'add' if first_action == 'add' else 'upd')
+
+    def get_messages(self) -> Dict[Text, List[Dict]]:
+        messages = collections.OrderedDict()
+        for first, last, target in self.events.values():
+            when = self.get_when(first, last)
+            if when is not None:
+                message = collections.OrderedDict(when=when)
+                message['target'] = target
+                messages.setdefault(when, []).append(message)
+        return messages
+
+    def flush(self) -> NoReturn:
+        for when, messages in self.get_messages().items():
             with raise_context():
-                hook.run(when, message)
+                Hook.router.execute_many(when, messages)
+
+
+@contextlib.contextmanager
+def collect_hooks():
+    '''
+    Collect object-change events of hooks until commit of transaction.
+    Nested scopes join the outer one. Events are dropped on error.
+    '''
+    events = HookEvents.current()
+    if events is not None:
+        yield events
+        return
+    events = HookEvents.local.events = HookEvents()
+    try:
+        yield events
+    finally:
+        HookEvents.local.events = None
+    transaction.on_commit(events.flush)
 
 
 class Hook(BModel):
     # pylint: disable=no-member
     objects = HooksQuerySet.as_manager()
     handlers = HookHandlers("HOOKS", "'type' needed!")
+    router = HooksRouter()
     name       = models.CharField(max_length=512, default=uuid.uuid1)
     type       = models.CharField(max_length=32, null=False, db_index=True)
     when       = models.CharField(max_length=32, null=True, default=None, db_index=True)
@@ -66,3 +241,111 @@ class Hook(BModel):
             self.handlers.handle(self, when, message)
             if self.when is None or self.when == when else ''
         )
+
+
+class HookDeliveryQuerySet(BQuerySet):
+    use_for_related_fields = True
+    cleanup_key = 'hooks-cleanup'
+    cleanup_interval = 3600
+
+    def prepare(self, hooks: Iterable[Hook], when: Text, messages: List) -> List['HookDelivery']:
+        '''
+        New (unsaved) deliveries of messages to every recipient of hooks.
+        '''
+        hooks = list(hooks)
+        return [
+            self.model(hook=hook, recipient=recipient, when=when, message=message)
+            for message in map(json.dumps, messages)
+            for hook in hooks for recipient in hook.reps if recipient
+        ]
+
+    def pending(self, ids: Iterable[int]) -> List['HookDelivery']:
+        return list(self.filter(id__in=ids, status='PENDING').select_related('hook').order_by('id'))
+
+    def deliver(self, deliveries: List['HookDelivery']) -> List['HookDelivery']:
+        '''
+        Send deliveries and save results. Recipients of hook get messages
+        concurrently, but every recipient gets them in order of events.
+        Returns saved deliveries which should be retried.
+        '''
+        endpoints = collections.OrderedDict()
+        for delivery in deliveries:
+            endpoints.setdefault((delivery.hook_id, delivery.recipient), []).append(delivery)
+        retry, by_hook = [], lambda item: item[0][0]
+        for _, group in groupby(sorted(endpoints.items(), key=by_hook), key=by_hook):
+            queues = [queue for _, queue in group]
+            handler = Hook.handlers.get_handler(queues[0][0].hook)
+            for result in handler.map(partial(self._deliver_queue, handler), queues):
+                retry += result
+        metrics = Metrics()
+        for status, count in collections.Counter(delivery.status for delivery in deliveries).items():
+            metrics.incr('hooks_{}'.format(status.lower()), count)
+        # New finished deliveries need no ids, so they are inserted by one query.
+        retried = set(map(id, retry))
+        with transaction.atomic():
+            self.bulk_create([
+                delivery for delivery in deliveries if delivery.pk is None and id(delivery) not in retried
+            ])
+            for delivery in deliveries:
+                if delivery.pk is not None or id(delivery) in retried:
+                    delivery.save()
+        return retry
+
+    @staticmethod
+    def _deliver_queue(handler, queue: List['HookDelivery']) -> List['HookDelivery']:
+        for index, delivery in enumerate(queue):
+            delivery.send(handler)
+            if delivery.status == 'PENDING':
+                # Next messages for unavailable recipient wait for retry of this one.
+                return queue[index:]
+        return []
+
+    def cleanup(self) -> bool:
+        '''
+        Remove old results of deliveries. Cleanup is done once
+        in `cleanup_interval` by any worker, so it is cheap to call it often.
+        '''
+        if not PMObject.get_django_cache('locks').add(self.cleanup_key, 1, self.cleanup_interval):
+            return False
+        border = timezone.now() - timedelta(seconds=settings.HOOKS_RESULTS_LIFETIME)
+        self.filter(created__lt=border).exclude(status='PENDING').delete()
+        return True
+
+
+class HookDelivery(BModel):
+    '''
+    Message of hook for one recipient and result of its sending.
+    '''
+    objects = HookDeliveryQuerySet.as_manager()
+    hook       = models.ForeignKey(Hook, on_delete=models.CASCADE)
+    recipient  = models.TextField()
+    when       = models.CharField(max_length=32)
+    message    = models.TextField()
+    status     = models.CharField(max_length=16, default='PENDING', db_index=True)
+    attempts   = models.PositiveIntegerField(default=0)
+    result     = models.TextField(default='')
+    created    = models.DateTimeField(default=timezone.now, db_index=True)
+    sent       = models.DateTimeField(null=True, default=None)
+
+    class Meta:
+        default_related_name = 'deliveries'
+
+    @staticmethod
+    def get_task_options():
+        return dict(queue=settings.HOOKS_QUEUE) if settings.HOOKS_QUEUE else dict()
+
+    @staticmethod
+    def get_retry_delay(deliveries: Iterable['HookDelivery']) -> int:
+        attempts = max(delivery.attempts for delivery in deliveries)
+        return settings.HOOKS_RETRY_DELAY * 2 ** max(attempts - 1, 0)
+
+    def send(self, handler) -> NoReturn:
+        message = json.loads(self.message, object_pairs_hook=collections.OrderedDict)
+        handler.when = self.when
+        status, result = handler.deliver(self.recipient, self.when, handler.modify_message(message))
+        self.result = str(result)
+        self.attempts += 1
+        self.sent = timezone.now()
+        if status == 'RETRY':
+            status = 'PENDING' if self.attempts <= settings.HOOKS_RETRIES else 'ERROR'
+        self.status = status
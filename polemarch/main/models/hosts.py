@@ -1,19 +1,28 @@
 # pylint: disable=protected-access,no-member
 from __future__ import unicode_literals
-from typing import Any, List, Tuple, Dict, Text
+from typing import Any, List, Tuple, Dict, Text, Iterable
 import logging
+import uuid
+from functools import reduce
+from collections import OrderedDict, defaultdict, Counter
 import six
+from django.db import connections, transaction
 from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from vstutils.utils import tmp_file
 try:
     from yaml import dump as to_yaml, CDumper as Dumper, ScalarNode
 except ImportError:  # nocv
     from yaml import dump as to_yaml, Dumper, ScalarNode
 
-from .base import models
+from .base import models, BModel, BQuerySet
 from .base import ManyToManyFieldACL, ManyToManyFieldACLReverse
-from .vars import AbstractModel, AbstractVarsQuerySet
+from .vars import AbstractModel, AbstractVarsQuerySet, Variable, update_boolean
 from ...main import exceptions as ex
 from ..validators import RegexValidator
+from ..utils import InventoryCache
 
 logger = logging.getLogger("polemarch")
 
@@ -41,6 +50,15 @@ def _get_dict(objects: AbstractVarsQuerySet, keys: List = None, tmp_dir: Text =
     return result, keys
 
 
+class _SubquerySQL(RawSQL):
+    '''
+    Raw subquery for `__in` lookups. Unlike `RawSQL`, it isn't wrapped
+    in extra brackets, which makes scalar subquery from `WITH` statement.
+    '''
+    def as_sql(self, compiler, connection):
+        return self.sql, self.params
+
+
 # Helpfull exceptions
 class CiclicDependencyError(ex.PMException):
     _def_message = "A cyclic dependence was found. {}"
@@ -81,7 +99,22 @@ class Host(AbstractModel):
 class GroupQuerySet(AbstractVarsQuerySet):
     # pylint: disable=no-member
 
-    def get_subgroups_id(self, accumulated: AbstractVarsQuerySet = None, tp: Text = "parents") -> AbstractVarsQuerySet:
+    _subgroups_cte = (
+        'WITH RECURSIVE {tree} ({id}) AS ('
+        '{base} UNION '
+        'SELECT {rel}.{target} FROM {rel} INNER JOIN {tree} ON {rel}.{source} = {tree}.{id}'
+        ') SELECT {tree}.{id} FROM {tree}'
+    )
+
+    def _has_recursive_cte(self) -> bool:
+        connection = connections[self.db]
+        if connection.vendor == 'mysql' and not connection.mysql_is_mariadb:
+            return connection.mysql_version >= (8, 0)
+        return connection.vendor in ('mysql', 'sqlite', 'postgresql')
+
+    def _get_subgroups_id_iterative(self, accumulated: AbstractVarsQuerySet = None,
+                                    tp: Text = "parents") -> AbstractVarsQuerySet:
+        # Fallback for databases without recursive CTE (MySQL < 8.0).
         accumulated = accumulated if accumulated else self.none()
         list_id = self.exclude(id__in=accumulated).values_list("id", flat=True)
         accumulated = (accumulated | list_id)
@@ -89,9 +122,44 @@ class GroupQuerySet(AbstractVarsQuerySet):
         subs = self.model.objects.filter(**kw)
         subs_id = subs.values_list("id", flat=True)
         if subs_id:
-            accumulated = (accumulated | subs.get_subgroups_id(accumulated, tp))
+            accumulated = (accumulated | subs._get_subgroups_id_iterative(accumulated, tp))
         return accumulated
 
+    def get_subgroups_id(self, tp: Text = "parents") -> AbstractVarsQuerySet:
+        '''
+        Ids of groups from queryset with all their subgroups (`tp="parents"`)
+        or all their parents (`tp="childrens"`).
+        Whole tree is resolved by one recursive query.
+        '''
+        if settings.GROUPS_CLOSURE:
+            return self._get_subgroups_id_closure(tp)
+        if not self._has_recursive_cte():
+            return self._get_subgroups_id_iterative(tp=tp)  # nocv
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        relation = self.model.parents.through._meta
+        source, target = (
+            relation.get_field(name).column for name in ('to_group', 'from_group')
+        )
+        if tp != "parents":
+            source, target = target, source
+        base, params = self.order_by().values('id').query.sql_with_params()
+        sql = self._subgroups_cte.format(
+            tree=qn('pm_subgroups'), id=qn('id'), base=base,
+            rel=qn(relation.db_table), source=qn(source), target=qn(target),
+        )
+        return self.model.objects.filter(id__in=_SubquerySQL(sql, params)).values_list("id", flat=True)
+
+    def _get_subgroups_id_closure(self, tp: Text = "parents") -> AbstractVarsQuerySet:
+        own, related = "ancestor", "descendant"
+        if tp != "parents":
+            own, related = related, own
+        ids = self.values('id')
+        relatives = GroupClosure.objects.filter(**{own + '__in': ids}).values(related)
+        return self.model.objects.filter(
+            Q(id__in=ids) | Q(id__in=relatives)
+        ).values_list("id", flat=True)
+
     def get_subgroups(self) -> AbstractVarsQuerySet:
         return self.model.objects.filter(id__in=self.get_subgroups_id(tp="parents"))
 
@@ -132,6 +200,130 @@ class Group(AbstractModel):
         return result, keys
 
 
+class GroupClosureQuerySet(BQuerySet):
+    # pylint: disable=no-member
+
+    def has_relation(self, ancestors_ids: Iterable[int], descendants_ids: Iterable[int]) -> bool:
+        return self.filter(ancestor_id__in=ancestors_ids, descendant_id__in=descendants_ids).exists()
+
+    def _get_edges(self) -> Dict[int, List[int]]:
+        edges = defaultdict(list)
+        relations = Group.parents.through.objects.values_list('to_group_id', 'from_group_id')
+        for parent_id, child_id in relations:
+            edges[parent_id].append(child_id)
+        return edges
+
+    def calculate(self) -> Counter:
+        '''
+        Calculate closure of groups tree from relations of groups.
+
+        :return: -- counts of paths by (ancestor, descendant, depth).
+        '''
+        edges, calculated = self._get_edges(), dict()
+
+        def get_descendants(group_id: int) -> Counter:
+            if group_id not in calculated:
+                result = Counter()
+                for child_id in edges[group_id]:
+                    result[(child_id, 1)] += 1
+                    for (descendant_id, depth), paths in get_descendants(child_id).items():
+                        result[(descendant_id, depth + 1)] += paths
+                calculated[group_id] = result
+            return calculated[group_id]
+
+        closure = Counter()
+        for group_id in list(edges.keys()):
+            for (descendant_id, depth), paths in get_descendants(group_id).items():
+                closure[(group_id, descendant_id, depth)] = paths
+        return closure
+
+    def check_consistency(self) -> List[Tuple[int, int, int]]:
+        '''
+        Check consistency of stored closure.
+
+        :return: -- list of (ancestor, descendant, depth) with wrong paths count.
+        '''
+        stored = Counter({
+            (ancestor_id, descendant_id, depth): paths
+            for ancestor_id, descendant_id, depth, paths in self.values_list(
+                'ancestor_id', 'descendant_id', 'depth', 'paths'
+            )
+        })
+        calculated = self.calculate()
+        return sorted(
+            key for key in set(stored.keys()) | set(calculated.keys())
+            if stored[key] != calculated[key]
+        )
+
+    @transaction.atomic()
+    def rebuild(self) -> int:
+        self.all().delete()
+        objects = self.bulk_create([
+            self.model(ancestor_id=ancestor_id, descendant_id=descendant_id, depth=depth, paths=paths)
+            for (ancestor_id, descendant_id, depth), paths in self.calculate().items()
+        ], batch_size=1000)
+        return len(objects)
+
+    def update_relation(self, parent_id: int, child_id: int, count: int = 1):
+        '''
+        Apply new (`count=1`) or removed (`count=-1`) relation
+        between parent and child groups to closure.
+        '''
+        ancestors = [(parent_id, 0, 1)] + list(
+            self.filter(descendant_id=parent_id).values_list('ancestor_id', 'depth', 'paths')
+        )
+        descendants = [(child_id, 0, 1)] + list(
+            self.filter(ancestor_id=child_id).values_list('descendant_id', 'depth', 'paths')
+        )
+        changes = Counter()
+        for ancestor_id, ancestor_depth, ancestor_paths in ancestors:
+            for descendant_id, descendant_depth, descendant_paths in descendants:
+                key = (ancestor_id, descendant_id, ancestor_depth + descendant_depth + 1)
+                changes[key] += ancestor_paths * descendant_paths * count
+        existing = {
+            (row.ancestor_id, row.descendant_id, row.depth): row
+            for row in self.filter(
+                ancestor_id__in={key[0] for key in changes},
+                descendant_id__in={key[1] for key in changes},
+            )
+        }
+        to_create, to_update, to_delete = [], [], []
+        for key, paths in changes.items():
+            row = existing.get(key, None)
+            if row is None and paths <= 0:
+                continue  # nocv
+            elif row is None:
+                to_create.append(self.model(
+                    ancestor_id=key[0], descendant_id=key[1], depth=key[2], paths=paths
+                ))
+                continue
+            row.paths += paths
+            (to_update if row.paths > 0 else to_delete).append(row)
+        self.bulk_create(to_create)
+        self.bulk_update(to_update, ['paths'])
+        self.filter(id__in=[row.id for row in to_delete]).delete()
+
+
+class GroupClosure(BModel):
+    '''
+    Materialized transitive closure of groups tree.
+    Used instead of recursive queries when `groups_closure` is enabled.
+    '''
+    objects     = GroupClosureQuerySet.as_manager()
+    ancestor    = models.ForeignKey(Group, on_delete=models.CASCADE,
+                                    related_query_name="descendants_closure",
+                                    related_name="descendants_closure")
+    descendant  = models.ForeignKey(Group, on_delete=models.CASCADE,
+                                    related_query_name="ancestors_closure",
+                                    related_name="ancestors_closure")
+    depth       = models.PositiveIntegerField(default=1)
+    paths       = models.PositiveIntegerField(default=1)
+
+    class Meta:
+        unique_together = [["ancestor", "descendant", "depth"]]
+        index_together = [["descendant", "ancestor"]]
+
+
 class Inventory(AbstractModel):
     hosts       = ManyToManyFieldACL(Host)
     groups      = ManyToManyFieldACL(Group)
@@ -169,20 +361,35 @@ class Inventory(AbstractModel):
         '''
         return self.hosts.all().order_by("name")
 
+    def get_inventory_cache(self) -> InventoryCache:
+        return InventoryCache(self.id)
+
     def get_inventory(self, tmp_dir='/tmp/') -> Tuple[Text, List]:
-        inv = dict(all=dict())
-        hvars, keys = self.get_generated_vars(tmp_dir)
-        hosts = self.hosts.all().order_by("name")
-        groups = self.groups.all().order_by("name")
-        hosts_dicts, keys = _get_dict(hosts, keys, tmp_dir)
-        groups_dicts, keys = _get_dict(groups, keys, tmp_dir)
-        if hosts_dicts:
-            inv['all']['hosts'] = hosts_dicts
-        if groups_dicts:
-            inv['all']['children'] = groups_dicts
-        if hvars:
-            inv['all']['vars'] = hvars
-        return to_yaml(inv, **self._to_yaml_kwargs), keys
+        cache = self.get_inventory_cache()
+        data = cache.get()
+        if data is None:
+            inv, keys = InventoryCompiler(self).compile()
+            data = dict(raw=to_yaml(inv, **self._to_yaml_kwargs), keys=keys)
+            cache.set(data)
+        return self._make_keys_files(data['raw'], data['keys'], tmp_dir)
+
+    def _make_keys_files(self, raw: Text, keys: Dict[Text, int], tmp_dir: Text) -> Tuple[Text, List]:
+        '''
+        Write private keys to temporary files of execution and put
+        their names to inventory instead of placeholders.
+        '''
+        files = []
+        if not keys:
+            return raw, files
+        values = dict(
+            Variable.objects.filter(id__in=keys.values()).values_list('id', 'value')
+        )
+        for placeholder, var_id in keys.items():
+            tmp = tmp_file(dir=tmp_dir)
+            tmp.write(values.get(var_id, None) or '')
+            raw = raw.replace(placeholder, tmp.name)
+            files.append(tmp)
+        return raw, files
 
     @property
     def all_groups(self) -> GroupQuerySet:
@@ -193,3 +400,117 @@ class Inventory(AbstractModel):
         return Host.objects.filter(
             Q(groups__in=self.groups_list) | Q(pk__in=self.hosts_list)
         ).distinct()
+
+
+class InventoryCompiler(object):
+    '''
+    Builds inventory dict with fixed count of queries.
+    All groups, hosts, relations and variables of inventory are loaded
+    by bulk queries and tree is assembled in memory. Result is the same
+    as rendering with `toDict()` of every object, except private keys,
+    which are replaced with placeholders (see `keys`), so result could be
+    cached without secrets.
+    '''
+    # pylint: disable=too-many-instance-attributes
+    __slots__ = (
+        'inventory', 'keys', 'keys_prefix', 'groups', 'hosts',
+        'group_children', 'group_hosts', 'variables', 'variables_ids', '_generated',
+    )
+
+    def __init__(self, inventory: Inventory):
+        self.inventory = inventory
+        self.keys = dict()  # type: Dict[Text, int]
+        self.keys_prefix = 'pm_private_key_{}_'.format(uuid.uuid4().hex)
+        self.groups = dict()  # type: Dict[int, Tuple[Text, bool]]
+        self.hosts = dict()  # type: Dict[int, Text]
+        self.group_children = defaultdict(list)  # type: Dict[int, List[int]]
+        self.group_hosts = defaultdict(list)  # type: Dict[int, List[int]]
+        self.variables = defaultdict(OrderedDict)  # type: Dict[Tuple, OrderedDict]
+        self.variables_ids = dict()  # type: Dict[Tuple, int]
+        self._generated = dict()  # type: Dict[Tuple, Dict]
+
+    def load(self):
+        groups_qs = Group.objects.filter(
+            id__in=self.inventory.groups.all().get_subgroups_id()
+        )
+        hosts_qs = Host.objects.filter(
+            Q(inventories=self.inventory) | Q(groups__in=groups_qs)
+        ).distinct()
+        for group_id, name, children in groups_qs.values_list('id', 'name', 'children'):
+            self.groups[group_id] = (name, children)
+        self.hosts.update(hosts_qs.values_list('id', 'name'))
+        parents_qs = Group.parents.through.objects.filter(to_group__in=groups_qs)
+        for parent_id, child_id in parents_qs.order_by('from_group_id').values_list(
+                'to_group_id', 'from_group_id'
+        ):
+            self.group_children[parent_id].append(child_id)
+        group_hosts_qs = Group.hosts.through.objects.filter(group__in=groups_qs)
+        for group_id, host_id in group_hosts_qs.order_by('host_id').values_list(
+                'group_id', 'host_id'
+        ):
+            self.group_hosts[group_id].append(host_id)
+        types = ContentType.objects.get_for_models(Inventory, Group, Host)
+        variables_qs = Variable.objects.filter(
+            Q(content_type=types[Inventory], object_id=self.inventory.id) |
+            Q(content_type=types[Group], object_id__in=groups_qs.values('id')) |
+            Q(content_type=types[Host], object_id__in=hosts_qs.values('id'))
+        ).sort_by_key().values_list('id', 'content_type_id', 'object_id', 'key', 'value')
+        for var_id, type_id, object_id, key, value in variables_qs:
+            self.variables[(type_id, object_id)][key] = value
+            self.variables_ids[(type_id, object_id, key)] = var_id
+        return types
+
+    def get_vars(self, model, object_id: int, type_id: int) -> Dict:
+        index = (type_id, object_id)
+        if index not in self._generated:
+            obj_vars = reduce(
+                update_boolean, model.BOOLEAN_VARS, self.variables.get(index, OrderedDict())
+            )
+            if "ansible_ssh_private_key_file" in obj_vars:
+                var_id = self.variables_ids[index + ("ansible_ssh_private_key_file",)]
+                placeholder = '{}{}_'.format(self.keys_prefix, var_id)
+                obj_vars["ansible_ssh_private_key_file"] = placeholder
+                self.keys[placeholder] = var_id
+            self._generated[index] = dict(obj_vars)
+        # New dict for every occurrence, otherwise yaml renders aliases
+        return dict(self._generated[index])
+
+    def get_host(self, host_id: int, types: Dict) -> Any:
+        return self.get_vars(Host, host_id, types[Host].id) or None
+
+    def get_group(self, group_id: int, types: Dict) -> Dict:
+        result = dict()
+        if self.groups[group_id][1]:
+            objs_dict = {
+                self.groups[child_id][0]: self.get_group(child_id, types)
+                for child_id in self.group_children[group_id]
+            }
+            key_name = 'children'
+        else:
+            objs_dict = {
+                self.hosts[host_id]: self.get_host(host_id, types)
+                for host_id in self.group_hosts[group_id]
+            }
+            key_name = 'hosts'
+        if objs_dict:
+            result[key_name] = objs_dict
+        hvars = self.get_vars(Group, group_id, types[Group].id)
+        if hvars:
+            result['vars'] = hvars
+        return result
+
+    def compile(self) -> Tuple[Dict, Dict[Text, int]]:
+        types = self.load()
+        inv = dict(all=dict())
+        hvars = self.get_vars(Inventory, self.inventory.id, types[Inventory].id)
+        hosts = self.inventory.hosts.order_by('name', 'id').values_list('id', flat=True)
+        groups = self.inventory.groups.order_by('name', 'id').values_list('id', flat=True)
+        hosts_dicts = {self.hosts[pk]: self.get_host(pk, types) for pk in hosts}
+        groups_dicts = {self.groups[pk][0]: self.get_group(pk, types) for pk in groups}
+        if hosts_dicts:
+            inv['all']['hosts'] = hosts_dicts
+        if groups_dicts:
+            inv['all']['children'] = groups_dicts
+        if hvars:
+            inv['all']['vars'] = hvars
+        return inv, self.keys
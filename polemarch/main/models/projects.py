@@ -9,6 +9,7 @@ import time
 import uuid
 import six
 import requests
+from celery import group
 from docutils.core import publish_parts as rst_gen
 from markdown2 import Markdown
 from django.conf import settings
@@ -29,6 +30,7 @@ from .vars import AbstractModel, AbstractVarsQuerySet, models
 from ..exceptions import PMException
 from .base import ManyToManyFieldACL, BQuerySet, BModel
 from .hooks import Hook
+from ..executions import get_message_priority
 from ..utils import AnsibleModules, AnsibleConfigParser, SubCacheInterface
 
 
@@ -123,7 +125,9 @@ class Project(AbstractModel):
         'repo_sync_on_run_timeout',
         'repo_branch',
         'repo_password',
-        'repo_key'
+        'repo_key',
+        'execution_concurrency',
+        'execution_queue',
     ]
 
     EXTRA_OPTIONS = {
@@ -131,7 +135,8 @@ class Project(AbstractModel):
         'initiator_type': 'project',
         'executor': None,
         'save_result': True,
-        'template_option': None
+        'template_option': None,
+        'priority': None,
     }
 
     PM_YAML_FORMATS = {
@@ -199,6 +204,10 @@ class Project(AbstractModel):
         except self.variables.model.DoesNotExist:
             return settings.PROJECT_REPOSYNC_WAIT_SECONDS
 
+    @property
+    def execution_queue(self) -> Text:
+        return self.vars.get('execution_queue', None) or settings.EXECUTION_QUEUE
+
     @property
     def config(self) -> Dict[Text, Any]:
         return self.get_ansible_config_parser().get_data()
@@ -299,7 +308,7 @@ class Project(AbstractModel):
         return kwargs
 
     def hook(self, when, msg) -> NoReturn:
-        Hook.objects.all().execute(when, msg)
+        Hook.router.execute(when, msg)
 
     def sync_on_execution_handler(self) -> NoReturn:
         if not self.vars.get('repo_sync_on_run', False):
@@ -316,6 +325,13 @@ class Project(AbstractModel):
         except Exception as exc:  # nocv
             raise self.SyncError("ERROR on Sync operation: " + str(exc))
 
+    def _get_task_options(self, history) -> Dict[str, Any]:
+        options = dict(priority=get_message_priority(history.priority if history else None))
+        queue = self.execution_queue
+        if queue:
+            options['queue'] = queue
+        return options
+
     def execute(self, kind: str, *args, **extra) -> HISTORY_ID:
         sync = extra.pop("sync", False)
         if self.status != "OK" and not sync:
@@ -328,9 +344,30 @@ class Project(AbstractModel):
         if sync:
             task_class(**kwargs)
         else:
-            task_class.delay(**kwargs)
+            task_class.apply_async(kwargs=kwargs, **self._get_task_options(history))
         return history.id if history is not None else history
 
+    def execute_many(self, kind: str, mod_name: str, inventories: List, **extra) -> List[HISTORY_ID]:
+        '''
+        Start the same execution for every inventory. Histories are created
+        with one insert and tasks are sent as one group.
+        '''
+        if self.status != "OK":
+            raise self.SyncError("ERROR project not synchronized")
+        if not mod_name:  # nocv
+            raise PMException("Empty playbook/module name.")
+        kind = kind.upper()
+        task_class = self.task_handlers.backend(kind)
+        histories, extra = self.history.all().start_many(self, kind, mod_name, inventories, **extra)
+        group(
+            task_class.signature(
+                kwargs=dict(target=mod_name, inventory=inventory, history=history, project=self, **extra),
+                **self._get_task_options(history)
+            )
+            for inventory, history in zip(inventories, histories)
+        ).apply_async()
+        return [history.id if history is not None else history for history in histories]
+
     def set_status(self, status) -> NoReturn:
         self.status = status
         self.save()
@@ -1,8 +1,9 @@
 # pylint: disable=protected-access,no-member
 from __future__ import unicode_literals
-from typing import NoReturn, Any, Dict, List, Tuple, Iterable, TypeVar, Generator, Text
+from typing import NoReturn, Any, Dict, List, Tuple, Iterable, TypeVar, Generator, Text, Optional
 import logging
-from collections import OrderedDict
+import time
+from collections import OrderedDict, Counter
 from datetime import timedelta, datetime
 from functools import partial
 import json
@@ -11,18 +12,19 @@ import re
 import six
 from celery.schedules import crontab
 from django.core.exceptions import ValidationError
-from django.db import transaction
-from django.db.models import Q
+from django.db import transaction, connections, IntegrityError
 from django.utils import timezone
 from django.contrib.auth.models import User
-from django.db.models import functions as dbfunc, Count
+from django.db.models import functions as dbfunc, Count, Sum, F
 from django.utils.timezone import now
-from django.test import Client
 from django.conf import settings
+from vstutils.utils import ModelHandlers, raise_context
 from rest_framework.exceptions import UnsupportedMediaType
 
 from . import Inventory
 from ..exceptions import DataNotReady, NotApplicable
+from ..utils import KVChannel, PMObject
+from ..executions import start_execution, ExecutionSlots
 from .base import ForeignKeyACL, BModel, ACLModel, BQuerySet, models
 from .vars import AbstractModel, AbstractVarsQuerySet
 from .projects import Project, HISTORY_ID
@@ -92,25 +94,28 @@ class Template(ACLModel):
         data.update(extra)
         return data
 
-    def execute(self, user: User, option: str = None, **extra):
-        # pylint: disable=protected-access
+    def execute(self, user: User, option: str = None, **extra) -> HISTORY_ID:
         tp = self._exec_types.get(self.kind, None)
         if tp is None:
             raise UnsupportedMediaType(media_type=self.kind)  # nocv
-        client = Client(SERVER_NAME='TEMPLATE')
-        client.force_login(user)
-        url = "/{}/{}/project/{}/execute_{}/".format(
-            getattr(settings, 'API_URL'), getattr(settings, 'VST_API_VERSION'),
-            self.project.id, tp
-        )
-        data = dict(
-            template=self.id, template_option=option,
-            **self.get_data_with_options(option, **extra)
-        )
-        response = client.post(
-            url, data=json.dumps(data), content_type="application/json"
+        data = dict(template_option=option, **self.get_data_with_options(option, **extra))
+        return start_execution(self.project, tp, data, user, template=self.id)
+
+    def execute_many(self, user: User, inventories: List, option: str = None, **extra) -> List[HISTORY_ID]:
+        '''
+        Execute template with every inventory from list in one batch.
+        '''
+        tp = self._exec_types.get(self.kind, None)
+        if tp is None:
+            raise UnsupportedMediaType(media_type=self.kind)  # nocv
+        data = self.get_data_with_options(option, **extra)
+        data.pop('inventory', None)
+        target = data.pop(tp)
+        return self.project.execute_many(
+            tp, str(target), inventories,
+            initiator=self.id, initiator_type='template', executor=user,
+            template_option=option, **data
         )
-        return response
 
     def ci_run(self):
         self.execute(self.project.owner)
@@ -217,9 +222,11 @@ class PeriodicTask(AbstractModel):
                                        related_query_name="periodic_task",
                                        null=True, blank=True)
     template_opt   = models.CharField(max_length=256, null=True, blank=True)
+    overlap_policy = models.CharField(max_length=16, default="allow")
 
     kinds = ["PLAYBOOK", "MODULE", "TEMPLATE"]
     types = ["CRONTAB", "INTERVAL"]
+    overlap_policies = ["allow", "skip", "coalesce"]
     HIDDEN_VARS = [
         'key-file',
         'key_file',
@@ -308,6 +315,7 @@ class HistoryQuerySet(BQuerySet):
 
     def create(self, **kwargs) -> BModel:
         raw_stdout = kwargs.pop("raw_stdout", None)
+        kwargs.setdefault('output_storage', settings.HISTORY_OUTPUT_STORAGE)
         history = super(HistoryQuerySet, self).create(**kwargs)
         if raw_stdout:
             history.raw_stdout = raw_stdout
@@ -347,25 +355,72 @@ class HistoryQuerySet(BQuerySet):
             options['template_option'] = extra_options['template_option']
         return options
 
-    def start(self, project, kind, mod_name, inventory, **extra) -> Tuple[Any, Dict]:
-        extra_options = self.__get_extra_options(extra, project.EXTRA_OPTIONS)
-        if not extra_options['save_result']:
-            return None, extra
-        history_kwargs = dict(
-            mode=mod_name, start_time=timezone.now(),
-            inventory=inventory, project=project,
-            kind=kind, raw_stdout="", execute_args=extra,
+    def __get_priority(self, extra_options) -> int:
+        if extra_options['priority'] is not None:
+            return min(max(int(extra_options['priority']), 0), 9)
+        return settings.EXECUTION_PRIORITIES.get(
+            extra_options['initiator_type'], settings.EXECUTION_DEFAULT_PRIORITY
+        )
+
+    def __get_history_kwargs(self, project, kind, mod_name, extra_options, extra) -> Dict[str, Any]:
+        return dict(
+            mode=mod_name, start_time=timezone.now(), project=project,
+            kind=kind, execute_args=extra,
             initiator=extra_options['initiator'],
             initiator_type=extra_options['initiator_type'],
+            priority=self.__get_priority(extra_options),
             executor=extra_options['executor'], hidden=project.hidden,
             options=self.__get_additional_options(extra_options)
         )
+
+    def start(self, project, kind, mod_name, inventory, **extra) -> Tuple[Any, Dict]:
+        extra_options = self.__get_extra_options(extra, project.EXTRA_OPTIONS)
+        if not extra_options['save_result']:
+            return None, extra
+        history_kwargs = self.__get_history_kwargs(project, kind, mod_name, extra_options, extra)
+        history_kwargs.update(inventory=inventory, raw_stdout="")
         if isinstance(inventory, (six.string_types, six.text_type)):
             history_kwargs['inventory'] = None
         elif isinstance(inventory, int):
             history_kwargs['inventory'] = project.inventories.get(pk=inventory)  # nocv
         return self.create(status="DELAY", **history_kwargs), extra
 
+    def start_many(self, project, kind, mod_name, inventories: List, **extra) -> Tuple[List, Dict]:
+        '''
+        Create histories of the same execution for every inventory
+        with one query, when backend returns ids of inserted rows.
+        Returns histories in order of inventories.
+        '''
+        extra_options = self.__get_extra_options(extra, project.EXTRA_OPTIONS)
+        if not extra_options['save_result']:
+            return [None] * len(inventories), extra
+        ids = {inventory for inventory in inventories if isinstance(inventory, int)}
+        inventory_objects = project.inventories.in_bulk(ids)
+        unknown = ids - set(inventory_objects)
+        if unknown:
+            raise ValidationError(dict(inventories=[
+                'Unknown inventories: {}.'.format(', '.join(map(str, sorted(unknown))))
+            ]))
+        history_kwargs = self.__get_history_kwargs(project, kind, mod_name, extra_options, extra)
+        history_kwargs.update(status="DELAY", output_storage=settings.HISTORY_OUTPUT_STORAGE)
+        histories = [
+            self.model(
+                inventory=inventory if isinstance(inventory, Inventory) else inventory_objects.get(inventory),
+                **history_kwargs
+            )
+            for inventory in inventories
+        ]
+        with transaction.atomic(using=self.db):
+            if connections[self.db].features.can_return_ids_from_bulk_insert:
+                histories = self.bulk_create(histories)
+                HistoryStatistic.objects.register(histories)
+            else:
+                # Backend doesn't return ids of inserted rows (sqlite, MySQL),
+                # so rows are inserted one by one to get own ids.
+                for history in histories:
+                    history.save(force_insert=True, using=self.db)
+        return histories, extra
+
 
 class History(BModel):
     ansi_escape = re.compile(r'\x1b[^m]*m')
@@ -387,13 +442,21 @@ class History(BModel):
     initiator      = models.IntegerField(default=0)
     # Initiator type should be always as in urls for api
     initiator_type = models.CharField(max_length=50, default="project")
+    priority       = models.PositiveSmallIntegerField(default=5)
     executor       = models.ForeignKey(User, blank=True, null=True, default=None,
                                        on_delete=models.SET_NULL)
     json_options   = models.TextField(default="{}")
+    output_storage = models.CharField(max_length=32, default="LINES")
 
+    output_handlers = ModelHandlers("HISTORY_OUTPUT_BACKENDS", "Unknown output storage!")
+    output_channel_prefix = 'history_output_'
+    live_fallback_interval = 5
     working_statuses = ['DELAY', 'RUN']
     stoped_statuses = ['OK', 'ERROR', 'OFFLINE', 'INTERRUPTED']
     statuses = working_statuses + stoped_statuses
+    statistic_fields = ['start_time', 'status', 'project_id', 'executor_id']
+    # Statistic key of history as it was loaded from database or saved.
+    statistic_saved_key = None
 
     def __init__(self, *args, **kwargs):
         execute_args = kwargs.pop('execute_args', None)
@@ -401,6 +464,19 @@ class History(BModel):
         if execute_args:
             self.execute_args = execute_args
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(History, cls).from_db(db, field_names, values)
+        if not instance.get_deferred_fields().intersection(cls.statistic_fields):
+            instance.statistic_saved_key = instance.statistic_key
+        return instance
+
+    @property
+    def statistic_key(self) -> Tuple:
+        start_time = self.start_time
+        date = timezone.localdate(start_time) if timezone.is_aware(start_time) else start_time.date()
+        return date, self.status, self.project_id, self.executor_id
+
     class NoFactsAvailableException(NotApplicable):
         def __init__(self):
             msg = "Facts can be gathered only by setup module."
@@ -414,6 +490,15 @@ class History(BModel):
     def working(self) -> bool:
         return self.status in self.working_statuses
 
+    @property
+    def queue_position(self) -> Optional[int]:
+        '''
+        Position of waiting execution in queue of project executions.
+        '''
+        if self.status != 'DELAY':
+            return None
+        return ExecutionSlots(self).get_position()
+
     def get_hook_data(self, when: str) -> OrderedDict:
         data = OrderedDict()
         data['id'] = self.id
@@ -479,12 +564,7 @@ class History(BModel):
             raise DataNotReady("Execution still in process.")
         if self.kind != 'MODULE' or self.mode != 'setup' or self.status != 'OK':
             raise self.NoFactsAvailableException()
-        data = self.get_raw(
-            original=False,
-            excludes=(
-                Q(line__contains="No config file") | Q(line__contains="as config file"),
-            )
-        )
+        data = self.get_raw(original=False, excludes=("No config file", "as config file"))
         regex = (
             r"^([\S]{1,})\s\|\s([\S]{1,}) \=>"
             r" \{\s([^\r]*?\"[\w]{1,}\"\: .*?\s)\}\s{0,1}"
@@ -494,11 +574,72 @@ class History(BModel):
         result = "{" + result[:-1] + "\n}"
         return json.loads(result)
 
-    def get_raw(self, original=True, filters=(), excludes=()) -> Text:
-        qs = self.raw_history_line.filter(*filters).exclude(*excludes)
-        qs = qs.order_by('line_gnumber', 'line_number')
-        data = "".join(qs.values_list("line", flat=True))
-        return data if original else self.ansi_escape.sub('', data)
+    @property
+    def output(self) -> Any:
+        return self.output_handlers(self.output_storage, self)
+
+    @transaction.atomic
+    def set_output_storage(self, storage: Text) -> NoReturn:
+        if storage == self.output_storage:
+            return
+        old_output, new_output = self.output, self.output_handlers(storage, self)
+        lines = []
+        for line in old_output.iter_lines():
+            lines.append(line)
+            if len(lines) >= new_output.batch_size:
+                new_output.write(lines)
+                lines = []
+        new_output.write(lines)
+        old_output.clear()
+        self.output_storage = storage
+        self.save(update_fields=['output_storage'])
+
+    def __iter_blocks(self, excludes: Iterable[Text], block_size: int) -> Generator:
+        lines = []
+        for line in self.output.iter_raw(excludes):
+            lines.append(line)
+            if len(lines) >= block_size:
+                yield "".join(lines)
+                lines = []
+        if lines:
+            yield "".join(lines)
+
+    def iter_raw(self, original=True, excludes=(), block_size=1000) -> Generator:
+        tail = ""
+        for block in self.__iter_blocks(excludes, block_size):
+            if original:
+                yield block
+                continue
+            block = tail + block
+            # Escape sequence may be continued in next block.
+            escape_start = block.find('\x1b', block.rfind('m') + 1)
+            if escape_start >= 0:
+                block, tail = block[:escape_start], block[escape_start:]
+            else:
+                tail = ""
+            yield self.ansi_escape.sub('', block)
+        if tail:
+            yield tail
+
+    def get_raw(self, original=True, excludes=()) -> Text:
+        return "".join(self.iter_raw(original, excludes))
+
+    def get_raw_size(self, original=True) -> int:
+        '''
+        Size of utf-8 encoded raw output. Output is read only once
+        for each state of output (lines count and last line number).
+        '''
+        output = self.output
+        key = 'history-raw-size-{}-{}-{}-{}-{}'.format(
+            self.id, self.start_time.timestamp() if self.start_time else 0,
+            int(original), output.count(), output.last_gnumber()
+        )
+        cache = PMObject.get_django_cache()
+        size = cache.get(key)
+        if size is None:
+            size = sum(len(block.encode('utf-8')) for block in self.iter_raw(original))
+            cache.set(key, size)
+        return size
 
     @property
     def raw_stdout(self) -> str:
@@ -512,10 +653,10 @@ class History(BModel):
 
     @raw_stdout.deleter
     def raw_stdout(self) -> NoReturn:
-        self.raw_history_line.all().delete()
+        self.output.clear()
 
     def check_output(self, output: str) -> NoReturn:
-        raw_count = self.raw_history_line.all().count()
+        raw_count = self.output.count()
         lines = re.findall(r'.+\n{0,}', output)
         counter = 0
         if raw_count >= len(lines):
@@ -538,10 +679,70 @@ class History(BModel):
         if endl:
             yield self.__create_line(number, nline, endl)
 
+    def make_lines(self, value: str, number: int, endl: Text = "") -> List[BModel]:
+        return list(self.__bulking_lines(value, number, endl))
+
+    def write_lines(self, lines: Iterable[BModel]) -> NoReturn:
+        lines = list(lines)
+        self.output.write(lines)
+        if lines:
+            self.publish_output(gnumber=max(line.line_gnumber for line in lines))
+
+    @property
+    def output_channel(self) -> KVChannel:
+        return KVChannel(self.output_channel_prefix + str(self.id), 3600)
+
+    def publish_output(self, **state) -> NoReturn:
+        # Notify live output readers, that output is changed.
+        with raise_context():
+            self.output_channel.publish(state)
+
+    def __is_working(self) -> bool:
+        return History.objects.filter(pk=self.pk, status__in=self.working_statuses).exists()
+
+    def __get_new_lines(self, after: int, batch_size: int) -> List[BModel]:
+        lines = list(self.output.get_lines(after=after)[:batch_size])
+        if len(lines) == batch_size and lines[0].line_gnumber != lines[-1].line_gnumber:
+            # Do not split parts of one line between batches.
+            last_gnumber = lines[-1].line_gnumber
+            lines = [line for line in lines if line.line_gnumber != last_gnumber]
+        return lines
+
+    def follow_output(self, after: int = 0, batch_size: int = 500, check_interval: float = None,
+                      timeout: int = None) -> Generator:
+        '''
+        Yields lists of new output lines while execution is working.
+        Database is requested only when output channel is changed
+        or channel is silent longer than `live_fallback_interval`.
+        Empty list is yielded on every check without new lines.
+        Output is read once more after finish, if worker has not
+        published `finished` state yet.
+        '''
+        check_interval = check_interval or settings.HISTORY_LIVE_CHECK_INTERVAL
+        timeout = settings.HISTORY_LIVE_TIMEOUT if timeout is None else timeout
+        channel, state, last_check = self.output_channel, None, 0
+        started, stopped = time.time(), False
+        while True:
+            new_state = channel.last()
+            if new_state != state or time.time() - last_check >= self.live_fallback_interval:
+                state, last_check = new_state, time.time()
+                working = self.__is_working()
+                lines = self.__get_new_lines(after, batch_size)
+                while lines:
+                    after = lines[-1].line_gnumber
+                    yield lines
+                    lines = self.__get_new_lines(after, batch_size)
+                if not working:
+                    if stopped or (state or {}).get('finished'):
+                        return
+                    stopped = True
+            if time.time() - started >= timeout:
+                return
+            yield []
+            time.sleep(check_interval)
+
     def write_line(self, value: str, number: int, endl: Text = "") -> NoReturn:
-        self.raw_history_line.bulk_create(
-            map(lambda l: l, self.__bulking_lines(value, number, endl))
-        )
+        self.write_lines(self.make_lines(value, number, endl))
 
 
 class HistoryLines(BModel):
@@ -554,3 +755,103 @@ class HistoryLines(BModel):
     class Meta:
         default_related_name = "raw_history_line"
         ordering = ['-line_gnumber', '-line_number']
+
+
+class HistoryChunk(BModel):
+    history       = models.ForeignKey(History, on_delete=models.CASCADE,
+                                      related_query_name="output_chunks")
+    first_gnumber = models.IntegerField(default=0)
+    last_gnumber  = models.IntegerField(default=0)
+    lines_count   = models.IntegerField(default=0)
+    data          = models.BinaryField()
+
+    class Meta:
+        default_related_name = "output_chunks"
+        index_together = [["history", "first_gnumber"]]
+
+
+class HistoryStatisticQuerySet(BQuerySet):
+    use_for_related_fields = True
+    truncs = dict(day=F, month=dbfunc.TruncMonth, year=dbfunc.TruncYear)
+
+    def change(self, key: Tuple, delta: int) -> NoReturn:
+        '''
+        Add `delta` to one row of `key`. Row is created if it is not exists.
+        '''
+        date, status, project_id, executor_id = key
+        fields = dict(date=date, status=status, project_id=project_id, executor_id=executor_id)
+        while True:
+            row_id = self.filter(**fields).order_by('id').values_list('id', flat=True).first()
+            if row_id is not None:
+                self.filter(id=row_id).update(count=F('count') + delta)
+                return
+            if delta <= 0:
+                return
+            try:
+                with transaction.atomic():
+                    self.create(count=delta, **fields)
+                return
+            except IntegrityError:  # nocv
+                # Row was created by concurrent transaction.
+                continue
+
+    def clear_executor(self, executor_id: int) -> NoReturn:
+        '''
+        Move counts of executor to rows without executor (before user is removed).
+        '''
+        rows = self.filter(executor_id=executor_id)
+        for date, status, project_id, count in rows.values_list('date', 'status', 'project_id', 'count'):
+            self.change((date, status, project_id, None), count)
+        rows.delete()
+
+    def register(self, histories: Iterable) -> NoReturn:
+        '''
+        Count new histories created without signals (e.g. by `bulk_create`).
+        '''
+        counter = Counter()
+        for history in histories:
+            history.statistic_saved_key = history.statistic_key
+            counter[history.statistic_key] += 1
+        for key, count in counter.items():
+            self.change(key, count)
+
+    def _get_stats_by(self, qs, grouped_by='day') -> List:
+        values, sum_by_date = [], Counter()
+        qs = qs.annotate(**{grouped_by: self.truncs[grouped_by]('date')})
+        qs = qs.values(grouped_by, 'status').annotate(sum=Sum('count')).filter(sum__gt=0)
+        for hist_stat in qs.order_by(grouped_by, 'status'):
+            hist_stat[grouped_by] = timezone.make_aware(
+                datetime.combine(hist_stat[grouped_by], datetime.min.time())
+            )
+            sum_by_date[hist_stat[grouped_by]] += hist_stat['sum']
+            values.append(hist_stat)
+        for hist_stat in values:
+            hist_stat['all'] = sum_by_date[hist_stat[grouped_by]]
+        return values
+
+    def stats(self, last: int) -> OrderedDict:
+        qs = self.filter(date__gte=timezone.localdate() - timedelta(days=last))
+        result = OrderedDict()
+        result['day'] = self._get_stats_by(qs, 'day')
+        result['month'] = self._get_stats_by(qs, 'month')
+        result['year'] = self._get_stats_by(qs, 'year')
+        return result
+
+
+class HistoryStatistic(BModel):
+    '''
+    Daily counts of histories by status, project and executor.
+    It is updated on every change of history status.
+    '''
+    objects  = HistoryStatisticQuerySet.as_manager()
+    date     = models.DateField(db_index=True)
+    status   = models.CharField(max_length=50)
+    project  = models.ForeignKey(Project, on_delete=models.CASCADE,
+                                 related_query_name="history_statistic", null=True)
+    executor = models.ForeignKey(User, blank=True, null=True, default=None,
+                                 on_delete=models.SET_NULL)
+    count    = models.IntegerField(default=0)
+
+    class Meta:
+        default_related_name = "history_statistic"
+        unique_together = ('date', 'status', 'project', 'executor')
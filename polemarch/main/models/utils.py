@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
-from typing import NoReturn, Text, Any, Iterable, Tuple, List, Dict, Union
+from typing import NoReturn, Text, Any, Iterable, Iterator, Tuple, List, Dict, Union
 import os
 import re
 import time
@@ -8,17 +8,21 @@ import signal
 import shutil
 import logging
 import tempfile
+import threading
 import traceback
+from queue import Queue, Empty
 from pathlib import Path
 from collections import namedtuple, OrderedDict
 from subprocess import Popen
 from functools import reduce
+from django.conf import settings
 from django.utils import timezone
-from vstutils.utils import tmp_file, KVExchanger, raise_context
+from vstutils.utils import tmp_file, raise_context
 from vstutils.tools import get_file_value
 from .hosts import Inventory
 from .tasks import History, Project
-from ...main.utils import CmdExecutor, AnsibleArgumentsReference, PMObject
+from ...main.utils import CmdExecutor, AnsibleArgumentsReference, PMObject, KVChannel
+from ...main.workspace import prepare_workspace, prepare_git_workspace, get_workspace_pool
 
 
 logger = logging.getLogger("polemarch")
@@ -58,18 +62,78 @@ class DummyHistory:
         # pylint: disable=unused-argument
         logger.info(value)
 
+    def make_lines(self, value: Text, number: int, endl: Text = '') -> List:
+        self.write_line(value, number, endl)
+        return []
+
+    def write_lines(self, lines: Iterable) -> NoReturn:
+        pass
+
+    def publish_output(self, **state) -> NoReturn:
+        pass
+
     def save(self) -> None:
         pass
 
 
+class HistoryLinesWriter:
+    '''
+    Collects output lines of history and writes them by batches
+    when buffer is full or flush interval is expired.
+    '''
+    __slots__ = 'history', 'bulk_size', 'flush_interval', 'buffer', 'last_flush', 'lock'
+
+    def __init__(self, history: History, bulk_size: int = None, flush_interval: float = None):
+        self.history = history
+        self.bulk_size = bulk_size or settings.HISTORY_LINES_BULK_SIZE
+        self.flush_interval = flush_interval
+        if self.flush_interval is None:
+            self.flush_interval = settings.HISTORY_LINES_FLUSH_INTERVAL
+        self.buffer = []
+        self.last_flush = time.time()
+        self.lock = threading.RLock()
+
+    @property
+    def expired(self) -> bool:
+        return time.time() - self.last_flush >= self.flush_interval
+
+    @property
+    def full(self) -> bool:
+        return len(self.buffer) >= self.bulk_size
+
+    def write_line(self, value: Text, number: int, endl: Text = '', flush: bool = True) -> NoReturn:
+        with self.lock:
+            self.buffer += self.history.make_lines(value, number, endl)
+            if flush and (self.full or self.expired):
+                self.flush()
+
+    def flush(self) -> NoReturn:
+        with self.lock:
+            lines, self.buffer = self.buffer, []
+            self.last_flush = time.time()
+            if lines:
+                self.history.write_lines(lines)
+
+
 class Executor(CmdExecutor):
-    __slots__ = 'history', 'counter', 'exchanger'
+    '''
+    Command executor which reads output in separate thread and writes it
+    to history by batches. Calling thread is a watchdog: it checks
+    cancel message with fixed interval, flushes expired batches and
+    escalates signals on cancel, while output is still collected.
+    '''
+    __slots__ = 'history', 'counter', 'exchanger', 'writer', 'check_interval', 'signal_timeout'
+    # Signals to interrupt execution, every next is sent after `signal_timeout`.
+    cancel_signals = (signal.SIGINT, signal.SIGTERM, signal.SIGKILL)
 
     def __init__(self, history: History):
         super(Executor, self).__init__()
         self.history = history
         self.counter = 0
-        self.exchanger = KVExchanger(self.CANCEL_PREFIX + str(self.history.id))
+        self.writer = HistoryLinesWriter(history)
+        self.exchanger = KVChannel(self.CANCEL_PREFIX + str(self.history.id))
+        self.check_interval = settings.HISTORY_CANCEL_CHECK_INTERVAL
+        self.signal_timeout = settings.HISTORY_CANCEL_SIGNAL_TIMEOUT
         env_vars = {}
         if self.history.project is not None:
             env_vars = self.history.project.env_vars
@@ -84,25 +148,71 @@ class Executor(CmdExecutor):
     def output(self, value) -> NoReturn:
         pass  # nocv
 
-    def working_handler(self, proc: Popen):
-        if proc.poll() is None and self.exchanger.get() is not None:  # nocv
-            self.write_output("\n[ERROR]: User interrupted execution")
-            self.exchanger.delete()
-            for _ in range(5):
-                try:
-                    os.kill(-proc.pid, signal.SIGTERM)
-                except Exception:  # nocv
-                    break
-                proc.send_signal(signal.SIGINT)
-                time.sleep(5)
-            proc.terminate()
-            proc.kill()
-            proc.wait()
-        super(Executor, self).working_handler(proc)
+    def is_cancelled(self) -> bool:
+        return self.exchanger.pop() is not None
+
+    def send_signal(self, proc: Popen, sig: int) -> NoReturn:
+        try:
+            os.killpg(proc.pid, sig)
+        except OSError:
+            with raise_context():
+                proc.send_signal(sig)
 
-    def write_output(self, line: Text):
-        self.counter += 1
-        self.history.write_line(line, self.counter, '\n')
+    def line_handler(self, line: Text) -> NoReturn:
+        # Lines are written to database by batches, flushed by watchdog.
+        with raise_context():
+            self.write_output(line, flush=False)
+
+    def read_output(self, stream, lines: Queue) -> NoReturn:
+        try:
+            for line in iter(stream.readline, ""):
+                lines.put(line.rstrip())
+        finally:
+            stream.close()
+            lines.put(None)
+
+    def _unbuffered(self, proc: Popen, stream: Text = 'stdout') -> Iterator[Text]:
+        '''
+        Lines read by separate thread. Between lines and when process
+        writes nothing, calling thread flushes expired batches and checks
+        cancel message.
+        '''
+        lines = Queue()  # type: Queue
+        reader = threading.Thread(target=self.read_output, args=(getattr(proc, stream), lines), daemon=True)
+        reader.start()
+        interval = min(self.check_interval, self.writer.flush_interval) or self.check_interval
+        signals, next_check, next_signal = None, 0, 0
+        while True:
+            try:
+                line = lines.get(timeout=interval)
+            except Empty:
+                pass
+            else:
+                if line is None:
+                    break
+                yield line
+            now = time.time()
+            if self.writer.full or self.writer.expired:
+                self.flush_output()
+            if proc.poll() is not None:
+                continue
+            if signals is None and now >= next_check:
+                next_check = now + self.check_interval
+                if self.is_cancelled():
+                    self.write_output("\n[ERROR]: User interrupted execution", flush=False)
+                    signals = list(self.cancel_signals)
+            if signals and now >= next_signal:
+                self.send_signal(proc, signals.pop(0))
+                next_signal = now + self.signal_timeout
+        proc.wait()
+
+    def write_output(self, line: Text, flush: bool = True):
+        with self.writer.lock:
+            self.counter += 1
+            self.writer.write_line(line, self.counter, '\n', flush=flush)
+
+    def flush_output(self) -> NoReturn:
+        self.writer.flush()
 
     def execute(self, cmd: Iterable[Text], cwd: Text):
         pm_ansible_path = ' '.join(self.pm_ansible())
@@ -113,7 +223,10 @@ class Executor(CmdExecutor):
                     one_cmd = one_cmd.decode('utf-8')
             new_cmd.append(one_cmd)
         self.history.raw_args = " ".join(new_cmd).replace(pm_ansible_path, '').lstrip()
-        return super(Executor, self).execute(new_cmd, cwd)
+        try:
+            return super(Executor, self).execute(new_cmd, cwd)
+        finally:
+            self.flush_output()
 
 
 class AnsibleCommand(PMObject):
@@ -126,6 +239,7 @@ class AnsibleCommand(PMObject):
 
     status_codes = {
         4: "OFFLINE",
+        -2: "INTERRUPTED",
         -9: "INTERRUPTED",
         -15: "INTERRUPTED",
         "other": "ERROR"
@@ -193,7 +307,7 @@ class AnsibleCommand(PMObject):
         self.kwargs = kwargs
         self.__will_raise_exception = False
         self.ref_type = self.ref_types[self.command_type]
-        self.ansible_ref = self.ansible_ref_class().raw_dict[self.ref_type]
+        self.ansible_ref = dict(self.ansible_ref_class().raw_dict[self.ref_type])
         self.verbose = kwargs.get('verbose', 0)
         self.cwd = tempfile.mkdtemp()
         self._verbose_output('Execution tmpdir created - [{}].'.format(self.cwd), 0)
@@ -205,6 +319,10 @@ class AnsibleCommand(PMObject):
                 self.executor.write_output(value)
             logger.debug(value)
 
+    def _flush_output(self) -> NoReturn:
+        if hasattr(self, 'executor'):
+            self.executor.flush_output()
+
     def _get_tmp_name(self) -> Text:
         return os.path.join(self.cwd, 'project_sources')
 
@@ -339,30 +457,29 @@ class AnsibleCommand(PMObject):
             )
 
     def dir_prepare_git(self, src: Text, work_dir: Text, revision: Text):
-        # pylint: disable=no-member
-        import git
-        repo = git.Repo.clone_from(
-            url=src + "/.git",
-            to_path=work_dir,
-            **self.project.repo_handlers.opts(self.project.type).get('PREP_KWARGS', {})
-        )
-        repo.git.checkout(revision or self.project.branch)
-        for sm in repo.submodules:
-            # Calling git directly for own submodules
-            # since using relative path is not working in gitpython
-            # see https://github.com/gitpython-developers/GitPython/issues/730
-            with raise_context():
-                if sm.url[0:3] == '../':
-                    repo_parent_url, _ = os.path.split(repo.remotes.origin.url)
-                    actual_url = os.path.join(repo_parent_url, sm.name)
-                    with sm.config_writer() as writer:
-                        writer.set('url', actual_url)
-                sm.update(init=True)
+        revision = revision or self.project.branch
+        kwargs = self.project.repo_handlers.opts(self.project.type).get('PREP_KWARGS', {})
+        pool = get_workspace_pool()
+        if pool is not None and pool.is_cacheable(revision):
+            start = time.time()
+            self.pool_entry = pool.get(
+                self.project.id, revision,
+                lambda path: prepare_git_workspace(src, path, revision, 'REFERENCE', **kwargs)
+            )
+            self._verbose_output('Workspace pool {} for revision {} ({:.3f}s).'.format(
+                'hit' if self.pool_entry.hit else 'miss', revision, time.time() - start
+            ), 2)
+            self.workspace = prepare_workspace(self.pool_entry.path, work_dir, pooled=True)
+            self._verbose_output('Workspace strategy - {}.'.format(self.workspace), 2)
+            return
+        self.workspace = prepare_git_workspace(src, work_dir, revision, **kwargs)
+        self._verbose_output('Workspace strategy - {}.'.format(self.workspace), 2)
 
     def dir_prepare_copy(self, src: Text, work_dir: Text, revision: Text):
         # pylint: disable=unused-argument
         if os.path.exists(src):
-            shutil.copytree(src=src, dst=work_dir)
+            self.workspace = prepare_workspace(src, work_dir)
+            self._verbose_output('Workspace strategy - {}.'.format(self.workspace), 2)
         else:  # nocv
             raise Exception('Project dir {} is not exist.'.format(src))
 
@@ -380,10 +497,12 @@ class AnsibleCommand(PMObject):
         elif isinstance(exception, self.project.SyncError):
             self.__will_raise_exception = True
 
-        last_line_object = self.history.raw_history_line.last()
-        last_line = 0
-        if last_line_object:
-            last_line = last_line_object.line_number  # nocv
+        if hasattr(self, 'executor'):
+            # Error is written after buffered output and flushed with it.
+            for line in error_text.split('\n'):
+                self.executor.write_output(line, flush=False)
+            return
+        last_line = self.history.output.last_gnumber() if self.history.id else 0
         for line in error_text.split('\n'):
             last_line += 1
             self.history.write_line(line, last_line)
@@ -405,10 +524,13 @@ class AnsibleCommand(PMObject):
             inventory_object = getattr(self, "inventory_object", None)
             if inventory_object is not None:
                 inventory_object.close()
+            self.__del__()
+            # Live output readers stop after finish, so output should be written before.
+            self._flush_output()
             self.history.stop_time = timezone.now()
             self.history.save()
             self._send_hook('after_execution')
-            self.__del__()
+            self.history.publish_output(finished=True)
 
     def run(self):
         try:
@@ -418,6 +540,13 @@ class AnsibleCommand(PMObject):
             raise
 
     def __del__(self):
+        workspace = getattr(self, 'workspace', None)
+        if workspace is not None:
+            with raise_context():
+                workspace.cleanup(self._get_tmp_name())
+        pool_entry = getattr(self, 'pool_entry', None)
+        if pool_entry is not None:
+            pool_entry.release()
         if hasattr(self, 'cwd') and os.path.exists(self.cwd):
             self._verbose_output('Tmpdir "{}" was cleared.'.format(self.cwd))
             shutil.rmtree(self.cwd, ignore_errors=True)
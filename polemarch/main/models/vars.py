@@ -7,6 +7,7 @@ import uuid
 from functools import reduce
 from collections import OrderedDict
 from django.db import transaction
+from django.dispatch import Signal
 from django.db.models import Case, When, Value
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
@@ -16,6 +17,10 @@ from .base import ACLModel, BQuerySet, BModel, models
 
 logger = logging.getLogger("polemarch")
 
+# Signals of bulk variables update by `set_vars()`.
+pre_set_vars = Signal(providing_args=["instance", "variables", "keys"])
+post_set_vars = Signal(providing_args=["instance", "variables"])
+
 
 def update_boolean(items: Dict[str, Any], item: Any):
     value = items.get(item, None)
@@ -129,12 +134,46 @@ class AbstractModel(ACLModel):
 
     @transaction.atomic()
     def set_vars(self, variables) -> NoReturn:
+        '''
+        Replace all variables by new ones. Only changed variables are written
+        and they are validated by `pre_set_vars` receivers in one pass,
+        because bulk operations don't send signals of each `Variable`.
+        '''
         encr = "[~~ENCRYPTED~~]"
         encrypted_vars = {k: v for k, v in variables.items() if v == encr}
-        other_vars = {k: v for k, v in variables.items() if v != encr}
-        self.variables.exclude(key__in=encrypted_vars.keys()).delete()
+        other_vars = OrderedDict(
+            (k, v if v is None else str(v)) for k, v in variables.items() if v != encr
+        )
+        existing, to_delete = dict(), list()
+        for variable in self.variables.all().order_by('-id'):
+            if variable.key in existing or variable.key not in variables:
+                to_delete.append(variable.id)
+            else:
+                existing[variable.key] = variable
+        kept_keys = set(existing.keys()) & set(encrypted_vars.keys())
+        pre_set_vars.send(
+            sender=self.__class__, instance=self,
+            variables=other_vars, keys=kept_keys | set(other_vars.keys())
+        )
+        content_type = ContentType.objects.get_for_model(self)
+        to_create, to_update = list(), list()
         for key, value in other_vars.items():
-            self.variables.create(key=key, value=value)
+            variable = existing.get(key, None)
+            if variable is None:
+                to_create.append(Variable(
+                    content_type=content_type, object_id=self.id, key=key, value=value
+                ))
+            elif variable.value != value:
+                variable.value = value
+                to_update.append(variable)
+        if not (to_create or to_update or to_delete):
+            return
+        # Raw delete, because signals of every variable are replaced by `post_set_vars`.
+        deleted = Variable.objects.filter(id__in=to_delete)
+        deleted._raw_delete(deleted.db)
+        Variable.objects.bulk_update(to_update, ['value'])
+        Variable.objects.bulk_create(to_create)
+        post_set_vars.send(sender=self.__class__, instance=self, variables=other_vars)
 
     def get_vars(self) -> [OrderedDict, Dict]:
         qs = self.variables.all().sort_by_key().values_list('key', 'value')
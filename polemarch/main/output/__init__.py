@@ -0,0 +1,2 @@
+from .lines import Lines
+from .chunks import Chunks
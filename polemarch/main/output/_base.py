@@ -0,0 +1,44 @@
+# pylint: disable=unused-argument
+from __future__ import unicode_literals
+from typing import Text, Iterable, Iterator, Sequence, NoReturn
+
+
+class _Base:
+    '''
+    Base class for execution output storage backends.
+    Every backend works with `HistoryLines` objects.
+    '''
+    __slots__ = 'history', 'options'
+    # Is `get_lines` returns queryset with all filters support.
+    is_queryset = False
+
+    def __init__(self, history, **options):
+        self.history = history
+        self.options = options
+
+    @property
+    def batch_size(self) -> int:
+        return 1000
+
+    def write(self, lines: Iterable) -> NoReturn:  # nocv
+        raise NotImplementedError()
+
+    def iter_lines(self, after: int = None, before: int = None, reverse: bool = False) -> Iterator:  # nocv
+        raise NotImplementedError()
+
+    def get_lines(self, after: int = None, before: int = None, reverse: bool = False) -> Sequence:  # nocv
+        raise NotImplementedError()
+
+    def count(self) -> int:  # nocv
+        raise NotImplementedError()
+
+    def last_gnumber(self) -> int:  # nocv
+        raise NotImplementedError()
+
+    def clear(self) -> NoReturn:  # nocv
+        raise NotImplementedError()
+
+    def iter_raw(self, excludes: Iterable[Text] = ()) -> Iterator[Text]:
+        for line in self.iter_lines():
+            if not any(value in line.line for value in excludes):
+                yield line.line
@@ -0,0 +1,176 @@
+from __future__ import unicode_literals
+from typing import Iterable, Iterator, List, Tuple, NoReturn
+import json
+import zlib
+from django.db.models import Max, Sum
+from ._base import _Base
+
+ChunkInfo = Tuple[int, int, int, int]
+
+
+class ChunkedLines:
+    '''
+    Lazy sequence of lines from compressed chunks.
+    Supports `len()` and slicing for pagination, so only chunks
+    needed by requested page are decompressed.
+    '''
+    __slots__ = 'storage', 'after', 'before', 'reverse', 'chunks', '_cache'
+
+    def __init__(self, storage: 'Chunks', after: int = None, before: int = None, reverse: bool = False):
+        self.storage = storage
+        self.after, self.before, self.reverse = after, before, reverse
+        self.chunks = list(
+            storage.filter_chunks(after, before, reverse).values_list(
+                'id', 'first_gnumber', 'last_gnumber', 'lines_count'
+            )
+        )  # type: List[ChunkInfo]
+        self._cache = dict()
+
+    def _is_full(self, chunk: ChunkInfo) -> bool:
+        _, first, last, _ = chunk
+        return (
+            (self.after is None or first > self.after) and
+            (self.before is None or last < self.before)
+        )
+
+    def _get_chunk_lines(self, chunk: ChunkInfo) -> List:
+        if chunk[0] not in self._cache:
+            self._cache[chunk[0]] = self.storage.filter_lines(
+                self.storage.unpack(self.storage.chunks.get(pk=chunk[0])),
+                self.after, self.before, self.reverse
+            )
+        return self._cache[chunk[0]]
+
+    def _count(self, chunk: ChunkInfo) -> int:
+        if self._is_full(chunk):
+            return chunk[3]
+        return len(self._get_chunk_lines(chunk))
+
+    def __len__(self) -> int:
+        return sum(map(self._count, self.chunks))
+
+    def __iter__(self) -> Iterator:
+        for chunk in self.chunks:
+            for line in self._get_chunk_lines(chunk):
+                yield line
+            self._cache.pop(chunk[0], None)
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0] if index >= 0 else list(self)[index]
+        start, stop, _ = index.indices(len(self))
+        result, position = [], 0
+        for chunk in self.chunks:
+            if position >= stop:
+                break
+            count = self._count(chunk)
+            if position + count > start:
+                lines = self._get_chunk_lines(chunk)
+                result += lines[max(start - position, 0):stop - position]
+            position += count
+        return result
+
+
+class Chunks(_Base):
+    '''
+    Storage which keeps output lines in zlib-compressed chunks
+    with range of global line numbers for every chunk.
+    Lines of not full (open) chunks are kept uncompressed and new lines
+    are written as new open chunk, until open lines fill whole chunk.
+    '''
+    __slots__ = ()
+    # Open chunks are joined to one when there are more of them.
+    max_open_chunks = 16
+
+    @property
+    def chunk_size(self) -> int:
+        return self.options.get('chunk_size', 1000)
+
+    @property
+    def compress_level(self) -> int:
+        return self.options.get('compress_level', 6)
+
+    @property
+    def batch_size(self) -> int:
+        return self.chunk_size
+
+    @property
+    def chunks(self):
+        return self.history.output_chunks.all()
+
+    def pack(self, lines: Iterable, compress: bool = True) -> bytes:
+        data = json.dumps([(line.line_gnumber, line.line_number, line.line) for line in lines]).encode('utf-8')
+        return zlib.compress(data, self.compress_level) if compress else data
+
+    def unpack(self, chunk) -> List:
+        line_class = self.history.raw_history_line.model
+        data = bytes(chunk.data)
+        if not data.startswith(b'['):
+            data = zlib.decompress(data)
+        data = json.loads(data.decode('utf-8'))
+        return [
+            line_class(
+                history_id=self.history.id, line_gnumber=gnumber, line_number=number, line=line
+            )
+            for gnumber, number, line in data
+        ]
+
+    def _make_chunk(self, lines: List, compress: bool = True):
+        gnumbers = [line.line_gnumber for line in lines]
+        return self.chunks.model(
+            history=self.history, first_gnumber=min(gnumbers), last_gnumber=max(gnumbers),
+            lines_count=len(lines), data=self.pack(lines, compress)
+        )
+
+    def write(self, lines: Iterable) -> NoReturn:
+        lines = list(lines)
+        if not lines:
+            return
+        open_chunks = self.chunks.filter(lines_count__lt=self.chunk_size)
+        counts = list(open_chunks.values_list('lines_count', flat=True))
+        if sum(counts) + len(lines) < self.chunk_size and len(counts) < self.max_open_chunks:
+            self.history.output_chunks.bulk_create([self._make_chunk(lines, compress=False)])
+            return
+        lines = [line for chunk in open_chunks.order_by('id') for line in self.unpack(chunk)] + lines
+        open_chunks.delete()
+        full = len(lines) - len(lines) % self.chunk_size
+        chunks = [self._make_chunk(lines[i:i + self.chunk_size]) for i in range(0, full, self.chunk_size)]
+        if full < len(lines):
+            chunks.append(self._make_chunk(lines[full:], compress=False))
+        self.history.output_chunks.bulk_create(chunks)
+
+    def filter_chunks(self, after: int = None, before: int = None, reverse: bool = False):
+        qs = self.chunks
+        if after is not None:
+            qs = qs.filter(last_gnumber__gt=after)
+        if before is not None:
+            qs = qs.filter(first_gnumber__lt=before)
+        if reverse:
+            return qs.order_by('-first_gnumber', '-id')
+        return qs.order_by('first_gnumber', 'id')
+
+    def filter_lines(self, lines: List, after: int = None, before: int = None, reverse: bool = False) -> List:
+        lines = [
+            line for line in lines
+            if (after is None or line.line_gnumber > after) and
+            (before is None or line.line_gnumber < before)
+        ]
+        lines.sort(key=lambda line: (line.line_gnumber, line.line_number))
+        if reverse:
+            lines.reverse()
+        return lines
+
+    def get_lines(self, after: int = None, before: int = None, reverse: bool = False) -> ChunkedLines:
+        return ChunkedLines(self, after, before, reverse)
+
+    def iter_lines(self, after: int = None, before: int = None, reverse: bool = False) -> Iterator:
+        return iter(self.get_lines(after, before, reverse))
+
+    def count(self) -> int:
+        return self.chunks.aggregate(count=Sum('lines_count'))['count'] or 0
+
+    def last_gnumber(self) -> int:
+        return self.chunks.aggregate(last=Max('last_gnumber'))['last'] or 0
+
+    def clear(self) -> NoReturn:
+        self.chunks.delete()
@@ -0,0 +1,47 @@
+from __future__ import unicode_literals
+from typing import Text, Iterable, Iterator, NoReturn
+from django.db.models import Max
+from ._base import _Base
+
+
+class Lines(_Base):
+    '''
+    Legacy storage. Every output line stored as `HistoryLines` row.
+    '''
+    __slots__ = ()
+    is_queryset = True
+
+    @property
+    def lines(self):
+        return self.history.raw_history_line.all()
+
+    def write(self, lines: Iterable) -> NoReturn:
+        self.history.raw_history_line.bulk_create(lines)
+
+    def get_lines(self, after: int = None, before: int = None, reverse: bool = False):
+        qs = self.lines
+        if after is not None:
+            qs = qs.filter(line_gnumber__gt=after)
+        if before is not None:
+            qs = qs.filter(line_gnumber__lt=before)
+        if reverse:
+            return qs.order_by('-line_gnumber', '-line_number')
+        return qs.order_by('line_gnumber', 'line_number')
+
+    def iter_lines(self, after: int = None, before: int = None, reverse: bool = False) -> Iterator:
+        return self.get_lines(after, before, reverse).iterator(chunk_size=self.batch_size)
+
+    def count(self) -> int:
+        return self.lines.count()
+
+    def last_gnumber(self) -> int:
+        return self.lines.aggregate(last=Max('line_gnumber'))['last'] or 0
+
+    def clear(self) -> NoReturn:
+        self.lines.delete()
+
+    def iter_raw(self, excludes: Iterable[Text] = ()) -> Iterator[Text]:
+        qs = self.get_lines()
+        for value in excludes:
+            qs = qs.exclude(line__contains=value)
+        return qs.values_list("line", flat=True).iterator(chunk_size=self.batch_size)
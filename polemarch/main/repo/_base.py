@@ -3,15 +3,18 @@ from __future__ import unicode_literals
 from typing import Any, Text, Dict, List, Tuple, Union, Iterable, Callable, TypeVar, NoReturn
 import os
 import shutil
+import hashlib
 import pathlib
 import logging
 import traceback
+from functools import partial
 
+from collections import OrderedDict
 from six.moves.urllib.request import urlretrieve
 from django.db import transaction
 from django.conf import settings
 from vstutils.utils import raise_context, import_class
-from ..utils import AnsibleModules
+from ..utils import AnsibleModules, AnsibleArgumentsReference
 from ..models.projects import Project
 from ..models.tasks import Template
 
@@ -128,23 +131,70 @@ class _Base:
             feature_name = 'pm_handle_{}'.format(feature)
             getattr(self, feature_name, self.pm_handle_unknown)(feature, data)
 
+    def _get_fingerprint(self, repo: Any, path: Text) -> Text:
+        '''
+        Fingerprint of file or directory in project: hash of manifest
+        with relative paths, sizes and modification times of files.
+        '''
+        # pylint: disable=unused-argument
+        digest = hashlib.sha1()
+        files = [path] if os.path.isfile(path) else (
+            os.path.join(root, name) for root, _, names in sorted(os.walk(path)) for name in sorted(names)
+        )
+        for file_path in files:
+            with raise_context():
+                stat = os.stat(file_path)
+                digest.update('{}:{}:{}\n'.format(
+                    os.path.relpath(file_path, path), stat.st_size, stat.st_mtime_ns
+                ).encode('utf-8'))
+        return digest.hexdigest()
+
+    def _get_files_fingerprint(self, repo: Any) -> Text:
+        '''
+        Fingerprint of list of files in project root, where playbooks are
+        searched. Directory modification time is changed when its entries
+        are added, removed or renamed.
+        '''
+        # pylint: disable=unused-argument
+        stat = os.stat(self.path)
+        return '{}:{}'.format(stat.st_ino, stat.st_mtime_ns)
+
+    def _get_sync_state(self) -> Dict[Text, Any]:
+        return self.proj.get_yaml_subcache('sync').get() or dict()
+
+    def _set_sync_state(self, state: Dict[Text, Any]) -> NoReturn:
+        self.proj.get_yaml_subcache('sync').set(state)
+
+    def _update_objects(self, queryset, field: Text, values: List[Text], create: Callable) -> NoReturn:
+        '''
+        Make rows of queryset have only `values` of `field`:
+        missing values are created by `create(value)`, others are removed.
+        '''
+        existing, to_delete, required = set(), list(), set(values)
+        for object_id, value in queryset.values_list('id', field).order_by('id'):
+            if value in required and value not in existing:
+                existing.add(value)
+            else:
+                to_delete.append(object_id)
+        if to_delete:
+            queryset.filter(id__in=to_delete).delete()
+        to_create = [create(value) for value in values if value not in existing]
+        if to_create:
+            queryset.model.objects.bulk_create(to_create)
+
     def _set_tasks_list(self, playbooks_names: Iterable[pathlib.Path]) -> NoReturn:
         """
-        Updates playbooks in project.
+        Updates playbooks in project. Only added and removed playbooks are written.
         """
         # pylint: disable=invalid-name
         project = self.proj
-        project.playbook.all().delete()
         PlaybookModel = self.proj.playbook.model
         hidden = project.hidden
         split = str.split
-        playbook_objects = (
-            PlaybookModel(
-                name=split(str(p), ".yml")[0], playbook=p,
-                hidden=hidden, project=project
-            ) for p in playbooks_names
-        )
-        PlaybookModel.objects.bulk_create(playbook_objects) if playbook_objects else None
+        playbooks = list(OrderedDict.fromkeys(map(str, playbooks_names)))
+        self._update_objects(project.playbook.all(), 'playbook', playbooks, lambda p: PlaybookModel(
+            name=split(p, ".yml")[0], playbook=p, hidden=hidden, project=project
+        ))
 
     def __get_project_modules(self, module_path: Iterable[Text]) -> List[Union[Text, Dict]]:
         valid_paths = tuple(filter(self._dir_exists, module_path))
@@ -157,21 +207,34 @@ class _Base:
         return modules_list
 
     @raise_context()
-    def _set_project_modules(self) -> None:
+    def _set_project_modules(self, repo: Any = None, state: Dict = None) -> None:
         '''
-        Update project modules
+        Update project modules. Modules are not rescanned when ansible version,
+        `ansible.cfg` and modules dirs have the same fingerprints as in sync `state`.
         '''
         # pylint: disable=invalid-name
         project = self.proj
+        state = state if state is not None else dict()
+        config = '{}:{}'.format(
+            AnsibleArgumentsReference().version, self._get_fingerprint(repo, os.path.join(self.path, 'ansible.cfg'))
+        )
+        if 'module_paths' in state and state.get('config') == config:
+            fingerprints = [self._get_fingerprint(repo, path) for path in state['module_paths']]
+            if fingerprints == state.get('modules'):
+                self.message('Modules are not changed.')
+                return
         project.get_ansible_config_parser().clear_cache()
-        project.modules.all().delete()
         ModuleClass = self.proj.modules.model
         paths = project.config.get('DEFAULT_MODULE_PATH', [])
-        paths = filter(lambda mp: project.path in mp, paths)
+        paths = [mp for mp in paths if project.path in mp]
         modules = self.__get_project_modules(paths)
-        ModuleClass.objects.bulk_create([
-            ModuleClass(path=path, project=project) for path in modules
-        ])
+        self._update_objects(project.modules.all(), 'path', modules, lambda path: ModuleClass(
+            path=path, project=project
+        ))
+        state.update(
+            config=config, module_paths=paths,
+            modules=[self._get_fingerprint(repo, path) for path in paths],
+        )
 
     def _update_tasks(self, files: Iterable[pathlib.Path]) -> NoReturn:
         '''
@@ -182,6 +245,18 @@ class _Base:
         # playbooks = filter(reg.match, files)
         self._set_tasks_list(files)
 
+    def _update_playbooks(self, repo: Any = None, state: Dict = None) -> NoReturn:
+        '''
+        Search and update playbooks, if files of project were changed since sync `state`.
+        '''
+        state = state if state is not None else dict()
+        fingerprint = self._get_files_fingerprint(repo)
+        if state.get('files') == fingerprint:
+            self.message('Playbooks are not changed.')
+            return
+        self._update_tasks(self.search_files(repo, '*.yml'))
+        state['files'] = fingerprint
+
     def _get_files(self, repo: Any = None) -> pathlib.Path:
         '''
         Get all files, where playbooks should be.
@@ -207,13 +282,17 @@ class _Base:
         :return: tuple with repo-object and fetch-results
         '''
         self._set_status("SYNC")
+        # Clone always rescans project, because its objects could be left from other project.
+        state = self._get_sync_state() if operation != self.make_clone else dict()
         try:
             with transaction.atomic():
                 result = self._operate(operation)
                 self._set_status("OK")
-                self._update_tasks(self.search_files(result[0], '*.yml'))
-                self._set_project_modules()
+                self._update_playbooks(result[0], state)
+                self._set_project_modules(result[0], state)
+                # Yaml is handled on every sync to restore objects changed in database.
                 self._handle_yaml(self._load_yaml() or dict())
+                transaction.on_commit(partial(self._set_sync_state, state))
         except Exception as err:
             logger.debug(traceback.format_exc())
             self.message('Sync error: {}'.format(err), 'error')
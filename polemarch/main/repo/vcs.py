@@ -203,6 +203,21 @@ class Git(_VCS):
                 for file in self.search_files(sm.module(), pattern.replace(sm.name + '/', '')):
                     yield pathlib.Path(sm.name)/file
 
+    def _get_fingerprint(self, repo: git.Repo, path: Text) -> Text:
+        '''
+        Fingerprint of file or directory is hash of its git object in HEAD.
+        Paths which are not in commit (e.g. in submodules) use files manifest.
+        '''
+        relpath = os.path.relpath(path, self.path)
+        try:
+            tree = repo.head.commit.tree
+            return (tree if relpath == '.' else tree / relpath).hexsha
+        except (KeyError, ValueError):
+            return super(Git, self)._get_fingerprint(repo, path)
+
+    def _get_files_fingerprint(self, repo: git.Repo) -> Text:
+        return self._get_fingerprint(repo, self.path)
+
     def get(self) -> Dict[str, str]:
         return {
             res.ref.remote_head: self._fetch_map[res.flags]
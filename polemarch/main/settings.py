@@ -253,6 +253,9 @@ TASKS_HANDLERS = {
     "PLAYBOOK": {
         "BACKEND": "{}.main.tasks.tasks.ExecuteAnsiblePlaybook".format(VST_PROJECT_LIB_NAME)
     },
+    "HOOKS": {
+        "BACKEND": "{}.main.tasks.tasks.SendHooks".format(VST_PROJECT_LIB_NAME)
+    },
 }
 
 CLONE_RETRY = rpc.getint('clone_retry_count', fallback=5)
@@ -276,6 +279,23 @@ HOOKS = {
 
 HOOKS_DIR = main.get("hooks_dir", fallback="/etc/polemarch/hooks/")
 
+# Hooks are delivered by celery task, so requests don't wait for recipients.
+# Failed deliveries are retried with exponential backoff.
+hooks = config['hooks']
+HOOKS_ASYNC = hooks.getboolean('async', fallback=False)
+HOOKS_QUEUE = hooks.get('queue', fallback='')
+HOOKS_TIMEOUT = hooks.getseconds('timeout', fallback=10)
+HOOKS_CONNECT_TIMEOUT = hooks.getseconds('connect_timeout', fallback=5)
+HOOKS_RETRIES = hooks.getint('retries', fallback=5)
+HOOKS_RETRY_DELAY = hooks.getseconds('retry_delay', fallback=10)
+HOOKS_RESULTS_LIFETIME = hooks.getseconds('results_lifetime', fallback='7d')
+# Send events coalesced in transaction to HTTP and SCRIPT hooks as one message.
+HOOKS_BATCH = hooks.getboolean('batch', fallback=False)
+# HTTP hooks use connections pool of process and send to recipients in threads.
+HOOKS_HTTP_WORKERS = hooks.getint('http_workers', fallback=8)
+HOOKS_HTTP_POOL_SIZE = hooks.getint('http_pool_size', fallback=10)
+HOOKS_HTTP_KEEPALIVE = hooks.getboolean('http_keepalive', fallback=True)
+
 __EXECUTOR_DEFAULT = '{INTERPRETER} -m pm_ansible'
 EXECUTOR = main.get("executor_path", fallback=__EXECUTOR_DEFAULT).strip().split(' ')
 SELFCARE = '/tmp/'
@@ -284,8 +304,104 @@ MANUAL_PROJECT_VARS = config['project_manual_vars'].all() or \
                       dict(forks=4, timeout=30, fact_caching_timeout=3600, poll_interval=5)
 
 PROJECT_REPOSYNC_WAIT_SECONDS = main.getseconds('repo_sync_on_run_timeout', fallback='1:00')
+GROUPS_CLOSURE = main.getboolean('groups_closure', fallback=False)
+
 PROJECT_CI_HANDLER_CLASS = "{}.main.ci.DefaultHandler".format(VST_PROJECT_LIB_NAME)
 
+# Execution history settings
+history = config['history']
+HISTORY_LINES_BULK_SIZE = history.getint('lines_bulk_size', fallback=200)
+HISTORY_LINES_FLUSH_INTERVAL = history.getint('lines_flush_interval', fallback=500) / 1000
+HISTORY_LIVE_CHECK_INTERVAL = history.getint('live_check_interval', fallback=500) / 1000
+HISTORY_LIVE_TIMEOUT = history.getseconds('live_timeout', fallback=30)
+HISTORY_CANCEL_CHECK_INTERVAL = history.getint('cancel_check_interval', fallback=1000) / 1000
+HISTORY_CANCEL_SIGNAL_TIMEOUT = history.getseconds('cancel_signal_timeout', fallback=5)
+HISTORY_OUTPUT_STORAGE = history.get('output_storage', fallback='LINES').upper()
+
+HISTORY_OUTPUT_BACKENDS = {
+    "LINES": {
+        "BACKEND": "{}.main.output.Lines".format(VST_PROJECT_LIB_NAME),
+    },
+    "CHUNKS": {
+        "BACKEND": "{}.main.output.Chunks".format(VST_PROJECT_LIB_NAME),
+        "OPTIONS": {
+            "chunk_size": history.getint('chunk_size', fallback=1000),
+            "compress_level": history.getint('compress_level', fallback=6),
+        }
+    },
+}
+
+
+# Execution queue settings
+execution = config['execution']
+EXECUTION_CONCURRENCY = execution.getint('concurrency', fallback=0)
+EXECUTION_PROJECT_CONCURRENCY = execution.getint('project_concurrency', fallback=0)
+EXECUTION_INVENTORY_CONCURRENCY = execution.getint('inventory_concurrency', fallback=0)
+EXECUTION_QUEUE_RETRY_INTERVAL = execution.getseconds('queue_retry_interval', fallback=5)
+EXECUTION_QUEUE = execution.get('queue', fallback='')
+# Lifetime of lease of running execution, which is refreshed by worker.
+EXECUTION_LEASE_TIMEOUT = execution.getseconds('lease_timeout', fallback=60)
+# Max lifetime of periodic task run marks for overlap policy.
+EXECUTION_PERIODIC_LOCK_TIMEOUT = execution.getseconds('periodic_lock_timeout', fallback=86400)
+# Default priorities (0-9, greater is more urgent) by initiator type
+# and weights of owners for fair sharing of slots between users.
+EXECUTION_PRIORITIES = {
+    'project': execution.getint('project_priority', fallback=8),
+    'template': execution.getint('template_priority', fallback=5),
+    'scheduler': execution.getint('scheduler_priority', fallback=2),
+}
+EXECUTION_DEFAULT_PRIORITY = EXECUTION_PRIORITIES['template']
+EXECUTION_OWNER_WEIGHTS = {
+    name.strip(): float(weight)
+    for name, weight in (
+        item.split(':', 1) for item in execution.getlist('owner_weights', fallback='') if ':' in item
+    )
+}
+
+CELERY_TASK_QUEUE_MAX_PRIORITY = 9
+if CELERY_BROKER_URL.startswith('redis'):  # nocv
+    # Redis emulates priorities with separate lists, where less is more urgent.
+    CELERY_BROKER_TRANSPORT_OPTIONS = dict(
+        globals().get('CELERY_BROKER_TRANSPORT_OPTIONS', {}),
+        priority_steps=list(range(10)),
+        queue_order_strategy='priority',
+    )
+
+# Execution workspace settings
+workspace = config['workspace']
+WORKSPACE_STRATEGY = workspace.get('strategy', fallback='AUTO').upper()
+WORKSPACE_GIT_STRATEGY = workspace.get('git_strategy', fallback='CLONE').upper()
+WORKSPACE_POOL_SIZE = workspace.getint('pool_size', fallback=0)
+WORKSPACE_POOL_BUDGET = workspace.getbytes('pool_budget', fallback='1G')
+WORKSPACE_POOL_DIR = workspace.get('pool_dir', fallback='/tmp/polemarch_workspaces')
+
+WORKSPACE_BACKENDS = {
+    "COPY": {
+        "BACKEND": "{}.main.workspace.Copy".format(VST_PROJECT_LIB_NAME),
+    },
+    "REFLINK": {
+        "BACKEND": "{}.main.workspace.Reflink".format(VST_PROJECT_LIB_NAME),
+    },
+    "HARDLINK": {
+        "BACKEND": "{}.main.workspace.Hardlink".format(VST_PROJECT_LIB_NAME),
+    },
+    "OVERLAY": {
+        "BACKEND": "{}.main.workspace.Overlay".format(VST_PROJECT_LIB_NAME),
+    },
+}
+
+WORKSPACE_GIT_BACKENDS = {
+    "CLONE": {
+        "BACKEND": "{}.main.workspace.GitClone".format(VST_PROJECT_LIB_NAME),
+    },
+    "REFERENCE": {
+        "BACKEND": "{}.main.workspace.GitReference".format(VST_PROJECT_LIB_NAME),
+    },
+    "WORKTREE": {
+        "BACKEND": "{}.main.workspace.GitWorktree".format(VST_PROJECT_LIB_NAME),
+    },
+}
+
 
 __PWA_ICONS_SIZES = [
     "36x36", "48x48", "72x72", "96x96", "120x120", "128x128", "144x144",
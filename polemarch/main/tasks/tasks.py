@@ -6,6 +6,7 @@ from ...wapp import app
 from ..utils import task, BaseTask
 from .exceptions import TaskError
 from ..models.utils import AnsibleModule, AnsiblePlaybook
+from ..executions import ExecutionSlots, PeriodicTaskRun, get_message_priority
 
 logger = logging.getLogger("polemarch")
 clone_retry = getattr(settings, 'CLONE_RETRY', 5)
@@ -36,18 +37,24 @@ class RepoTask(BaseTask):
             self.app.retry(exc=error)
 
 
-@task(app, ignore_result=True, bind=True)
+@task(app, ignore_result=True, bind=True,
+      priority=get_message_priority(settings.EXECUTION_PRIORITIES['scheduler']))
 class ScheduledTask(BaseTask):
-    __slots__ = ('job_id',)
+    __slots__ = 'job_id', 'queued'
 
-    def __init__(self, app, job_id, *args, **kwargs):
+    def __init__(self, app, job_id, queued=False, *args, **kwargs):
         super(ScheduledTask.task_class, self).__init__(app, *args, **kwargs)
-        self.job_id = job_id
+        self.job_id, self.queued = job_id, queued
+
+    def requeue(self):
+        self.app.apply_async(
+            args=(self.job_id,), kwargs=dict(queued=True), countdown=settings.EXECUTION_QUEUE_RETRY_INTERVAL
+        )
 
     def run(self):
         from ..models import PeriodicTask
         try:
-            PeriodicTask.objects.get(id=self.job_id).execute()
+            PeriodicTaskRun(PeriodicTask.objects.get(id=self.job_id), self.requeue).execute(self.queued)
         except PeriodicTask.DoesNotExist:
             return
         except Exception:  # nocv
@@ -55,9 +62,60 @@ class ScheduledTask(BaseTask):
             raise
 
 
+@task(app, ignore_result=True, bind=True)
+class SendHooks(BaseTask):
+    '''
+    Delivery of hooks message to recipients. Failed deliveries are sent
+    again by new task after backoff delay.
+    '''
+    __slots__ = 'when', 'messages', 'hooks', 'deliveries'
+
+    def __init__(self, app, when=None, messages=(), hooks=(), deliveries=(), *args, **kwargs):
+        super(SendHooks.task_class, self).__init__(app, *args, **kwargs)
+        self.when, self.messages = when, messages
+        self.hooks, self.deliveries = hooks, deliveries
+
+    def run(self):
+        from ..models import Hook, HookDelivery
+        if self.deliveries:
+            deliveries = HookDelivery.objects.pending(self.deliveries)
+        else:
+            HookDelivery.objects.cleanup()
+            hooks = Hook.objects.filter(id__in=self.hooks).order_by('id')
+            deliveries = HookDelivery.objects.prepare(hooks, self.when, self.messages)
+        retry = HookDelivery.objects.deliver(deliveries)
+        if retry:
+            self.app.apply_async(
+                kwargs=dict(deliveries=[delivery.id for delivery in retry]),
+                countdown=HookDelivery.get_retry_delay(retry),
+                **HookDelivery.get_task_options()
+            )
+
+
 class _ExecuteAnsible(BaseTask):
     ansible_class = None
 
+    def start(self):
+        history = self.kwargs.get('history', None)
+        if history is None:
+            return super(_ExecuteAnsible, self).start()
+        slots = ExecutionSlots(history)
+        if slots.is_cancelled():
+            slots.interrupt()
+            return None
+        if slots.acquire():
+            with slots.hold():
+                return super(_ExecuteAnsible, self).start()
+        # Execution waits for free slot in `DELAY` status without holding worker.
+        if not self.app.request.called_directly:
+            raise self.app.retry(countdown=settings.EXECUTION_QUEUE_RETRY_INTERVAL, max_retries=None)
+        # Synchronous execution (e.g. from scheduler) is queued as regular one.
+        self.app.apply_async(
+            args=self.args, kwargs=self.kwargs, countdown=settings.EXECUTION_QUEUE_RETRY_INTERVAL,
+            **self.kwargs['project']._get_task_options(history)  # pylint: disable=protected-access
+        )
+        return None
+
     def run(self):
         # pylint: disable=not-callable
         ansible_object = self.ansible_class(*self.args, **self.kwargs)
@@ -1,6 +1,7 @@
 import json  # noqa: F401
 
 import os
+from django.db import transaction
 from vstutils.tests import BaseTestCase as VSTBaseTestCase
 from ...main import models
 
@@ -9,6 +10,17 @@ echo "OK"
 '''
 
 
+def run_on_commit():
+    '''
+    Run callbacks of test transaction as after commit,
+    because test transaction is never committed.
+    '''
+    connection = transaction.get_connection()
+    callbacks, connection.run_on_commit = connection.run_on_commit, []
+    for _, callback in callbacks:
+        callback()
+
+
 class BaseTestCase(VSTBaseTestCase):
     server_name = 'polemarch-testserver'
     models = models
@@ -52,6 +64,14 @@ class BaseTestCase(VSTBaseTestCase):
         with open(self.get_test_filepath(name), 'r') as fd:
             return fd.read()
 
+    def get_stream_result(self, url, code=200, **kwargs):
+        client = self._login()
+        response = client.get(url, secure=True, **kwargs)
+        self.assertEqual(response.status_code, code, url)
+        content = b''.join(response.streaming_content) if response.streaming else response.content
+        self._logout(client)
+        return response, content
+
     def get_mod_bulk(self, item, pk, data, mtype="variables", *args, **kwargs):
         return super(BaseTestCase, self).get_mod_bulk(
             item, pk, data, mtype, *args, **kwargs
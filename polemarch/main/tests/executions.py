@@ -1,3 +1,4 @@
+import json
 import shutil
 import uuid
 import tempfile
@@ -837,6 +838,31 @@ class ProjectTestCase(BaseExecutionsTestCase):
         self.assertEqual(results['results'][-4]['initiator_type'], 'template')
         self.assertEqual(results['results'][-4]['options']['template_option'], 'four')
 
+        # Execute template in many inventories
+        url = 'template/{}/execute_many'.format(tmplt_mod['id'])
+        results = self.make_bulk([
+            self.get_mod_bulk('project', pk, dict(option='one', inventories=['localhost,', 'localhost,']), url),
+        ])
+        self.assertEqual(results[0]['status'], 201)
+        self.assertEqual(len(results[0]['data']['history_ids']), 2)
+        for inventories in ([], ['999999']):
+            self.get_result(
+                'post', self.get_url('project', pk, url), 400, data=json.dumps(dict(inventories=inventories))
+            )
+        histories = self.get_model_filter('History', pk__in=results[0]['data']['history_ids'])
+        self.assertEqual(histories.count(), 2)
+        for history in histories:
+            self.assertEqual(history.status, 'OK')
+            self.assertEqual(history.initiator_type, 'template')
+            self.assertEqual(history.initiator, tmplt_mod['id'])
+            self.assertEqual(history.options['template_option'], 'one')
+        # Direct execution without API request
+        template = self.get_model_filter('Template', pk=tmplt_mod['id']).get()
+        history = self.get_model_filter('History', pk=template.execute(self.user, 'one')).get()
+        self.assertEqual(history.status, 'OK')
+        self.assertEqual(history.initiator_type, 'template')
+        self.assertEqual(history.executor, self.user)
+
         # Templates in periodic tasks
         data = dict(
             mode="test-1.yml", schedule="10", type="INTERVAL",
@@ -1301,7 +1327,7 @@ class ProjectTestCase(BaseExecutionsTestCase):
         response.reason = None
         response.text = "OK"
         ##
-        with self.patch('requests.post') as mock:
+        with self.patch('requests.Session.post') as mock:
             iterations = 2 * len(hook_urls)
             mock.side_effect = [response] * iterations
             # results = self.make_bulk(bulk_data, 'put')
@@ -252,6 +252,12 @@ class OApiTestCase(BaseTestCase):
             objName, oneHistory['properties']['execution_time'],
             type='integer', format='uptime'
         )
+        self.check_fields(
+            objName, oneHistory['properties']['queue_position'], type='integer', readOnly=True
+        )
+        self.check_fields(
+            objName, oneHistory['properties']['priority'], type='integer', readOnly=True
+        )
         self.check_fields(
             objName, oneHistory['properties']['start_time'],
             type='string', format='date-time'
@@ -879,6 +885,10 @@ class OApiTestCase(BaseTestCase):
             type='string', format='dynamic', additionalProperties=additional_properties
         )
         self.check_fields(objName, periodicTask['properties']['enabled'], type='boolean')
+        self.check_fields(
+            objName, periodicTask['properties']['overlap_policy'],
+            type='string', default='allow', enum=['allow', 'skip', 'coalesce']
+        )
         del periodicTask
 
         onePeriodicTask = definitions['OnePeriodictask']
@@ -945,6 +955,10 @@ class OApiTestCase(BaseTestCase):
         self.check_fields(
             objName, onePeriodicTask['properties']['enabled'], type='boolean'
         )
+        self.check_fields(
+            objName, onePeriodicTask['properties']['overlap_policy'],
+            type='string', default='allow', enum=['allow', 'skip', 'coalesce']
+        )
         del onePeriodicTask
 
         periodicTaskVariable = definitions['PeriodicTaskVariable']
@@ -1046,7 +1060,8 @@ class OApiTestCase(BaseTestCase):
 
         key_list = [
             'repo_type', 'repo_sync_on_run', 'repo_sync_on_run_timeout',
-            'repo_branch', 'repo_password', 'repo_key', 'ci_template'
+            'repo_branch', 'repo_password', 'repo_key',
+            'execution_concurrency', 'execution_queue', 'ci_template'
         ]
         self.check_fields(
             objName, projectVariable['properties']['key'],
@@ -1058,6 +1073,7 @@ class OApiTestCase(BaseTestCase):
                 repo_password='password',
                 repo_key='secretfile',
                 repo_sync_on_run_timeout='uptime',
+                execution_concurrency='integer',
                 ci_template='fk'
             ),
             choices=dict(
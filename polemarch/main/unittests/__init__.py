@@ -1,6 +1,7 @@
 from .ansible import AnsibleTestCase
 from .utils import TemplateCreateTestCase
 from .api import UsersTestCase
-from .hooks import HooksTestCase
-from .tasks import TasksTestCase, TestTaskError, TestRepoTask
-from .models import ModelsTestCase
+from .hooks import HooksTestCase, HookDeliveryTestCase, HooksRouterTestCase, HookEventsTestCase
+from .tasks import TasksTestCase, TestTaskError, TestRepoTask, HistoryLinesWriterTestCase, ExecutorTestCase, ExecutionSlotsTestCase, PeriodicTaskRunTestCase, HistoryStatisticTestCase, HistoryOutputTestCase, WorkspaceTestCase, \
+    GitWorkspaceTestCase, WorkspacePoolTestCase, ProjectSyncTestCase
+from .models import ModelsTestCase, InventoryCompilerTestCase, GroupClosureTestCase, SetVariablesTestCase
@@ -1,7 +1,12 @@
+try:
+    from mock import patch
+except ImportError:  # nocv
+    from unittest.mock import patch
 import six
 from django.test import TestCase
 from django.core.management import call_command
-from ..utils import AnsibleInventoryParser
+from django.core.validators import ValidationError
+from ..utils import AnsibleInventoryParser, AnsibleArgumentsReference
 
 inventory_data = '''
 test-host-single ansible_host=10.10.10.10
@@ -79,6 +84,29 @@ class AnsibleTestCase(TestCase):
             out.getvalue().replace('\x1b[32;1m', '').replace('\x1b[0m', '')
         )
 
+    def test_arguments_reference(self):
+        reference = AnsibleArgumentsReference()
+        # Parsed reference is shared and reloaded only after cache changes.
+        self.assertIs(AnsibleArgumentsReference().raw_dict, reference.raw_dict)
+        reference.validate_args('playbook', {'forks': '5', 'become_user': 'root'})
+        with self.assertRaises(ValidationError):
+            reference.validate_args('playbook', {'forks': 'five'})
+        with self.assertRaises(ValidationError):
+            reference.validate_args('playbook', {'unknown_argument': '1'})
+        # Memoized reference could not be changed by its users.
+        with self.assertRaises(TypeError):
+            reference.raw_dict['playbook']['forks']['type'] = 'string'
+        # Only small version key is requested from cache.
+        cache = reference.get_ansible_cache().cache
+        with patch.object(cache.__class__, 'get', autospec=True, side_effect=cache.__class__.get) as get:
+            self.assertIs(AnsibleArgumentsReference().raw_dict, reference.raw_dict)
+            self.assertEqual([call[0][1] for call in get.call_args_list], [reference.version_key])
+        reference.clear_cache()
+        new_reference = AnsibleArgumentsReference()
+        self.assertIsNot(new_reference.raw_dict, reference.raw_dict)
+        self.assertEqual(new_reference.raw_dict, reference.raw_dict)
+        self.assertEqual(new_reference.version, reference.version)
+
     def test_inventory_parser(self):
         parser = AnsibleInventoryParser()
         inv_json = parser.get_inventory_data(inventory_data)
@@ -1,15 +1,23 @@
 import os
 import json
+import uuid
+import threading
+from datetime import timedelta
 try:
     from mock import patch
 except ImportError:  # nocv
     from unittest.mock import patch
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
 from django.core.validators import ValidationError
 from requests import Response
 from vstutils.utils import raise_context
-from ..models import Hook
+from ..models import Hook, HookDelivery, HookEvents, Inventory, collect_hooks
+from ..hooks.base import DeliveryError
+from ..hooks.http import Backend as HttpBackend
+from ..tests._base import run_on_commit
 
 
 class HooksTestCase(TestCase):
@@ -66,7 +74,7 @@ class HooksTestCase(TestCase):
 
     def check_output_run_http(self, method, url, data, **kwargs):
         # pylint: disable=protected-access, unused-argument
-        self.assertEqual(method, "post")
+        self.assertEqual(method.lower(), "post")
         self.check_output_run(
             [url, data['type']],
             cwd='', input=json.dumps(data['payload']),
@@ -78,12 +86,13 @@ class HooksTestCase(TestCase):
         the_response._content = b'{ "result" : "ok" }'
         return the_response
 
+    @override_settings(HOOKS_HTTP_WORKERS=1)
     def test_http(self):
         self.recipients = ['http://test.lan', 'https://example.com']
         hook = Hook.objects.create(
             type='HTTP', recipients=" | ".join(self.recipients)
         )
-        with patch('requests.api.request') as cmd:
+        with patch('requests.Session.request') as cmd:
             self.count = 0
             cmd.side_effect = self.check_output_run_http
             result = hook.run(message=dict(test="test"))
@@ -95,3 +104,272 @@ class HooksTestCase(TestCase):
             cmd.side_effect = self.check_output_error
             self.assertEqual(hook.run(message=dict(test="test")), "Err\nErr")
             self.assertEqual(cmd.call_count, 4)
+
+
+@override_settings(HOOKS_ASYNC=True)
+class HookDeliveryTestCase(TestCase):
+    def setUp(self):
+        super(HookDeliveryTestCase, self).setUp()
+        self.recipients = ['http://ok.lan', 'http://down.lan']
+        self.hook = Hook.objects.create(type='HTTP', recipients=" | ".join(self.recipients))
+        self.fails = 0
+
+    def execute(self, url, when, message):
+        if url == 'http://down.lan' and self.fails:
+            self.fails -= 1
+            raise DeliveryError("503 Service Unavailable: ")
+        return "200 OK: {}".format(message['target']['id'])
+
+    def send(self, object_id):
+        Hook.objects.all().execute('on_object_add', dict(when='on_object_add', target=dict(id=object_id)))
+
+    def get_deliveries(self, recipient):
+        return self.hook.deliveries.filter(recipient=recipient).order_by('id')
+
+    def test_delivery(self):
+        with patch('polemarch.main.hooks.http.Backend.execute') as execute:
+            execute.side_effect = self.execute
+            self.fails = 2
+            self.send(1)
+            self.assertEqual(execute.call_count, 4)
+        ok_delivery = self.get_deliveries('http://ok.lan').get()
+        self.assertEqual(ok_delivery.status, 'OK')
+        self.assertEqual(ok_delivery.attempts, 1)
+        self.assertEqual(ok_delivery.result, '200 OK: 1')
+        self.assertEqual(json.loads(ok_delivery.message)['target']['id'], 1)
+        down_delivery = self.get_deliveries('http://down.lan').get()
+        self.assertEqual(down_delivery.status, 'OK')
+        self.assertEqual(down_delivery.attempts, 3)
+        self.assertEqual(down_delivery.result, '200 OK: 1')
+
+    def test_order_and_retries(self):
+        hooks = [self.hook]
+        deliveries = (
+            HookDelivery.objects.prepare(hooks, 'on_object_add', [dict(target=dict(id=1))]) +
+            HookDelivery.objects.prepare(hooks, 'on_object_add', [dict(target=dict(id=2))])
+        )
+        with patch('polemarch.main.hooks.http.Backend.execute') as execute:
+            execute.side_effect = self.execute
+            self.fails = 1
+            retry = HookDelivery.objects.deliver(deliveries)
+            # Second message waits for retry of the first one.
+            self.assertEqual(execute.call_count, 3)
+            self.assertEqual([d.attempts for d in retry], [1, 0])
+            self.assertEqual(HookDelivery.get_retry_delay(retry), settings.HOOKS_RETRY_DELAY)
+            self.assertEqual(HookDelivery.objects.filter(status='OK').count(), 2)
+            retry = HookDelivery.objects.deliver(HookDelivery.objects.pending(d.id for d in retry))
+            self.assertEqual(retry, [])
+        results = self.get_deliveries('http://down.lan').values_list('result', flat=True)
+        self.assertEqual(list(results), ['200 OK: 1', '200 OK: 2'])
+
+        with override_settings(HOOKS_RETRIES=1):
+            with patch('polemarch.main.hooks.http.Backend.execute') as execute:
+                execute.side_effect = self.execute
+                self.fails = 10
+                self.send(3)
+                self.assertEqual(execute.call_count, 3)
+        failed = self.get_deliveries('http://down.lan').last()
+        self.assertEqual(failed.status, 'ERROR')
+        self.assertEqual(failed.attempts, 2)
+        self.assertEqual(failed.result, '503 Service Unavailable: ')
+        self.assertEqual(HookDelivery.get_retry_delay([failed]), settings.HOOKS_RETRY_DELAY * 2)
+
+    def test_sync(self):
+        with override_settings(HOOKS_ASYNC=False):
+            with patch('polemarch.main.hooks.http.Backend.execute') as execute:
+                execute.side_effect = self.execute
+                self.send(1)
+                self.assertEqual(execute.call_count, 2)
+        self.assertFalse(self.hook.deliveries.exists())
+
+    def test_cleanup(self):
+        with patch('polemarch.main.hooks.http.Backend.execute') as execute:
+            execute.side_effect = self.execute
+            self.send(1)
+        old = timezone.now() - timedelta(seconds=settings.HOOKS_RESULTS_LIFETIME + 1)
+        self.get_deliveries('http://ok.lan').update(created=old)
+        # Locks cache is shared by test processes.
+        with patch.object(HookDelivery.objects._queryset_class, 'cleanup_key', 'hooks-cleanup-' + uuid.uuid4().hex):
+            self.assertTrue(HookDelivery.objects.cleanup())
+            self.assertEqual(list(self.hook.deliveries.values_list('recipient', flat=True)), ['http://down.lan'])
+            self.get_deliveries('http://down.lan').update(created=old)
+            # Next cleanup is not earlier than in cleanup interval.
+            self.assertFalse(HookDelivery.objects.cleanup())
+            self.assertEqual(self.hook.deliveries.count(), 1)
+
+    def test_http_errors(self):
+        # pylint: disable=protected-access
+        response = Response()
+        response.reason, response.status_code, response._content = 'Unavailable', 503, b''
+        with patch('requests.Session.request') as request:
+            request.return_value = response
+            self.assertEqual(self.hook.run(message=dict(test="test")), '503 Unavailable: \n503 Unavailable: ')
+            self.assertEqual(
+                request.call_args[1]['timeout'], (settings.HOOKS_CONNECT_TIMEOUT, settings.HOOKS_TIMEOUT)
+            )
+            handler = Hook.handlers.get_handler(self.hook)
+            self.assertEqual(handler.deliver('http://ok.lan', 'on_execution', {}), ('RETRY', '503 Unavailable: '))
+            request.side_effect = ValueError('Wrong message')
+            self.assertEqual(handler.deliver('http://ok.lan', 'on_execution', {}), ('ERROR', 'Wrong message'))
+
+    def test_concurrent_recipients(self):
+        barrier = threading.Barrier(len(self.recipients), timeout=5)
+
+        def execute(url, when, message):
+            # Fails with timeout when recipients are sent one by one.
+            barrier.wait()
+            return self.execute(url, when, message)
+
+        with patch('polemarch.main.hooks.http.Backend.execute') as execute_method:
+            execute_method.side_effect = execute
+            self.send(1)
+            self.assertEqual(self.hook.run('on_object_add', dict(target=dict(id=2))), '200 OK: 2\n200 OK: 2')
+        self.assertEqual(self.hook.deliveries.filter(status='OK').count(), 2)
+
+    def test_http_session(self):
+        handler = Hook.handlers.get_handler(self.hook)
+        session = handler.session
+        self.assertIs(Hook.handlers.get_handler(self.hook).session, session)
+        adapter = session.get_adapter('https://example.com')
+        self.assertEqual(adapter._pool_maxsize, settings.HOOKS_HTTP_POOL_SIZE)  # pylint: disable=protected-access
+        self.assertEqual(session.headers['Connection'], 'keep-alive')
+        with override_settings(HOOKS_HTTP_KEEPALIVE=False):
+            self.assertEqual(HttpBackend(self.hook).get_session().headers['Connection'], 'close')
+
+
+class HooksRouterTestCase(TestCase):
+    def setUp(self):
+        super(HooksRouterTestCase, self).setUp()
+        Hook.router.update()
+
+    def test_routes(self):
+        message = dict(when='on_object_add', target=dict(id=1))
+        # Table is loaded once and events without hooks need no queries.
+        Hook.router.execute('on_object_add', message)
+        with self.assertNumQueries(0):
+            Hook.router.execute('on_object_add', message)
+            self.assertEqual(Hook.router.get('on_object_add'), [])
+
+        user_hook = Hook.objects.create(type='HTTP', recipients='http://user.lan', when='on_user_add')
+        common_hook = Hook.objects.create(type='HTTP', recipients='http://all.lan | http://all2.lan')
+        # Transaction which changed hooks routes by own data.
+        with self.assertNumQueries(1):
+            routes = Hook.router.get('on_user_add')
+        self.assertEqual([hook.id for hook, _ in routes], [user_hook.id, common_hook.id])
+        run_on_commit()
+        with self.assertNumQueries(1):
+            routes = Hook.router.get('on_user_add')
+        self.assertEqual([hook.id for hook, _ in routes], [user_hook.id, common_hook.id])
+        handler = routes[1][1]
+        self.assertEqual(handler.conf['recipients'], ['http://all.lan', 'http://all2.lan'])
+        with self.assertNumQueries(0):
+            self.assertEqual(Hook.router.get('on_object_add'), [(common_hook, handler)])
+            self.assertIs(Hook.router.get('on_user_add')[1][1], handler)
+
+        with override_settings(HOOKS_ASYNC=False):
+            with patch('polemarch.main.hooks.http.Backend.execute') as execute:
+                execute.return_value = 'OK'
+                with self.assertNumQueries(0):
+                    Hook.router.execute('on_object_add', message)
+                self.assertEqual(execute.call_count, 2)
+
+        common_hook.enable = False
+        common_hook.save()
+        self.assertEqual(Hook.router.get('on_object_add'), [])
+        user_hook.delete()
+        self.assertEqual(Hook.router.get('on_user_add'), [])
+        run_on_commit()
+        self.assertEqual(Hook.router.get('on_object_add'), [])
+
+        # Rolled back hook is not routed.
+        with self.assertRaises(ValueError), transaction.atomic():
+            Hook.objects.create(type='HTTP', recipients='http://rollback.lan')
+            self.assertEqual(len(Hook.router.get('on_object_add')), 1)
+            raise ValueError('rollback')
+        with self.assertNumQueries(0):
+            self.assertEqual(Hook.router.get('on_object_add'), [])
+
+
+@override_settings(HOOKS_ASYNC=False)
+class HookEventsTestCase(TestCase):
+    def setUp(self):
+        super(HookEventsTestCase, self).setUp()
+        Hook.router.update_version()
+        self.sent = []
+
+    def execute(self, url, when, message):
+        self.sent.append((url, when, message))
+        return 'OK'
+
+    def commit(self, callbacks):
+        for callback in callbacks:
+            callback()
+
+    def collect(self, callbacks):
+        with patch('polemarch.main.models.hooks.transaction.on_commit') as on_commit:
+            on_commit.side_effect = callbacks.append
+            with collect_hooks():
+                inventory = Inventory.objects.create(name='collected')
+                inventory.vars = dict(some_var='value')
+                hosts = [inventory.hosts.create(name='host{}'.format(i)) for i in range(3)]
+                hosts[0].vars = dict(ansible_host='127.0.0.1')
+                hosts[1].delete()
+                # Nested scope joins the outer one.
+                with collect_hooks():
+                    inventory.name = 'renamed'
+                    inventory.save()
+            self.assertEqual(self.sent, [])
+        return inventory, hosts
+
+    def test_get_when(self):
+        self.assertEqual(HookEvents.get_when('on_object_add', 'on_object_upd'), 'on_object_add')
+        self.assertEqual(HookEvents.get_when('on_object_upd', 'on_object_upd'), 'on_object_upd')
+        self.assertEqual(HookEvents.get_when('on_object_upd', 'on_object_del'), 'on_object_del')
+        self.assertEqual(HookEvents.get_when('on_object_add', 'on_object_del'), None)
+        self.assertEqual(HookEvents.get_when('on_user_upd', 'on_user_upd'), 'on_user_upd')
+
+    def test_collect(self):
+        Hook.objects.create(type='HTTP', recipients='http://single.lan')
+        callbacks = []
+        with patch('polemarch.main.hooks.http.Backend.execute') as execute:
+            execute.side_effect = self.execute
+            inventory, hosts = self.collect(callbacks)
+            self.assertEqual(len([cb for cb in callbacks if isinstance(getattr(cb, '__self__', None), HookEvents)]), 1)
+            self.commit(callbacks)
+        self.assertEqual([(when, message['target']['id']) for _, when, message in self.sent], [
+            ('on_object_add', inventory.id), ('on_object_add', hosts[0].id), ('on_object_add', hosts[2].id),
+        ])
+        self.assertEqual(self.sent[0][2]['target']['name'], 'renamed')
+        self.assertEqual(self.sent[0][2]['when'], 'on_object_add')
+        # Events out of scope are sent at once.
+        with patch('polemarch.main.hooks.http.Backend.execute') as execute:
+            execute.side_effect = self.execute
+            hosts[0].delete()
+            self.assertEqual(self.sent[-1][1], 'on_object_del')
+        self.assertIsNone(HookEvents.current())
+
+    @override_settings(HOOKS_BATCH=True)
+    def test_batch(self):
+        Hook.objects.create(type='HTTP', recipients='http://batch.lan', when='on_object_add')
+        callbacks = []
+        with patch('polemarch.main.hooks.http.Backend.execute') as execute:
+            execute.side_effect = self.execute
+            inventory, hosts = self.collect(callbacks)
+            self.commit(callbacks)
+            self.assertEqual(execute.call_count, 1)
+        url, when, message = self.sent[0]
+        self.assertEqual((url, when, message['when']), ('http://batch.lan', 'on_object_add', 'on_object_add'))
+        self.assertEqual(
+            [target['id'] for target in message['targets']], [inventory.id, hosts[0].id, hosts[2].id]
+        )
+
+    def test_rollback(self):
+        callbacks = []
+        with patch('polemarch.main.models.hooks.transaction.on_commit') as on_commit:
+            on_commit.side_effect = callbacks.append
+            with self.assertRaises(ValueError):
+                with collect_hooks():
+                    Inventory.objects.create(name='dropped')
+                    raise ValueError('rollback')
+        self.assertFalse([cb for cb in callbacks if isinstance(getattr(cb, '__self__', None), HookEvents)])
+        self.assertIsNone(HookEvents.current())
@@ -1,4 +1,17 @@
-from ..tests._base import BaseTestCase
+try:
+    from mock import patch
+except ImportError:  # nocv
+    from unittest.mock import patch
+import six
+from django.core.management import call_command
+from django.db import transaction, connection
+from django.test.utils import CaptureQueriesContext
+from django.test import override_settings
+from django.core.validators import ValidationError
+from django.contrib.contenttypes.models import ContentType
+from ..tests._base import BaseTestCase, run_on_commit
+from ..models.hosts import InventoryCompiler
+from ..exceptions import Conflict
 
 
 class ModelsTestCase(BaseTestCase):
@@ -11,3 +24,246 @@ class ModelsTestCase(BaseTestCase):
         self.assertEqual(class_handler.model, ObjClass)
         self.assertEqual(object_handler.instance, obj)
         self.assertEqual(object_handler.model, ObjClass)
+
+
+class InventoryCompilerTestCase(BaseTestCase):
+    def _legacy_inventory(self, inventory):
+        # pylint: disable=protected-access
+        from ..models.hosts import _get_dict, to_yaml
+        inv = dict(all=dict())
+        hvars, keys = inventory.get_generated_vars()
+        hosts_dicts, keys = _get_dict(inventory.hosts.all().order_by("name"), keys)
+        groups_dicts, keys = _get_dict(inventory.groups.all().order_by("name"), keys)
+        if hosts_dicts:
+            inv['all']['hosts'] = hosts_dicts
+        if groups_dicts:
+            inv['all']['children'] = groups_dicts
+        if hvars:
+            inv['all']['vars'] = hvars
+        return to_yaml(inv, **inventory._to_yaml_kwargs)
+
+    def _add_hosts(self, group, count):
+        Host = self.get_model_class('Host')
+        for i in range(count):
+            host = Host.objects.create(name='host-{}-{}'.format(group.name, i))
+            host.vars = dict(ansible_host='10.0.0.{}'.format(i), ansible_port=str(22 + i))
+            group.hosts.add(host)
+
+    def _create_inventory(self, hosts_count):
+        Inventory = self.get_model_class('Inventory')
+        Group = self.get_model_class('Group')
+        Host = self.get_model_class('Host')
+        inventory = Inventory.objects.create(name='compiled')
+        inventory.vars = dict(ansible_user='centos', custom='value')
+        parent = Group.objects.create(name='parent', children=True)
+        parent.vars = dict(ansible_become='True')
+        child = Group.objects.create(name='child', children=True)
+        shared = Group.objects.create(name='shared')
+        other = Group.objects.create(name='other')
+        other.vars = dict(some_var='1')
+        parent.groups.add(child, shared)
+        child.groups.add(shared, other)
+        self._add_hosts(shared, hosts_count)
+        self._add_hosts(other, hosts_count)
+        alone = Host.objects.create(name='alone')
+        inventory.hosts.add(alone, *shared.hosts.all()[:1])
+        inventory.groups.add(parent, other)
+        return inventory
+
+    def test_compiled_inventory(self):
+        inventory = self._create_inventory(3)
+        result, keys = inventory.get_inventory()
+        self.assertEqual(result, self._legacy_inventory(inventory))
+        self.assertEqual(keys, [])
+        # Queries count doesn't depend on inventory size.
+        with self.assertNumQueries(7):
+            InventoryCompiler(inventory).compile()
+        bigger = self._create_inventory(30)
+        with self.assertNumQueries(7):
+            InventoryCompiler(bigger).compile()
+        result, _ = bigger.get_inventory()
+        self.assertEqual(result, self._legacy_inventory(bigger))
+
+    def test_compiled_inventory_keys(self):
+        Host = self.get_model_class('Host')
+        inventory = self._create_inventory(1)
+        host = Host.objects.get(name='alone')
+        host.vars = dict(ansible_ssh_private_key_file='PRIVATE KEY')
+        result, keys = inventory.get_inventory()
+        self.assertEqual(len(keys), 1)
+        self.assertIn('ansible_ssh_private_key_file: {}'.format(keys[0].name), result)
+        with open(keys[0].name) as key_file:
+            self.assertEqual(key_file.read(), 'PRIVATE KEY')
+
+    def test_inventory_cache(self):
+        Host = self.get_model_class('Host')
+        Group = self.get_model_class('Group')
+        inventory = self._create_inventory(2)
+        run_on_commit()
+        result, _ = inventory.get_inventory()
+        with self.assertNumQueries(0):
+            self.assertEqual(inventory.get_inventory()[0], result)
+        # Any change of inventory content makes new version of cache.
+        changes = (
+            lambda: Host.objects.get(name='alone').variables.create(key='new', value='1'),
+            lambda: Group.objects.get(name='other').hosts.add(Host.objects.create(name='new')),
+            lambda: Host.objects.get(name='new').groups.clear(),
+            lambda: setattr(inventory, 'vars', dict(ansible_user='centos', custom='v')),
+            lambda: Group.objects.get(name='shared').delete(),
+        )
+        for change in changes:
+            change()
+            new_result, _ = inventory.get_inventory()
+            self.assertNotEqual(new_result, result)
+            self.assertEqual(new_result, self._legacy_inventory(inventory))
+            result = new_result
+            run_on_commit()
+            self.assertEqual(inventory.get_inventory()[0], result)
+        # Inventory of rolled back transaction is not cached.
+        with self.assertRaises(ValueError), transaction.atomic():
+            inventory.hosts.create(name='dropped')
+            self.assertIn('dropped', inventory.get_inventory()[0])
+            raise ValueError('rollback')
+        with self.assertNumQueries(0):
+            self.assertEqual(inventory.get_inventory()[0], result)
+        # Private keys are not cached and written for every execution.
+        Host.objects.get(name='alone').vars = dict(ansible_ssh_private_key_file='KEY')
+        run_on_commit()
+        first, first_keys = inventory.get_inventory()
+        with self.assertNumQueries(1):
+            second, second_keys = inventory.get_inventory()
+        self.assertNotEqual(first_keys[0].name, second_keys[0].name)
+        self.assertEqual(
+            first.replace(first_keys[0].name, second_keys[0].name), second
+        )
+        self.assertNotIn('KEY', first)
+
+    def test_subgroups_tree(self):
+        Group = self.get_model_class('Group')
+        groups = [
+            Group.objects.create(name='level{}'.format(i), children=True)
+            for i in range(10)
+        ]
+        for parent, child in zip(groups, groups[1:]):
+            parent.groups.add(child)
+        side = Group.objects.create(name='side')
+        groups[4].groups.add(side)
+        top = Group.objects.filter(id=groups[0].id)
+        with self.assertNumQueries(1):
+            subgroups = set(top.get_subgroups().values_list('id', flat=True))
+        self.assertEqual(subgroups, {g.id for g in groups + [side]})
+        with self.assertNumQueries(1):
+            parents = set(Group.objects.filter(id=side.id).get_parents())
+        self.assertEqual(parents, set(groups[:5] + [side]))
+        # Fallback for old databases gives the same result.
+        middle = Group.objects.filter(id=groups[6].id)
+        self.assertEqual(
+            set(middle.get_subgroups_id()),
+            set(middle._get_subgroups_id_iterative(tp='parents'))
+        )
+
+
+@override_settings(GROUPS_CLOSURE=True)
+class GroupClosureTestCase(BaseTestCase):
+    def setUp(self):
+        super(GroupClosureTestCase, self).setUp()
+        self.Group = self.get_model_class('Group')
+        self.closure = self.get_model_class('GroupClosure').objects
+        self.groups = {
+            name: self.Group.objects.create(name=name, children=True)
+            for name in ('a', 'b', 'c', 'd', 'e')
+        }
+
+    def _ids(self, *names):
+        return {self.groups[name].id for name in names}
+
+    def test_closure(self):
+        a, b, c, d, e = (self.groups[name] for name in 'abcde')
+        # Diamond: a -> (b, c) -> d -> e
+        a.groups.add(b, c)
+        b.groups.add(d)
+        d.groups.add(e)
+        c.groups.add(d)
+        self.assertEqual(self.closure.check_consistency(), [])
+        row = self.closure.get(ancestor=a, descendant=e)
+        self.assertEqual((row.depth, row.paths), (3, 2))
+        top = self.Group.objects.filter(id=a.id)
+        self.assertEqual(set(top.get_subgroups_id()), self._ids(*'abcde'))
+        self.assertEqual(
+            set(self.Group.objects.filter(id=e.id).get_parents()),
+            {a, b, c, d, e}
+        )
+        # Cyclic dependencies are checked without tree walking
+        with CaptureQueriesContext(connection) as queries:
+            with self.assertRaises(self.Group.CiclicDependencyError), transaction.atomic():
+                e.groups.add(a)
+        self.assertEqual(len([q for q in queries if 'SAVEPOINT' not in q['sql']]), 2)
+        with self.assertRaises(self.Group.CiclicDependencyError), transaction.atomic():
+            a.parents.add(d)
+        # Removing of relations
+        b.groups.remove(d, e)
+        self.assertEqual(self.closure.check_consistency(), [])
+        self.assertEqual(self.closure.get(ancestor=a, descendant=e).paths, 1)
+        c.groups.clear()
+        self.assertEqual(self.closure.check_consistency(), [])
+        self.assertEqual(set(top.get_subgroups_id()), self._ids(*'abc'))
+        c.groups.add(d)
+        d.delete()
+        self.assertEqual(self.closure.check_consistency(), [])
+        self.assertFalse(self.closure.filter(descendant=e).exists())
+        e.parents.add(c)
+        self.assertEqual(set(top.get_subgroups_id()), self._ids(*'abce'))
+
+    def test_rebuild_command(self):
+        a, b, c = (self.groups[name] for name in 'abc')
+        a.groups.add(b)
+        b.groups.add(c)
+        self.closure.all().delete()
+        out = six.StringIO()
+        with self.assertRaises(Exception):
+            call_command('rebuild_groups_closure', check=True, stdout=out)
+        call_command('rebuild_groups_closure', stdout=out)
+        self.assertIn('rebuilt with 3 rows', out.getvalue())
+        call_command('rebuild_groups_closure', check=True, stdout=out)
+        self.assertEqual(self.closure.check_consistency(), [])
+
+
+class SetVariablesTestCase(BaseTestCase):
+    def test_set_vars(self):
+        host = self.get_model_class('Host').objects.create(name='vars-host')
+        ContentType.objects.get_for_model(host)
+        variables = {'var_{}'.format(i): str(i) for i in range(30)}
+        variables['ansible_ssh_pass'] = 'secret'
+        with patch('polemarch.main.models.send_polemarch_models') as send:
+            with self.assertNumQueries(4):
+                host.vars = variables
+            send.assert_called_once_with('on_object_upd', host)
+            self.assertEqual(host.vars, variables)
+            # Only changed variables are written.
+            send.reset_mock()
+            variables.update(var_0='changed', ansible_ssh_pass='[~~ENCRYPTED~~]')
+            variables.pop('var_1')
+            with self.assertNumQueries(5):
+                host.vars = variables
+            send.assert_called_once_with('on_object_upd', host)
+            self.assertEqual(host.variables.count(), 30)
+            self.assertEqual(host.vars['var_0'], 'changed')
+            self.assertEqual(host.vars['ansible_ssh_pass'], 'secret')
+            self.assertNotIn('var_1', host.vars)
+            send.reset_mock()
+            host.vars = variables
+            send.assert_not_called()
+
+    def test_set_vars_validation(self):
+        host = self.get_model_class('Host').objects.create(name='vars-host')
+        host.vars = dict(ansible_host='127.0.0.1')
+        with self.assertRaises(ValidationError):
+            host.vars = dict(ansible_host='not valid host', other='1')
+        self.assertEqual(host.vars, dict(ansible_host='127.0.0.1'))
+        project = self.get_model_class('Project').objects.create(name='vars-project')
+        with self.assertRaises(ValidationError):
+            project.vars = dict(repo_type='MANUAL', unknown='1')
+        with self.assertRaises(Conflict):
+            project.vars = dict(repo_type='MANUAL', repo_sync_on_run=True, ci_template='1')
+        with self.assertRaises(ValidationError):
+            project.vars = dict(repo_type='MANUAL', ci_template='1')
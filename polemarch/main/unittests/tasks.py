@@ -1,9 +1,33 @@
+try:
+    from mock import patch, Mock
+except ImportError:  # nocv
+    from unittest.mock import patch, Mock
+import os
+import sys
+import time
+import gzip
+import signal
+import json
+import uuid
+import shutil
+import tempfile
+import six
+from django.contrib.auth.models import User
+from django.db.models import Sum
+from django.core.management import call_command
 from django.core.validators import ValidationError
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from vstutils.utils import KVExchanger
+from ..tests._base import BaseTestCase
 from ..tasks.exceptions import TaskError
 from ..tasks import RepoTask
+from ..tasks.tasks import ExecuteAnsiblePlaybook, ScheduledTask
 from ..exceptions import PMException
-from ..models import History
+from ..models import History, Project, Inventory, PeriodicTask, HistoryStatistic
+from ..executions import ExecutionSlots, PeriodicTaskRun, get_message_priority
+from ..models.utils import HistoryLinesWriter, Executor
+from ..utils import Metrics, KVChannel, AnsibleArgumentsReference
+from .. import workspace
 
 
 class TasksTestCase(TestCase):
@@ -37,3 +61,854 @@ class TestRepoTask(TestCase):
         project = "TestProject"
         with self.assertRaises(RepoTask.task_class.UnknownRepoOperation):
             RepoTask(app, project, "error")
+
+
+class HistoryLinesWriterTestCase(TestCase):
+
+    def test_write_by_batches(self):
+        history = History.objects.create(status="RUN", mode="test", output_storage="LINES")
+        writer = HistoryLinesWriter(history, bulk_size=4, flush_interval=3600)
+        writer.write_line('first', 1, '\n')
+        self.assertEqual(history.raw_history_line.count(), 0)
+        writer.write_line('second', 2, '\n')
+        self.assertEqual(history.raw_history_line.count(), 4)
+        writer.write_line('x' * 3000, 3, '\n')
+        self.assertEqual(history.raw_history_line.count(), 4)
+        writer.flush()
+        self.assertEqual(history.raw_history_line.count(), 7)
+        self.assertEqual(
+            history.get_raw(), 'first\nsecond\n{}\n'.format('x' * 3000)
+        )
+        writer.flush_interval = 0
+        writer.write_line('third', 4)
+        self.assertEqual(history.raw_history_line.count(), 8)
+
+
+class ExecutorTestCase(TestCase):
+
+    def get_executor(self):
+        history = History.objects.create(status="RUN", mode="test", output_storage="LINES")
+        executor = Executor(history)
+        executor.check_interval, executor.signal_timeout = 0.05, 0.2
+        return executor
+
+    def test_output(self):
+        executor = self.get_executor()
+        script = 'import sys\nfor i in range(500): print(i)\nsys.stdout.flush()'
+        executor.execute([sys.executable, '-c', script], '/tmp')
+        self.assertEqual(
+            executor.history.get_raw(), ''.join('{}\n'.format(i) for i in range(500))
+        )
+
+    def test_cancel(self):
+        executor = self.get_executor()
+        # SIGINT is ignored, so execution should be stopped by SIGTERM.
+        script = (
+            'import signal, sys, time\nsignal.signal(signal.SIGINT, signal.SIG_IGN)\n'
+            'print("started")\nsys.stdout.flush()\ntime.sleep(30)'
+        )
+        # Cancel key is unique, because cache is shared by parallel tests.
+        executor.exchanger = KVChannel('test-cancel-{}'.format(uuid.uuid4().hex))
+        line_handler = executor.line_handler
+
+        def send_cancel(line):
+            line_handler(line)
+            executor.exchanger.send(True)
+
+        executor.line_handler = send_cancel
+        start = time.time()
+        with self.assertRaises(executor.CalledProcessError) as err:
+            executor.execute([sys.executable, '-c', script], '/tmp')
+        self.assertEqual(err.exception.returncode, -signal.SIGTERM)
+        self.assertLess(time.time() - start, 10)
+        self.assertIn('User interrupted execution', executor.history.get_raw())
+        self.assertIsNone(executor.exchanger.last())
+
+
+class ExecutionSlotsTestCase(TestCase):
+
+    def setUp(self):
+        self.project = Project.objects.create(name='slots')
+        self.other_project = Project.objects.create(name='other-slots')
+        self.inventory = Inventory.objects.create(name='slots')
+        ExecutionSlots(None).cache.delete(ExecutionSlots.waiters_key)
+
+    def create_history(self, status='DELAY', project=None, inventory=None, **kwargs):
+        history = History.objects.create(
+            status=status, mode="test", project=project or self.project, inventory=inventory, **kwargs
+        )
+        if status == 'RUN':
+            ExecutionSlots(history).refresh()
+        return history
+
+    def test_limits(self):
+        running = self.create_history('RUN', inventory=self.inventory)
+        waiting = self.create_history()
+        # Without limits status is set by execution itself.
+        self.assertTrue(ExecutionSlots(waiting).acquire())
+        self.assertEqual(waiting.status, 'DELAY')
+        with override_settings(EXECUTION_PROJECT_CONCURRENCY=2):
+            self.assertTrue(ExecutionSlots(waiting).acquire())
+            self.assertEqual(History.objects.get(pk=waiting.pk).status, 'RUN')
+            self.assertFalse(ExecutionSlots(self.create_history()).acquire())
+            other = self.create_history(project=self.other_project, inventory=self.inventory)
+            self.assertTrue(ExecutionSlots(other).acquire())
+            self.project.vars = dict(execution_concurrency='3')
+            self.assertTrue(ExecutionSlots(self.create_history()).acquire())
+        with override_settings(EXECUTION_INVENTORY_CONCURRENCY=2):
+            waiting_inventory = self.create_history(inventory=self.inventory)
+            self.assertFalse(ExecutionSlots(waiting_inventory).acquire())
+            self.assertTrue(ExecutionSlots(self.create_history(project=self.other_project)).acquire())
+        with override_settings(EXECUTION_CONCURRENCY=4):
+            self.assertFalse(ExecutionSlots(self.create_history(project=self.other_project)).acquire())
+        running.status = 'OK'
+        running.save()
+        with override_settings(EXECUTION_INVENTORY_CONCURRENCY=2):
+            # Execution which waits longer takes free slot first.
+            self.assertFalse(ExecutionSlots(self.create_history(inventory=self.inventory)).acquire())
+            self.assertTrue(ExecutionSlots(waiting_inventory).acquire())
+        with self.assertRaises(ValidationError):
+            self.project.vars = dict(execution_concurrency='-1')
+
+    def test_stale_running(self):
+        running = self.create_history('RUN')
+        waiting = self.create_history()
+        with override_settings(EXECUTION_CONCURRENCY=1):
+            self.assertFalse(ExecutionSlots(waiting).acquire())
+            # Worker of running execution was killed and its lease is expired.
+            ExecutionSlots(running).release()
+            self.assertTrue(ExecutionSlots(waiting).acquire())
+            self.assertFalse(ExecutionSlots(self.create_history()).acquire())
+        slots = ExecutionSlots(waiting)
+        with override_settings(EXECUTION_LEASE_TIMEOUT=0.03):
+            with slots.hold():
+                time.sleep(0.05)
+                self.assertEqual([row[0] for row in ExecutionSlots(running).get_running_rows()], [waiting.id])
+        self.assertEqual(ExecutionSlots(running).get_running_rows(), [])
+
+    def test_lock(self):
+        slots = ExecutionSlots(self.create_history())
+        with slots.locked() as locked:
+            self.assertTrue(locked)
+            with patch.object(ExecutionSlots, 'lock_timeout', 0.1):
+                with slots.locked() as other_locked:
+                    self.assertFalse(other_locked)
+                with override_settings(EXECUTION_CONCURRENCY=1):
+                    self.assertFalse(slots.acquire())
+            self.assertTrue(slots.cache.get(slots.lock_id))
+
+    def test_priority(self):
+        for initiator_type, priority in (('project', 8), ('template', 5), ('scheduler', 2)):
+            history, _ = History.objects.start(
+                self.project, 'PLAYBOOK', 'test.yml', 'localhost,', initiator_type=initiator_type
+            )
+            self.assertEqual(history.priority, priority)
+        history, _ = History.objects.start(
+            self.project, 'PLAYBOOK', 'test.yml', 'localhost,', initiator_type='scheduler', priority=12
+        )
+        self.assertEqual(history.priority, 9)
+        self.assertEqual(get_message_priority(), 5)
+        History.objects.all().delete()
+
+        running = self.create_history('RUN')
+        scheduled = self.create_history(priority=2)
+        interactive = self.create_history(priority=8)
+        with override_settings(EXECUTION_CONCURRENCY=1):
+            self.assertFalse(ExecutionSlots(scheduled).acquire())
+            self.assertFalse(ExecutionSlots(interactive).acquire())
+            running.status = 'OK'
+            running.save()
+            # Queued scheduler run gives slot to interactive run.
+            self.assertFalse(ExecutionSlots(scheduled).acquire())
+            self.assertTrue(ExecutionSlots(interactive).acquire())
+            self.assertFalse(ExecutionSlots(scheduled).acquire())
+            slots = ExecutionSlots(scheduled)
+            slots.interrupt()
+            self.assertNotIn(scheduled.id, slots.get_waiters())
+            self.assertEqual(History.objects.get(pk=scheduled.pk).status, 'INTERRUPTED')
+
+    def test_fair_share(self):
+        first = User.objects.create(username='first-owner')
+        second = User.objects.create(username='second-owner')
+        self.create_history('RUN', executor=first)
+        other = self.create_history('RUN')
+        first_waiting = self.create_history(executor=first)
+        second_waiting = self.create_history(executor=second)
+        with override_settings(EXECUTION_CONCURRENCY=2):
+            self.assertFalse(ExecutionSlots(first_waiting).acquire())
+            self.assertFalse(ExecutionSlots(second_waiting).acquire())
+            other.status = 'OK'
+            other.save()
+            # Owner without running executions takes slot first.
+            self.assertFalse(ExecutionSlots(first_waiting).acquire())
+            self.assertTrue(ExecutionSlots(second_waiting).acquire())
+        with override_settings(EXECUTION_OWNER_WEIGHTS={'first-owner': 2}):
+            self.assertEqual(ExecutionSlots(first_waiting).get_weight(), 2)
+            self.assertEqual(ExecutionSlots(second_waiting).get_weight(), 1)
+
+    def test_queue(self):
+        first, second = self.create_history(), self.create_history()
+        self.create_history(project=self.other_project)
+        self.assertEqual(first.queue_position, 1)
+        self.assertEqual(second.queue_position, 2)
+        # Position follows the order of slots giving.
+        urgent = self.create_history(priority=9)
+        self.assertEqual(urgent.queue_position, 1)
+        self.assertEqual(first.queue_position, 2)
+        self.assertEqual(second.queue_position, 3)
+        urgent.delete()
+        self.assertIsNone(self.create_history('RUN').queue_position)
+        self.assertEqual(self.project.execution_queue, '')
+        self.project.vars = dict(execution_queue='heavy')
+        self.assertEqual(self.project.execution_queue, 'heavy')
+        slots = ExecutionSlots(first)
+        exchanger = KVExchanger(Executor.CANCEL_PREFIX + str(first.id))
+        # Cancel messages are shared by test processes.
+        exchanger.delete()
+        self.assertFalse(slots.is_cancelled())
+        exchanger.send(True)
+        self.assertTrue(slots.is_cancelled())
+        self.assertFalse(slots.is_cancelled())
+
+    def test_requeue_synchronous(self):
+        history = self.create_history()
+        kwargs = dict(target='test.yml', inventory=None, history=history, project=self.project)
+        with patch.object(ExecutionSlots, 'acquire', return_value=False), \
+                patch.object(ExecuteAnsiblePlaybook, 'apply_async') as apply_async, \
+                patch.object(ExecuteAnsiblePlaybook.task_class, 'ansible_class') as ansible_class:
+            ExecuteAnsiblePlaybook(**kwargs)
+        self.assertEqual(ansible_class.call_count, 0)
+        self.assertEqual(apply_async.call_count, 1)
+        self.assertEqual(apply_async.call_args[1]['kwargs'], kwargs)
+        self.assertEqual(apply_async.call_args[1]['countdown'], 5)
+
+    def test_cancel_waiting(self):
+        history = self.create_history()
+        KVExchanger(Executor.CANCEL_PREFIX + str(history.id)).send(True)
+        with patch.object(ExecuteAnsiblePlaybook.task_class, 'ansible_class') as ansible_class:
+            ExecuteAnsiblePlaybook.delay(
+                target='test.yml', inventory=None, history=history, project=self.project
+            )
+        self.assertEqual(ansible_class.call_count, 0)
+        history.refresh_from_db()
+        self.assertEqual(history.status, 'INTERRUPTED')
+        self.assertIsNotNone(history.stop_time)
+
+
+class PeriodicTaskRunTestCase(TestCase):
+
+    def get_run(self, policy):
+        # Unsaved task with unique id, because locks cache is shared by test processes.
+        return PeriodicTaskRun(PeriodicTask(id=uuid.uuid4().int % 10 ** 9, overlap_policy=policy))
+
+    def test_overlap_policy(self):
+        metrics = Metrics()
+        skipped, coalesced = metrics.get('periodic_task_skipped'), metrics.get('periodic_task_coalesced')
+        with patch.object(PeriodicTask, 'execute', return_value=1) as execute:
+            run = self.get_run('allow')
+            self.assertTrue(run.acquire('running'))
+            self.assertEqual(run.execute(), 1)
+            run.release('running')
+
+            run = self.get_run('skip')
+            self.assertEqual(run.execute(), 1)
+            self.assertTrue(run.acquire('running'))
+            self.assertIsNone(run.execute())
+            self.assertEqual(metrics.get('periodic_task_skipped'), skipped + 1)
+            run.release('running')
+            self.assertEqual(execute.call_count, 2)
+
+            run = self.get_run('coalesce')
+            run.requeue = requeue = Mock()
+            self.assertTrue(run.acquire('running'))
+            # Queued run is checked again later without waiting in worker.
+            self.assertIsNone(run.execute())
+            self.assertEqual(requeue.call_count, 1)
+            self.assertIsNone(run.execute(queued=True))
+            self.assertEqual(requeue.call_count, 2)
+            # Other runs are coalesced with queued one.
+            self.assertIsNone(run.execute())
+            self.assertEqual(metrics.get('periodic_task_coalesced'), coalesced + 1)
+            self.assertEqual(requeue.call_count, 2)
+            self.assertEqual(execute.call_count, 2)
+            # Queued run starts when running one is finished.
+            run.release('running')
+            self.assertEqual(run.execute(queued=True), 1)
+            self.assertEqual(execute.call_count, 3)
+            self.assertTrue(run.acquire('queued'))
+            run.release('queued')
+
+    def test_hold_running(self):
+        history = History.objects.create(status='DELAY', mode='test')
+        with patch.object(PeriodicTask, 'execute', return_value=history.id) as execute:
+            run = self.get_run('skip')
+            self.assertEqual(run.execute(), history.id)
+            # Execution waits for slot, so next runs are skipped.
+            self.assertIsNone(run.execute())
+            history.status = 'RUN'
+            history.save()
+            self.assertIsNone(run.execute())
+            self.assertEqual(execute.call_count, 1)
+            history.status = 'OK'
+            history.save()
+            self.assertEqual(run.execute(), history.id)
+            self.assertEqual(execute.call_count, 2)
+        run.release('running')
+
+    def test_requeue(self):
+        task = PeriodicTask(id=uuid.uuid4().int % 10 ** 9)
+        with patch.object(PeriodicTask.objects, 'get', return_value=task), \
+                patch.object(PeriodicTaskRun, 'execute') as execute:
+            ScheduledTask(task.id, queued=True)
+        execute.assert_called_once_with(True)
+        with patch.object(ScheduledTask, 'apply_async') as apply_async:
+            ScheduledTask.task_class(ScheduledTask, task.id).requeue()
+        apply_async.assert_called_once_with(args=(task.id,), kwargs=dict(queued=True), countdown=5)
+
+
+class HistoryStatisticTestCase(TestCase):
+
+    def get_counts(self):
+        return dict(
+            HistoryStatistic.objects.values('status').annotate(sum=Sum('count')).values_list('status', 'sum')
+        )
+
+    def test_statistic(self):
+        project = Project.objects.create(name='stats', status='OK')
+        history = History.objects.create(status='DELAY', mode='test', project=project)
+        self.assertEqual(self.get_counts(), dict(DELAY=1))
+        history.status = 'RUN'
+        history.save()
+        history.raw_args = 'args'
+        history.save()
+        self.assertEqual(self.get_counts(), dict(DELAY=0, RUN=1))
+        deferred = History.objects.only('id').get(pk=history.pk)
+        deferred.status = 'OK'
+        deferred.save()
+        self.assertEqual(self.get_counts(), dict(DELAY=0, RUN=0, OK=1))
+        histories, _ = History.objects.start_many(project, 'PLAYBOOK', 'test.yml', ['localhost,', 'other,'])
+        self.assertEqual(self.get_counts(), dict(DELAY=2, RUN=0, OK=1))
+        ids = [history.id for history in histories]
+        self.assertEqual(len(set(ids)), 2)
+        self.assertEqual(History.objects.filter(id__in=ids, mode='test.yml').count(), 2)
+        histories[0].status = 'ERROR'
+        histories[0].save()
+        self.assertEqual(self.get_counts(), dict(DELAY=1, RUN=0, OK=1, ERROR=1))
+
+        with self.assertNumQueries(3):
+            stats = HistoryStatistic.objects.all().stats(14)
+        self.assertEqual(list(stats.keys()), ['day', 'month', 'year'])
+        self.assertEqual(
+            [(item['status'], item['sum'], item['all']) for item in stats['day']],
+            [('DELAY', 1, 3), ('ERROR', 1, 3), ('OK', 1, 3)]
+        )
+        History.objects.all().delete()
+        self.assertEqual(HistoryStatistic.objects.all().stats(14)['year'], [])
+
+    def test_one_row_by_key(self):
+        project = Project.objects.create(name='stats', status='OK')
+        user = User.objects.create(username='stats-user')
+        History.objects.create(status='OK', mode='test', project=project)
+        History.objects.create(status='OK', mode='test', project=project, executor=user)
+        self.assertEqual(HistoryStatistic.objects.count(), 2)
+        # Rows without executor are not unique in database, but only one is changed.
+        row = HistoryStatistic.objects.get(executor=None)
+        HistoryStatistic.objects.create(date=row.date, status='OK', project=project, count=0)
+        HistoryStatistic.objects.change(HistoryStatistic.objects.filter(id=row.id).values_list(
+            'date', 'status', 'project_id', 'executor_id'
+        ).get(), 2)
+        self.assertEqual(self.get_counts(), dict(OK=4))
+        user.delete()
+        self.assertEqual(self.get_counts(), dict(OK=4))
+        self.assertEqual(HistoryStatistic.objects.get(id=row.id).count, 4)
+        self.assertEqual(HistoryStatistic.objects.filter(count__gt=0).count(), 1)
+
+
+class HistoryOutputTestCase(BaseTestCase):
+
+    def test_chunks_storage(self):
+        history = History.objects.create(status="OK", mode="test", output_storage='CHUNKS')
+        output = history.output
+        self.assertFalse(output.is_queryset)
+        writer = HistoryLinesWriter(history, bulk_size=7, flush_interval=3600)
+        for number in range(1, 2501):
+            writer.write_line('line {}'.format(number), number, '\n')
+        writer.flush()
+        self.assertEqual(output.count(), 5000)
+        self.assertEqual(history.output_chunks.count(), 5)
+        self.assertEqual(output.last_gnumber(), 2500)
+        raw = ''.join('line {}\n'.format(number) for number in range(1, 2501))
+        self.assertEqual(history.get_raw(), raw)
+        self.assertEqual(history.raw_stdout, raw)
+
+        lines = output.get_lines(after=1000, before=2001)
+        self.assertEqual(len(lines), 2000)
+        self.assertEqual(lines[0].line, 'line 1001')
+        self.assertEqual([l.line for l in lines[1998:]], ['line 2000', '\n'])
+
+        url = self.get_url('history', history.id, 'lines')
+        result = self.get_result('get', url + '?limit=3')
+        self.assertEqual(result['count'], 5000)
+        self.assertEqual(result['results'][0]['line_gnumber'], 2500)
+        self.assertEqual(result['results'][1]['line'], 'line 2500')
+        result = self.get_result('get', url + '?ordering=line_gnumber&after=2498&limit=3')
+        self.assertEqual(result['count'], 4)
+        self.assertEqual(
+            [l['line'] for l in result['results']], ['line 2499', '\n', 'line 2500']
+        )
+        result = self.get_result('get', url + '?line_gnumber=10')
+        self.assertEqual(result['count'], 2)
+        self.get_result('get', url + '?after=bad', 400)
+
+        call_command('migrate_history_output', storage='lines', stdout=six.StringIO())
+        history.refresh_from_db()
+        self.assertEqual(history.output_storage, 'LINES')
+        self.assertEqual(history.output_chunks.count(), 0)
+        self.assertEqual(history.raw_history_line.count(), 5000)
+        self.assertEqual(history.get_raw(), raw)
+        result = self.get_result('get', url + '?ordering=line_gnumber&after=2498&limit=3')
+        self.assertEqual(result['count'], 4)
+        history.set_output_storage('CHUNKS')
+        self.assertEqual(history.raw_history_line.count(), 0)
+        self.assertEqual(history.output_chunks.count(), 5)
+        self.assertEqual(history.get_raw(), raw)
+        del history.raw_stdout
+        self.assertEqual(history.output.count(), 0)
+
+    def test_chunks_open_tail(self):
+        history = History.objects.create(status="RUN", mode="test", output_storage='CHUNKS')
+        output = history.output
+        output.options['chunk_size'] = 10
+
+        def write(first, last):
+            output.write(line for number in range(first, last) for line in history.make_lines(str(number), number))
+
+        def get_chunks():
+            return [(c.lines_count, bytes(c.data).startswith(b'[')) for c in history.output_chunks.order_by('id')]
+
+        # Lines of not full chunk are appended without rewrite and compression.
+        write(1, 4)
+        write(4, 7)
+        self.assertEqual(get_chunks(), [(3, True), (3, True)])
+        write(7, 13)
+        self.assertEqual(get_chunks(), [(10, False), (2, True)])
+        with patch.object(output.__class__, 'max_open_chunks', 2):
+            write(13, 14)
+            write(14, 15)
+        self.assertEqual(get_chunks(), [(10, False), (4, True)])
+        self.assertEqual([l.line for l in output.iter_lines()], [str(n) for n in range(1, 15)])
+        self.assertEqual([l.line for l in output.get_lines(after=9, before=12)], ['10', '11'])
+
+    def test_raw_stream(self):
+        history = History.objects.create(status="OK", mode="test")
+        for number in range(1, 101):
+            history.write_line('\x1b[0;32mok: [host{}]\x1b[0m'.format(number), number, '\n')
+        raw = ''.join('ok: [host{}]\n'.format(number) for number in range(1, 101))
+        self.assertEqual(history.get_raw(original=False), raw)
+        self.assertEqual(''.join(history.iter_raw(False, block_size=3)), raw)
+        history.write_line('\x1b[0;3', 101)
+        history.write_line('1merror\x1b[0m', 102)
+        self.assertEqual(''.join(history.iter_raw(False, block_size=201)), raw + 'error')
+
+        url = self.get_url('history', history.id, 'raw')
+        response, content = self.get_stream_result(url + '?color=yes')
+        self.assertEqual(content.decode('utf-8'), history.get_raw())
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        response, content = self.get_stream_result(url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(content).decode('utf-8'), raw + 'error')
+        response, content = self.get_stream_result(url, 206, HTTP_RANGE='bytes=4-14')
+        self.assertEqual(content, b'[host1]\nok:')
+        self.assertEqual(response['Content-Range'], 'bytes 4-14/{}'.format(len(raw) + 5))
+        response, content = self.get_stream_result(url, 206, HTTP_RANGE='bytes=-6')
+        self.assertEqual(content, b'\nerror')
+        self.get_stream_result(url, 416, HTTP_RANGE='bytes=100000-')
+        # Size is computed once for the same output.
+        with patch.object(History, 'iter_raw', side_effect=AssertionError) as iter_raw:
+            self.assertEqual(history.get_raw_size(False), len(raw) + 5)
+        iter_raw.assert_not_called()
+        history.write_line('\nпривет', 103)
+        self.assertEqual(history.get_raw_size(False), len((raw + 'error\nпривет').encode('utf-8')))
+        response, content = self.get_stream_result(url, 206, HTTP_RANGE='bytes=-12')
+        self.assertEqual(content.decode('utf-8'), 'привет')
+        # Ranges are not served for growing output of working execution.
+        history.status = "RUN"
+        history.save()
+        response, content = self.get_stream_result(url, HTTP_RANGE='bytes=4-14')
+        self.assertEqual(content.decode('utf-8'), raw + 'error\nпривет')
+        self.assertEqual(response['Accept-Ranges'], 'none')
+
+    def test_live_output(self):
+        history = History.objects.create(status="RUN", mode="test")
+        history.write_line('first', 1, '\n')
+        self.assertEqual(history.output_channel.last(), {'gnumber': 1})
+        result = list(history.follow_output(0, timeout=0))
+        self.assertEqual(len(result), 1)
+        self.assertEqual([l.line for l in result[0]], ['first', '\n'])
+        for number in range(2, 6):
+            history.write_line('line {}'.format(number), number, '\n')
+        batches = list(filter(bool, history.follow_output(2, batch_size=3, timeout=0)))
+        self.assertEqual(
+            [[l.line_gnumber for l in lines] for lines in batches], [[3, 3], [4, 4], [5, 5]]
+        )
+        events = history.follow_output(5, check_interval=0.01, timeout=1)
+        self.assertEqual(next(events), [])
+        history.write_line('line 6', 6)
+        self.assertEqual(next(events)[0].line, 'line 6')
+        history.status = "OK"
+        history.save()
+        history.publish_output(finished=True)
+        self.assertEqual(list(events), [[]])
+
+        url = self.get_url('history', history.id, 'live')
+        response, content = self.get_stream_result(url + '?after=4')
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = content.decode('utf-8').split('\n\n')
+        self.assertEqual(events[0].split('\n')[0], 'id: 6')
+        data = json.loads(events[0].split('\n')[1][6:])
+        self.assertEqual([line['line'] for line in data], ['line 5', '\n', 'line 6'])
+        self.assertEqual(events[1], 'event: end\ndata: OK')
+        response, content = self.get_stream_result(url, HTTP_LAST_EVENT_ID='6')
+        self.assertEqual(content, b'event: end\ndata: OK\n\n')
+        self.get_stream_result(url + '?after=bad', 400)
+
+        # Reader waits for last lines, which are written after finish.
+        history.status = "RUN"
+        history.save()
+        events = history.follow_output(6, check_interval=0.01, timeout=1)
+        self.assertEqual(next(events), [])
+        history.status = "OK"
+        history.save()
+        history.publish_output(gnumber=6)
+        self.assertEqual(next(events), [])
+        history.write_line('line 7', 7)
+        history.publish_output(finished=True)
+        self.assertEqual([l.line for l in next(events)], ['line 7'])
+        self.assertEqual(list(events), [])
+
+    def test_live_stream_end(self):
+        history = History.objects.create(status="RUN", mode="test")
+        history.write_line('first', 1, '\n')
+
+        def finish():
+            history.write_line('second', 2, '\n')
+            history.status = "OK"
+            history.save()
+            history.write_line('last', 3, '\n')
+            history.publish_output(finished=True)
+
+        # Worker writes the rest of output and finishes while stream waits.
+        steps = [lambda: None, finish]
+        with patch('polemarch.main.models.tasks.time.sleep', side_effect=lambda t: steps and steps.pop(0)()):
+            response, content = self.get_stream_result(self.get_url('history', history.id, 'live'))
+        events = content.decode('utf-8').split('\n\n')
+        lines = sum((json.loads(event.split('\n')[1][6:]) for event in events if event.startswith('id: ')), [])
+        self.assertEqual(''.join(line['line'] for line in lines), 'first\nsecond\nlast\n')
+        self.assertEqual(events[-2], 'event: end\ndata: OK')
+
+
+class WorkspaceTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmpdir, 'project')
+        os.makedirs(os.path.join(self.src, 'roles', 'test'))
+        for name in ('main.yml', os.path.join('roles', 'test', 'tasks.yml')):
+            with open(os.path.join(self.src, name), 'w') as fd:
+                fd.write(name)
+        self.dst = os.path.join(self.tmpdir, 'execution', 'project_sources')
+        os.makedirs(os.path.dirname(self.dst))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def prepare(self, strategy):
+        backend = workspace.prepare_workspace(self.src, self.dst, strategy)
+        self.addCleanup(backend.cleanup, self.dst)
+        for name in ('main.yml', os.path.join('roles', 'test', 'tasks.yml')):
+            with open(os.path.join(self.dst, name)) as fd:
+                self.assertEqual(fd.read(), name)
+        return backend
+
+    def get_inode(self, path, name='main.yml'):
+        return os.stat(os.path.join(path, name)).st_ino
+
+    def write_new_file(self):
+        with open(os.path.join(self.dst, 'new.retry'), 'w') as fd:
+            fd.write('new')
+        self.assertFalse(os.path.exists(os.path.join(self.src, 'new.retry')))
+
+    def test_strategies_chain(self):
+        self.assertEqual(workspace.get_strategies('auto'), ['REFLINK', 'COPY'])
+        self.assertEqual(workspace.get_strategies('auto', pooled=True), ['OVERLAY', 'REFLINK', 'COPY'])
+        self.assertEqual(workspace.get_strategies('HARDLINK', pooled=True), ['HARDLINK', 'COPY'])
+        self.assertEqual(workspace.get_strategies('HARDLINK'), ['HARDLINK', 'COPY'])
+        self.assertEqual(workspace.get_strategies('COPY'), ['COPY'])
+
+    def test_copy(self):
+        self.assertEqual(str(self.prepare('COPY')), 'COPY')
+        self.assertNotEqual(self.get_inode(self.src), self.get_inode(self.dst))
+        self.write_new_file()
+
+    def test_hardlink(self):
+        self.assertEqual(str(self.prepare('HARDLINK')), 'HARDLINK')
+        self.assertEqual(self.get_inode(self.src), self.get_inode(self.dst))
+        self.write_new_file()
+
+    def test_reflink(self):
+        backend = self.prepare('REFLINK')
+        self.assertIn(str(backend), ['REFLINK', 'COPY'])
+        self.assertNotEqual(self.get_inode(self.src), self.get_inode(self.dst))
+        with open(os.path.join(self.dst, 'main.yml'), 'w') as fd:
+            fd.write('changed')
+        with open(os.path.join(self.src, 'main.yml')) as fd:
+            self.assertEqual(fd.read(), 'main.yml')
+        if str(backend) == 'COPY':
+            # Result of failed check is remembered for these filesystems.
+            devices = os.stat(self.src).st_dev, os.stat(self.tmpdir).st_dev
+            self.assertIn(('REFLINK',) + devices, workspace._unsupported)
+
+    def test_overlay(self):
+        backend = self.prepare('OVERLAY')
+        self.assertIn(str(backend), ['OVERLAY', 'COPY'])
+        self.write_new_file()
+        os.remove(os.path.join(self.dst, 'main.yml'))
+        self.assertTrue(os.path.exists(os.path.join(self.src, 'main.yml')))
+        backend.cleanup(self.dst)
+        self.assertFalse(os.path.ismount(self.dst))
+        backend.cleanup(self.dst)
+
+
+class GitWorkspaceTestCase(TestCase):
+
+    def setUp(self):
+        import git
+        self.tmpdir = tempfile.mkdtemp()
+        module = git.Repo.init(os.path.join(self.tmpdir, 'module'))
+        self.commit(module, 'role.yml', 'role')
+        self.src = os.path.join(self.tmpdir, 'project')
+        self.repo = git.Repo.init(self.src)
+        self.first = self.commit(self.repo, 'main.yml', 'first')
+        self.repo.git.execute([
+            'git', '-c', 'protocol.file.allow=always', 'submodule', 'add',
+            os.path.join(self.tmpdir, 'module'), 'roles'
+        ])
+        self.last = self.commit(self.repo, 'main.yml', 'last')
+        self.dst = os.path.join(self.tmpdir, 'execution', 'project_sources')
+        os.makedirs(os.path.dirname(self.dst))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def commit(self, repo, name, value):
+        with open(os.path.join(repo.working_dir, name), 'w') as fd:
+            fd.write(value)
+        repo.git.add(A=True)
+        repo.git.execute(['git', '-c', 'user.name=test', '-c', 'user.email=test@test', 'commit', '-m', value])
+        return repo.head.object.hexsha
+
+    def read(self, name):
+        with open(os.path.join(self.dst, name)) as fd:
+            return fd.read()
+
+    def prepare(self, strategy, revision, expected=None):
+        backend = workspace.prepare_git_workspace(self.src, self.dst, revision, strategy)
+        self.addCleanup(backend.cleanup, self.dst)
+        self.assertEqual(str(backend), expected or strategy)
+        return backend
+
+    def test_strategies_chain(self):
+        self.assertEqual(workspace.get_git_strategies('worktree'), ['WORKTREE', 'CLONE'])
+        self.assertEqual(workspace.get_git_strategies('CLONE'), ['CLONE'])
+        # Project repository is not changed by executions by default.
+        self.assertEqual(workspace.get_git_strategies(), ['CLONE'])
+
+    def test_worktree(self):
+        backend = self.prepare('WORKTREE', self.first)
+        self.assertEqual(self.read('main.yml'), 'first')
+        self.assertTrue(os.path.isfile(os.path.join(self.dst, '.git')))
+        self.assertEqual(len(self.repo.git.worktree('list').splitlines()), 2)
+        backend.cleanup(self.dst)
+        self.assertFalse(os.path.exists(self.dst))
+        self.assertEqual(len(self.repo.git.worktree('list').splitlines()), 1)
+        backend.cleanup(self.dst)
+
+    def test_reference(self):
+        self.prepare('REFERENCE', self.last)
+        self.assertEqual(self.read('main.yml'), 'last')
+        self.assertEqual(self.read('roles/role.yml'), 'role')
+        alternates = os.path.join(self.dst, '.git', 'objects', 'info', 'alternates')
+        self.assertTrue(os.path.exists(alternates))
+        module_alternates = os.path.join(self.dst, '.git', 'modules', 'roles', 'objects', 'info', 'alternates')
+        self.assertTrue(os.path.exists(module_alternates))
+
+    def test_fallback_to_clone(self):
+        with patch.object(workspace.GitWorktree, 'update_submodules', side_effect=Exception):
+            self.prepare('WORKTREE', self.last, 'CLONE')
+        self.assertEqual(self.read('main.yml'), 'last')
+        self.assertTrue(os.path.isdir(os.path.join(self.dst, '.git')))
+        self.assertEqual(len(self.repo.git.worktree('list').splitlines()), 1)
+
+
+class WorkspacePoolTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.pool = workspace.WorkspacePool(self.tmpdir, 2)
+        self.prepared = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def prepare(self, path):
+        self.prepared.append(path)
+        os.makedirs(path)
+        with open(os.path.join(path, 'main.yml'), 'w') as fd:
+            fd.write('x' * 100)
+
+    def get(self, revision, used=None):
+        entry = self.pool.get(1, revision * 40, self.prepare)
+        if used is not None:
+            os.utime(entry.path, (used, used))
+        return entry
+
+    def test_pool(self):
+        metrics = self.pool.metrics
+        hits, misses = metrics.get('workspace_pool_hit'), metrics.get('workspace_pool_miss')
+        self.assertFalse(self.pool.is_cacheable('master'))
+        self.assertTrue(self.pool.is_cacheable('a' * 40))
+
+        entry = self.get('a', 1)
+        self.assertFalse(entry.hit)
+        self.assertEqual(entry.size, 100)
+        with open(os.path.join(entry.path, 'main.yml')) as fd:
+            self.assertEqual(fd.read(), 'x' * 100)
+        entry.release()
+        entry = self.get('a', 1)
+        self.assertTrue(entry.hit)
+        entry.release()
+        self.assertEqual(len(self.prepared), 1)
+        self.assertEqual(metrics.get('workspace_pool_hit'), hits + 1)
+        self.assertEqual(metrics.get('workspace_pool_miss'), misses + 1)
+
+        # Least recently used entry is evicted, but not the one in use.
+        used = self.get('a', 1)
+        self.get('b', 2).release()
+        self.get('c', 3).release()
+        self.assertTrue(used.exists)
+        self.assertFalse(self.pool.get_entry(1, 'b' * 40).exists)
+        used.release()
+        self.get('d', 4).release()
+        self.assertFalse(used.exists)
+        self.assertFalse(os.path.exists(used.lock_path))
+        self.assertEqual(len(self.pool.entries()), 2)
+
+        # Disk budget.
+        self.pool.budget = 150
+        self.assertEqual(self.pool.evict(), 1)
+        self.assertEqual([e.path for e in self.pool.entries()], [self.pool.get_entry(1, 'd' * 40).path])
+
+
+class ProjectSyncTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        projects_dir = patch.object(Project, 'PROJECTS_DIR', self.tmpdir)
+        projects_dir.start()
+        self.addCleanup(projects_dir.stop)
+        self.project = Project.objects.create(name='sync_project', repository='')
+        self.repo = self.project.repo_class
+        self.repo.clone()
+        self.state = dict()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def write(self, name, value):
+        with open(os.path.join(self.project.path, name), 'w') as fd:
+            fd.write(value)
+
+    def test_update_objects(self):
+        self.write('first.yml', '---')
+        self.write('second.yml', '---')
+        self.repo.get()
+        ids = dict(self.project.playbook.values_list('name', 'id'))
+        self.assertIn(os.path.join(self.project.path, 'first'), ids)
+        os.remove(os.path.join(self.project.path, 'second.yml'))
+        self.write('third.yml', '---')
+        self.repo.get()
+        new_ids = dict(self.project.playbook.values_list('name', 'id'))
+        name = os.path.join(self.project.path, '{}').format
+        self.assertEqual(new_ids[name('first')], ids[name('first')])
+        self.assertNotIn(name('second'), new_ids)
+        self.assertIn(name('third'), new_ids)
+
+    def test_fingerprint(self):
+        path = os.path.join(self.project.path, 'library')
+        os.makedirs(path)
+        empty = self.repo._get_fingerprint(None, path)
+        self.write('library/module.py', 'first')
+        first = self.repo._get_fingerprint(None, path)
+        self.assertNotEqual(empty, first)
+        self.assertEqual(first, self.repo._get_fingerprint(None, path))
+        self.write('library/module.py', 'changed')
+        self.assertNotEqual(first, self.repo._get_fingerprint(None, path))
+        self.assertEqual(empty, self.repo._get_fingerprint(None, os.path.join(path, 'unknown')))
+
+    def test_skip_unchanged(self):
+        self.write('ansible.cfg', '[defaults]\nlibrary = ./library\n')
+        os.makedirs(os.path.join(self.project.path, 'library'))
+        self.write('library/module.py', 'module')
+        parser_class = self.project.get_ansible_config_parser().__class__
+        clear = parser_class.clear_cache
+        with patch.object(parser_class, 'clear_cache', autospec=True, side_effect=clear) as clear_cache:
+            self.repo._set_project_modules(None, self.state)
+            self.assertEqual(clear_cache.call_count, 1)
+            self.assertEqual(self.state['module_paths'], [os.path.join(self.project.path, 'library')])
+
+            self.repo._set_project_modules(None, self.state)
+            self.assertEqual(clear_cache.call_count, 1)
+
+            self.write('library/module.py', 'changed module')
+            self.repo._set_project_modules(None, self.state)
+            self.assertEqual(clear_cache.call_count, 2)
+
+            # Modules are rescanned after ansible update.
+            get_reference = AnsibleArgumentsReference._get_reference
+            with patch.object(
+                AnsibleArgumentsReference, '_get_reference', autospec=True,
+                side_effect=lambda ref: ('other',) + tuple(get_reference(ref)[1:])
+            ):
+                self.repo._set_project_modules(None, self.state)
+            self.assertEqual(clear_cache.call_count, 3)
+
+    def test_skip_playbooks(self):
+        self.write('first.yml', '---')
+        os.utime(self.project.path, ns=(1, 1))
+        search_files = self.repo.search_files
+        with patch.object(self.repo.__class__, 'search_files', autospec=True,
+                          side_effect=lambda repo, *args: search_files(*args)) as search:
+            self.repo._update_playbooks(None, self.state)
+            self.assertEqual(search.call_count, 1)
+            count = self.project.playbook.count()
+            # Changed content doesn't change list of playbooks.
+            self.write('first.yml', '---\n- hosts: all\n')
+            self.repo._update_playbooks(None, self.state)
+            self.assertEqual(search.call_count, 1)
+            self.write('second.yml', '---')
+            self.repo._update_playbooks(None, self.state)
+            self.assertEqual(search.call_count, 2)
+            self.assertEqual(self.project.playbook.count(), count + 1)
+
+    def test_yaml_restore(self):
+        self.write('.polemarch.yaml', '\n'.join([
+            '---', 'templates:', '  ping:', '    kind: Module',
+            '    data: {module: ping, group: all, inventory: "localhost,", args: "", vars: {}}',
+        ]))
+        self.repo.get()
+        self.assertEqual(self.project.template.filter(name='ping').count(), 1)
+        self.project.template.filter(name='ping').delete()
+        self.repo.get()
+        self.assertEqual(self.project.template.filter(name='ping').count(), 1)
+        self.repo.get()
+        self.assertEqual(self.project.template.filter(name='ping').count(), 1)
@@ -7,6 +7,8 @@ import sys
 import re
 import os
 import json
+import uuid
+from types import MappingProxyType
 from os.path import dirname
 
 try:
@@ -14,12 +16,14 @@ try:
 except ImportError:  # nocv
     from yaml import Loader, Dumper, load, dump
 
+from django.db import transaction
 from vstutils.utils import (
     ON_POSIX,
     tmp_file_context,
     BaseVstObject,
     Executor,
     UnhandledExecutor,
+    KVExchanger,
     subprocess
 )
 
@@ -57,6 +61,32 @@ class CmdExecutor(Executor, PMObject):
     __slots__ = ()
 
 
+class KVChannel(KVExchanger):
+    """
+    Key-value channel between services. Unlike `KVExchanger`,
+    last published value is kept for all readers until expired.
+    """
+    __slots__ = ()
+
+    def publish(self, value, ttl=None):
+        # pylint: disable=no-member
+        self.cache.set(self.key, value, ttl or self.timeout)
+
+    def last(self):
+        # pylint: disable=no-member
+        return self.cache.get(self.key)
+
+    def pop(self):
+        '''
+        Get value and remove it, if it is set. Unlike `get()`,
+        nothing is removed when there is no value.
+        '''
+        value = self.last()
+        if value is not None:
+            self.delete()
+        return value
+
+
 class task(object):
     """ Decorator for Celery task classes
 
@@ -152,10 +182,149 @@ class SubCacheInterface(PMObject):
         self.set(None)
 
 
+class VersionUpdate:
+    '''
+    New content version in shared cache, which is set after commit
+    of current transaction (immediately without transaction), so data of
+    uncommitted or rolled back changes is never cached under new version.
+    '''
+    __slots__ = 'cache', 'key'
+
+    def __init__(self, cache, key: str):
+        self.cache, self.key = cache, key
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, VersionUpdate) and other.key == self.key
+
+    def __hash__(self) -> int:
+        return hash(self.key)  # nocv
+
+    def __call__(self):
+        self.cache.set(self.key, uuid.uuid4().hex, None)
+
+    def get_pending(self) -> list:
+        '''
+        Savepoints of this update registered in current transaction.
+        Updates of rolled back savepoints are removed by Django.
+        '''
+        connection = transaction.get_connection()
+        if not connection.in_atomic_block:
+            return []
+        return [sids for sids, func in connection.run_on_commit if func == self]
+
+    @property
+    def pending(self) -> bool:
+        return bool(self.get_pending())
+
+    def schedule(self):
+        savepoints = set(transaction.get_connection().savepoint_ids)
+        # Update from outer (still active) savepoint is enough.
+        if not any(sids <= savepoints for sids in self.get_pending()):
+            transaction.on_commit(self)
+
+
+class InventoryCache(SubCacheInterface):
+    '''
+    Cache of compiled inventory. Cache key contains content versions
+    of inventory, which are kept in shared `locks` cache, so any change of
+    inventory data makes new key on all nodes after commit. Inventory
+    changed in current transaction is not cached.
+    '''
+    __slots__ = 'changed',
+    cache_name = "inventory"
+    versions_cache_name = "locks"
+    common_version_key = "inventory-version"
+
+    def __init__(self, inventory_id: int, timeout: int = 86400):
+        prefix = '{}-{}-{}'.format(
+            inventory_id,
+            self.get_version(self.common_version_key),
+            self.get_version(self.get_version_key(inventory_id)),
+        )
+        super(InventoryCache, self).__init__(prefix, timeout)
+        self.changed = any(
+            self.get_update(key).pending for key in (self.common_version_key, self.get_version_key(inventory_id))
+        )
+
+    def set(self, value):
+        if not self.changed:
+            super(InventoryCache, self).set(value)
+
+    def get(self):
+        return None if self.changed else super(InventoryCache, self).get()
+
+    @classmethod
+    def get_version_key(cls, inventory_id: int = None) -> str:
+        if inventory_id is None:
+            return cls.common_version_key
+        return '{}-{}'.format(cls.common_version_key, inventory_id)
+
+    @classmethod
+    def get_version(cls, key: str) -> str:
+        versions = cls.get_django_cache(cls.versions_cache_name)
+        version = versions.get(key)
+        if version is None:
+            versions.add(key, uuid.uuid4().hex, None)
+            version = versions.get(key)
+        return version
+
+    @classmethod
+    def get_update(cls, key: str) -> VersionUpdate:
+        return VersionUpdate(cls.get_django_cache(cls.versions_cache_name), key)
+
+    @classmethod
+    def update_version(cls, inventory_id: int = None):
+        '''
+        Update content version of inventory or of all inventories
+        (when `inventory_id` is None) after commit.
+        '''
+        cls.get_update(cls.get_version_key(inventory_id)).schedule()
+
+
 class AnsibleCache(SubCacheInterface):
     cache_name = "ansible"
 
 
+class Metrics(PMObject):
+    '''
+    Service counters shared between processes in `locks` cache.
+    '''
+    __slots__ = ('cache',)
+    cache_name = "locks"
+    names_key = "metrics-names"
+
+    def __init__(self):
+        self.cache = self.get_django_cache(self.cache_name)
+
+    def get_key(self, name: str) -> str:
+        return 'metrics-{}'.format(name)
+
+    def names(self) -> list:
+        return self.cache.get(self.names_key) or []
+
+    def incr(self, name: str, value: int = 1) -> int:
+        key = self.get_key(name)
+        if self.cache.add(key, value, None):
+            names = self.names()
+            if name not in names:
+                self.cache.set(self.names_key, names + [name], None)
+            return value
+        try:
+            return self.cache.incr(key, value)
+        except ValueError:  # nocv
+            self.cache.set(key, value, None)
+            return value
+
+    def get(self, name: str) -> int:
+        return self.cache.get(self.get_key(name)) or 0
+
+    def all(self) -> dict:
+        return {name: self.get(name) for name in sorted(self.names())}
+
+    def clear(self):
+        self.cache.delete_many([self.get_key(name) for name in self.names()] + [self.names_key])
+
+
 class PMAnsible(PMObject):
     __slots__ = ('execute_path', 'cache',)
     # Json regex
@@ -213,7 +382,12 @@ class PMAnsible(PMObject):
 
 
 class AnsibleArgumentsReference(PMAnsible):
-    __slots__ = 'raw_dict', 'version'
+    '''
+    Reference of ansible cli arguments. Parsed reference is memoized
+    per process and reloaded only when its version key in cache is changed
+    (e.g. cleared after ansible update). Memoized reference is read-only.
+    '''
+    __slots__ = 'raw_dict', 'version', 'args_types'
 
     ref_name = 'reference'
     # Excluded args from user calls
@@ -225,15 +399,47 @@ class AnsibleArgumentsReference(PMAnsible):
         'ask-sudo-pass', 'ask-su-pass', 'ask-pass',
         'ask-vault-pass', 'ask-become-pass',
     ]
+    # Memoized (reference version key, ansible version, reference, args types) of process
+    _memo = None
 
     def __init__(self):
         super(AnsibleArgumentsReference, self).__init__()
-        self.raw_dict = self._extract_from_cli()
+        self.version, self.raw_dict, self.args_types = self._get_reference()
+
+    @property
+    def version_key(self) -> str:
+        return self.get_ansible_cache().key + '-version'
+
+    def _get_reference(self):
+        cache = self.get_ansible_cache().cache
+        reference_version = cache.get(self.version_key)
+        memo = self.__class__._memo
+        if reference_version is None or memo is None or memo[0] != reference_version:
+            raw_dict = self._extract_from_cli()
+            args_types = {
+                command: {name: (data or {}).get('type', None) for name, data in args.items()}
+                for command, args in raw_dict.items()
+            }
+            if reference_version is None:
+                cache.add(self.version_key, uuid.uuid4().hex, self.cache_timeout)
+                reference_version = cache.get(self.version_key)
+            raw_dict = MappingProxyType({
+                command: MappingProxyType({
+                    name: MappingProxyType(data) if isinstance(data, dict) else data
+                    for name, data in args.items()
+                })
+                for command, args in raw_dict.items()
+            })
+            memo = (reference_version, self.version, raw_dict, args_types)
+            self.__class__._memo = memo
+        return memo[1:]
+
+    def clear_cache(self):
+        super(AnsibleArgumentsReference, self).clear_cache()
+        self.get_ansible_cache().cache.delete(self.version_key)
 
     def is_valid_value(self, command: str, argument: str, value):
-        argument = argument.replace('_', '-')
-        argument_data = self.raw_dict[command][argument]
-        mtype = argument_data["type"]
+        mtype = self.args_types[command][argument.replace('_', '-')]
         if mtype == 'int':
             int(value)
         elif mtype is not None and value is None:  # nocv
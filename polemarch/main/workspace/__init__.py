@@ -0,0 +1,101 @@
+from __future__ import unicode_literals
+from typing import Text, List, Set, Tuple, Optional
+import os
+import shutil
+import logging
+from django.conf import settings
+from vstutils.utils import ObjectHandlers, raise_context
+from ._base import _Base
+from .files import Copy, Reflink, Hardlink
+from .overlay import Overlay
+from .vcs import GitClone, GitReference, GitWorktree
+from .pool import WorkspacePool, PoolEntry
+
+logger = logging.getLogger('polemarch')
+
+handlers = ObjectHandlers('WORKSPACE_BACKENDS', 'Unknown workspace strategy!')
+git_handlers = ObjectHandlers('WORKSPACE_GIT_BACKENDS', 'Unknown git workspace strategy!')
+
+# Strategies tried in order for `AUTO`.
+AUTO_STRATEGIES = ('REFLINK', 'COPY')
+# Strategies tried in order for `AUTO` layer over pool entry. Pool entry
+# is not changed while it is used, so it is safe as overlay lower dir.
+POOL_AUTO_STRATEGIES = ('OVERLAY', 'REFLINK', 'COPY')
+# Last resort strategies, always supported.
+FALLBACK_STRATEGY = 'COPY'
+GIT_FALLBACK_STRATEGY = 'CLONE'
+
+# Pairs of strategy and devices of project dir and tmpdir, which already
+# failed in this process, so strategy is not probed for every execution.
+_unsupported = set()  # type: Set[Tuple[Text, int, int]]
+
+
+def get_strategies(strategy: Text = None, pooled: bool = False) -> List[Text]:
+    strategy = (strategy or settings.WORKSPACE_STRATEGY).upper()
+    if strategy == 'AUTO':
+        strategies = list(POOL_AUTO_STRATEGIES if pooled else AUTO_STRATEGIES)
+    else:
+        strategies = [strategy]
+    if FALLBACK_STRATEGY not in strategies:
+        strategies.append(FALLBACK_STRATEGY)
+    return strategies
+
+
+def get_git_strategies(strategy: Text = None) -> List[Text]:
+    strategy = (strategy or settings.WORKSPACE_GIT_STRATEGY).upper()
+    if strategy == GIT_FALLBACK_STRATEGY:
+        return [strategy]
+    return [strategy, GIT_FALLBACK_STRATEGY]
+
+
+def _prepare(backends: ObjectHandlers, strategies: List[Text], src: Text, dst: Text, *args, **kwargs) -> _Base:
+    devices = os.stat(src).st_dev, os.stat(os.path.dirname(dst)).st_dev
+    fallback = strategies[-1]
+    for name in strategies:
+        backend = backends.get_object(name, name)
+        if name != fallback:
+            if (name,) + devices in _unsupported:
+                continue
+            if not backend.is_supported(src, dst):
+                if backend.remember_failures:
+                    _unsupported.add((name,) + devices)
+                continue
+        try:
+            backend.prepare(src, dst, *args, **kwargs)
+            return backend
+        except Exception as err:
+            if name == fallback:
+                raise
+            logger.warning('Workspace strategy {} failed: {}'.format(name, err))
+            if backend.remember_failures:
+                _unsupported.add((name,) + devices)
+            with raise_context():
+                backend.cleanup(dst)
+            shutil.rmtree(dst, ignore_errors=True)
+    raise Exception('No workspace strategy for {}.'.format(dst))  # nocv
+
+
+def prepare_workspace(src: Text, dst: Text, strategy: Text = None, pooled: bool = False) -> _Base:
+    '''
+    Prepare writable workspace with project files from `src` in `dst`
+    using first supported strategy. Returns used strategy object,
+    which `cleanup()` should be called before removing of `dst`.
+    `pooled` means that `src` is pool entry, which is not changed while used.
+    '''
+    return _prepare(handlers, get_strategies(strategy, pooled), src, dst)
+
+
+def prepare_git_workspace(src: Text, dst: Text, revision: Text, strategy: Text = None, **kwargs) -> _Base:
+    '''
+    Prepare workspace with checkout of `revision` from project repository
+    in `src`. Extra kwargs are passed to `git clone` of `CLONE` strategy.
+    '''
+    return _prepare(git_handlers, get_git_strategies(strategy), src, dst, revision, **kwargs)
+
+
+def get_workspace_pool() -> Optional[WorkspacePool]:
+    if settings.WORKSPACE_POOL_SIZE <= 0:
+        return None
+    return WorkspacePool(
+        settings.WORKSPACE_POOL_DIR, settings.WORKSPACE_POOL_SIZE, settings.WORKSPACE_POOL_BUDGET
+    )
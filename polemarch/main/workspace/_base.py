@@ -0,0 +1,34 @@
+from __future__ import unicode_literals
+from typing import Text, NoReturn
+import os
+
+
+class _Base:
+    '''
+    Base class for strategies of execution workspace preparation.
+    Workspace is a writable tree of project files in execution tmpdir,
+    changes in it should not affect project directory.
+    '''
+    __slots__ = 'name', 'options'
+    # Remember unsupported strategy for filesystems of project and tmpdir.
+    remember_failures = True
+
+    def __init__(self, name: Text, **options):
+        self.name = name
+        self.options = options
+
+    def __str__(self):
+        return self.name
+
+    def same_device(self, src: Text, dst: Text) -> bool:
+        return os.stat(src).st_dev == os.stat(os.path.dirname(dst)).st_dev
+
+    def is_supported(self, src: Text, dst: Text) -> bool:
+        # pylint: disable=unused-argument
+        return True
+
+    def prepare(self, src: Text, dst: Text) -> NoReturn:  # nocv
+        raise NotImplementedError()
+
+    def cleanup(self, dst: Text) -> NoReturn:
+        pass
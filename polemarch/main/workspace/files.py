@@ -0,0 +1,66 @@
+from __future__ import unicode_literals
+from typing import Text, NoReturn
+import os
+import fcntl
+import shutil
+import tempfile
+from ._base import _Base
+
+# ioctl request for cloning file extents (`cp --reflink`).
+FICLONE = 0x40049409
+
+
+class Copy(_Base):
+    '''
+    Full copy of project tree.
+    '''
+    __slots__ = ()
+
+    def copy_function(self, src: Text, dst: Text) -> NoReturn:
+        shutil.copy2(src, dst)
+
+    def prepare(self, src: Text, dst: Text) -> NoReturn:
+        shutil.copytree(src, dst, copy_function=self.copy_function)
+
+
+class Reflink(Copy):
+    '''
+    Copy-on-write copy of project tree. Files share data blocks with
+    project files until they are changed. Requires filesystem with
+    reflinks support (btrfs, xfs, etc.) for project dir and tmpdir.
+    '''
+    __slots__ = ()
+
+    def copy_function(self, src: Text, dst: Text) -> NoReturn:
+        with open(src, 'rb') as src_fd, open(dst, 'wb') as dst_fd:
+            fcntl.ioctl(dst_fd.fileno(), FICLONE, src_fd.fileno())
+        shutil.copystat(src, dst)
+
+    def is_supported(self, src: Text, dst: Text) -> bool:
+        if not self.same_device(src, dst):
+            return False
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(dst)) as tmpdir:
+            probe = os.path.join(tmpdir, 'probe')
+            with open(probe, 'w') as probe_fd:
+                probe_fd.write('probe')
+            try:
+                self.copy_function(probe, probe + '.clone')
+            except OSError:
+                return False
+        return True
+
+
+class Hardlink(Copy):
+    '''
+    Tree of hardlinks to project files. Directories are created, files
+    are linked, so preparation doesn't depend on project size. Files
+    written in place (not replaced) are changed in project directory too,
+    so use it only for projects which playbooks don't modify own files.
+    '''
+    __slots__ = ()
+
+    def copy_function(self, src: Text, dst: Text) -> NoReturn:
+        os.link(src, dst)
+
+    def is_supported(self, src: Text, dst: Text) -> bool:
+        return self.same_device(src, dst)
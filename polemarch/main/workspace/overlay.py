@@ -0,0 +1,57 @@
+from __future__ import unicode_literals
+from typing import Text, NoReturn, List
+import os
+import shutil
+import subprocess
+from ._base import _Base
+
+
+class Overlay(_Base):
+    '''
+    Overlay filesystem mounted over project directory. Project directory
+    is read-only lower layer and all changes go to upper layer in tmpdir.
+    Uses kernel overlayfs for root and `fuse-overlayfs` for other users.
+    '''
+    __slots__ = ()
+
+    @property
+    def is_root(self) -> bool:
+        return os.geteuid() == 0
+
+    def kernel_supported(self) -> bool:
+        try:
+            with open('/proc/filesystems') as fs_fd:
+                return any(line.split()[-1] == 'overlay' for line in fs_fd if line.strip())
+        except OSError:  # nocv
+            return False
+
+    def is_supported(self, src: Text, dst: Text) -> bool:
+        if self.is_root:
+            return self.kernel_supported()
+        return bool(shutil.which('fuse-overlayfs') and shutil.which('fusermount'))  # nocv
+
+    def get_layers(self, dst: Text) -> List[Text]:
+        return [dst + '.upper', dst + '.work']
+
+    def mount_cmd(self, options: Text, dst: Text) -> List[Text]:
+        if self.is_root:
+            return ['mount', '-t', 'overlay', 'overlay', '-o', options, dst]
+        return ['fuse-overlayfs', '-o', options, dst]  # nocv
+
+    def umount_cmd(self, dst: Text) -> List[Text]:
+        if self.is_root:
+            return ['umount', dst]
+        return ['fusermount', '-u', dst]  # nocv
+
+    def prepare(self, src: Text, dst: Text) -> NoReturn:
+        upper, work = self.get_layers(dst)
+        for path in (dst, upper, work):
+            os.makedirs(path)
+        options = 'lowerdir={},upperdir={},workdir={}'.format(src, upper, work)
+        subprocess.check_output(self.mount_cmd(options, dst), stderr=subprocess.STDOUT)
+
+    def cleanup(self, dst: Text) -> NoReturn:
+        if os.path.ismount(dst):
+            subprocess.check_output(self.umount_cmd(dst), stderr=subprocess.STDOUT)
+        for path in self.get_layers(dst):
+            shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,199 @@
+from __future__ import unicode_literals
+from typing import Text, NoReturn, Callable, Any, List, Tuple
+import os
+import re
+import time
+import uuid
+import fcntl
+import shutil
+import logging
+from ..utils import Metrics
+
+logger = logging.getLogger('polemarch')
+
+
+def get_tree_size(path: Text) -> int:
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:  # nocv
+                pass
+    return size
+
+
+class PoolEntry:
+    '''
+    Prepared workspace of pool. Entry is locked (shared lock) while
+    execution uses it, so it could not be evicted by other process.
+    '''
+    __slots__ = 'path', 'hit', 'lock'
+
+    def __init__(self, path: Text):
+        self.path = path
+        self.hit = False
+        self.lock = None
+
+    @property
+    def lock_path(self) -> Text:
+        return self.path + '.lock'
+
+    @property
+    def size_path(self) -> Text:
+        return self.path + '.size'
+
+    def acquire(self, operation: int = fcntl.LOCK_SH) -> bool:
+        while True:
+            lock = open(self.lock_path, 'a')
+            try:
+                fcntl.flock(lock, operation)
+            except OSError:
+                lock.close()
+                return False
+            # Lock file could be removed by eviction while we waited.
+            if os.fstat(lock.fileno()).st_nlink:
+                self.lock = lock
+                return True
+            lock.close()  # nocv
+
+    def release(self) -> NoReturn:
+        if self.lock is not None:
+            self.lock.close()
+            self.lock = None
+
+    @property
+    def exists(self) -> bool:
+        return os.path.isdir(self.path)
+
+    @property
+    def size(self) -> int:
+        try:
+            with open(self.size_path) as size_fd:
+                return int(size_fd.read())
+        except (OSError, ValueError):
+            return 0
+
+    @property
+    def last_used(self) -> float:
+        return os.stat(self.path).st_mtime
+
+    def touch(self) -> NoReturn:
+        os.utime(self.path)
+
+    def remove(self) -> NoReturn:
+        shutil.rmtree(self.path, ignore_errors=True)
+        for path in (self.size_path, self.lock_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class WorkspacePool:
+    '''
+    Pool of prepared read-only workspaces keyed by project and revision.
+    Entries are kept in `path/<project_id>/<revision>` and least recently
+    used entries are removed when pool exceeds max count or disk budget.
+    Executions should make own writable layer over entry.
+    '''
+    __slots__ = 'path', 'max_size', 'budget', 'metrics'
+    revision_regex = re.compile(r'^[0-9a-f]{40}$')
+
+    def __init__(self, path: Text, max_size: int, budget: int = 0):
+        self.path = path
+        self.max_size = max_size
+        self.budget = budget
+        self.metrics = Metrics()
+
+    def is_cacheable(self, revision: Text) -> bool:
+        return bool(revision and self.revision_regex.match(revision))
+
+    def get_entry(self, project_id: int, revision: Text) -> PoolEntry:
+        return PoolEntry(os.path.join(self.path, str(project_id), revision))
+
+    def get(self, project_id: int, revision: Text, prepare: Callable[[Text], Any]) -> PoolEntry:
+        '''
+        Get locked entry for project revision. Missing entry is prepared
+        by `prepare(path)` in temporary dir and moved to pool.
+        Entry should be released after usage.
+        '''
+        entry = self.get_entry(project_id, revision)
+        os.makedirs(os.path.dirname(entry.path), exist_ok=True)
+        entry.acquire()
+        try:
+            if entry.exists:
+                entry.hit = True
+                entry.touch()
+                self.metrics.incr('workspace_pool_hit')
+                return entry
+            self.prepare_entry(entry, prepare)
+        except Exception:
+            entry.release()
+            raise
+        self.evict(keep=entry)
+        return entry
+
+    def prepare_entry(self, entry: PoolEntry, prepare: Callable[[Text], Any]) -> NoReturn:
+        tmp_path = '{}.{}'.format(entry.path, uuid.uuid4().hex)
+        start = time.time()
+        try:
+            prepare(tmp_path)
+            with open(tmp_path + '.size', 'w') as size_fd:
+                size_fd.write(str(get_tree_size(tmp_path)))
+            os.rename(tmp_path + '.size', entry.size_path)
+            try:
+                os.rename(tmp_path, entry.path)
+            except OSError:  # nocv
+                # Entry was prepared by other process.
+                pass
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        self.metrics.incr('workspace_pool_miss')
+        self.metrics.incr('workspace_pool_prepare_ms', int((time.time() - start) * 1000))
+
+    def entries(self) -> List[PoolEntry]:
+        result = []
+        if not os.path.isdir(self.path):
+            return result  # nocv
+        for project_id in os.listdir(self.path):
+            project_path = os.path.join(self.path, project_id)
+            if not os.path.isdir(project_path):
+                continue  # nocv
+            for revision in os.listdir(project_path):
+                if self.is_cacheable(revision) and os.path.isdir(os.path.join(project_path, revision)):
+                    result.append(PoolEntry(os.path.join(project_path, revision)))
+        return result
+
+    def _get_stats(self, entries: List[PoolEntry]) -> List[Tuple[float, int, PoolEntry]]:
+        stats = []
+        for entry in entries:
+            try:
+                stats.append((entry.last_used, entry.size, entry))
+            except OSError:  # nocv
+                continue
+        stats.sort(key=lambda item: item[0])
+        return stats
+
+    def evict(self, keep: PoolEntry = None) -> int:
+        '''
+        Remove least recently used entries which are not used by executions,
+        until pool fits max count and disk budget. Returns removed count.
+        '''
+        stats = self._get_stats(self.entries())
+        count, total = len(stats), sum(size for _, size, _ in stats)
+        removed = 0
+        for _, size, entry in stats:
+            if count <= self.max_size and (not self.budget or total <= self.budget):
+                break
+            if keep is not None and entry.path == keep.path:
+                continue
+            if not entry.acquire(fcntl.LOCK_EX | fcntl.LOCK_NB):
+                continue
+            try:
+                entry.remove()
+            finally:
+                entry.release()
+            count, total, removed = count - 1, total - size, removed + 1
+        if removed:
+            self.metrics.incr('workspace_pool_evicted', removed)
+            logger.debug('{} workspaces were evicted from pool.'.format(removed))
+        return removed
@@ -0,0 +1,96 @@
+# pylint: disable=import-error
+from __future__ import unicode_literals
+from typing import Text, NoReturn
+import os
+import shutil
+import warnings
+from vstutils.utils import raise_context
+try:
+    import git
+except:  # nocv
+    warnings.warn("Git is not installed or have problems.")
+from ._base import _Base
+
+
+class GitClone(_Base):
+    '''
+    Full clone of project repository with update of submodules
+    from their remotes.
+    '''
+    __slots__ = ()
+    # Support depends on project repository and revision, not on filesystem.
+    remember_failures = False
+
+    def is_supported(self, src: Text, dst: Text) -> bool:
+        return os.path.isdir(os.path.join(src, '.git'))
+
+    def clone(self, src: Text, dst: Text, **kwargs) -> git.Repo:
+        return git.Repo.clone_from(url=os.path.join(src, '.git'), to_path=dst, **kwargs)
+
+    def update_submodule(self, repo: git.Repo, sm, src: Text) -> NoReturn:
+        # pylint: disable=unused-argument
+        # Calling git directly for own submodules
+        # since using relative path is not working in gitpython
+        # see https://github.com/gitpython-developers/GitPython/issues/730
+        if sm.url[0:3] == '../':
+            repo_parent_url, _ = os.path.split(repo.remotes.origin.url)
+            actual_url = os.path.join(repo_parent_url, sm.name)
+            with sm.config_writer() as writer:
+                writer.set('url', actual_url)
+        sm.update(init=True)
+
+    def update_submodules(self, repo: git.Repo, src: Text) -> NoReturn:
+        for sm in repo.submodules:
+            with raise_context():
+                self.update_submodule(repo, sm, src)
+
+    def prepare(self, src: Text, dst: Text, revision: Text = None, **kwargs) -> NoReturn:
+        # pylint: disable=arguments-differ
+        repo = self.clone(src, dst, **kwargs)
+        repo.git.checkout(revision or 'HEAD')
+        self.update_submodules(repo, src)
+
+
+class GitReference(GitClone):
+    '''
+    Clone which borrows objects from project repository (`--reference`),
+    so only working tree is written. Submodules borrow objects from
+    modules of project repository.
+    '''
+    __slots__ = ()
+
+    def clone(self, src: Text, dst: Text, **kwargs) -> git.Repo:
+        kwargs['reference'] = os.path.join(src, '.git')
+        kwargs['no_checkout'] = True
+        return super(GitReference, self).clone(src, dst, **kwargs)
+
+    def update_submodule(self, repo: git.Repo, sm, src: Text) -> NoReturn:
+        local = os.path.join(src, '.git', 'modules', sm.name)
+        if not os.path.isdir(local):
+            return super(GitReference, self).update_submodule(repo, sm, src)
+        repo.git.execute([
+            'git', '-c', 'submodule.{}.url={}'.format(sm.name, local),
+            'submodule', 'update', '--init', '--reference', local, '--', sm.path
+        ])
+
+
+class GitWorktree(GitReference):
+    '''
+    Detached worktree of project repository (`git worktree add --detach`).
+    Worktree metadata is pruned from project repository on cleanup.
+    '''
+    __slots__ = ('source',)
+
+    def prepare(self, src: Text, dst: Text, revision: Text = None, **kwargs) -> NoReturn:
+        repo = git.Repo(src)
+        self.source = src
+        repo.git.worktree('add', '--detach', dst, revision or 'HEAD')
+        self.update_submodules(git.Repo(dst), src)
+
+    def cleanup(self, dst: Text) -> NoReturn:
+        source = getattr(self, 'source', None)
+        if source is None:
+            return
+        shutil.rmtree(dst, ignore_errors=True)
+        git.Repo(source).git.worktree('prune')
+        self.source = None
@@ -322,6 +322,14 @@ const history_pk_mixin = {
                      * Property, that stores stdout DOM element.
                      */
                     stdout_el: undefined,
+                    /**
+                     * Property, that stores EventSource of live output stream.
+                     */
+                    event_source: undefined,
+                    /**
+                     * Property, that means: live output stream is not available and lines should be polled.
+                     */
+                    live_failed: false,
                 };
             },
 
@@ -346,6 +354,15 @@ const history_pk_mixin = {
 
                     return '/api/' + api_version + '/' + url + '/raw'; /* globals api_version */
                 },
+                /**
+                 * Property, that returns url of live output stream with api prefix.
+                 * @return {string}
+                 */
+                live_url() {
+                    let url = this.url.replace(/^\/|\/$/g, "");
+
+                    return '/api/' + api_version + '/' + url + '/live/'; /* globals api_version */
+                },
                 /**
                  * Property, that returns url for getting stdout lines.
                  * @return {string}
@@ -425,6 +442,10 @@ const history_pk_mixin = {
                 this.stdout_el = $(this.$el).find('.history-stdout')[0];
             },
 
+            beforeDestroy() {
+                this.stopLiveOutput();
+            },
+
             methods: {
                 /**
                  * Method - on scroll event handler.
@@ -435,6 +456,11 @@ const history_pk_mixin = {
                     if(["RUN", "DELAY"].includes(instance_data.status)) {
                         this.last_status = instance_data.status;
 
+                        if(window.EventSource && !this.live_failed) {
+                            this.startLiveOutput();
+                            return Promise.resolve();
+                        }
+
                         return this.loadLinesFromBeginning().then(response => { /* jshint unused: false */
                             setTimeout(() => {
                                 $(this.stdout_el).scrollTop($(this.stdout_el).prop('scrollHeight'));
@@ -456,6 +482,52 @@ const history_pk_mixin = {
                         return Promise.resolve();
                     }
                 },
+                /**
+                 * Method, that subscribes to live output stream.
+                 * If stream is not available, lines will be polled by updateData method.
+                 */
+                startLiveOutput() {
+                    if(this.event_source) {
+                        return;
+                    }
+
+                    let after = 0;
+
+                    this.lines.forEach(line => {
+                        after = Math.max(after, line.line_gnumber);
+                    });
+
+                    this.event_source = new EventSource(this.live_url + '?after=' + after);
+
+                    this.event_source.onmessage = (event) => {
+                        this.saveNewLines(JSON.parse(event.data));
+
+                        setTimeout(() => {
+                            $(this.stdout_el).scrollTop($(this.stdout_el).prop('scrollHeight'));
+                        }, 300);
+                    };
+
+                    this.event_source.addEventListener('end', () => {
+                        this.stopLiveOutput();
+                    });
+
+                    this.event_source.onerror = () => {
+                        // EventSource reconnects by itself, CLOSED state means that stream is not available.
+                        if(this.event_source && this.event_source.readyState == EventSource.CLOSED) {
+                            this.live_failed = true;
+                            this.stopLiveOutput();
+                        }
+                    };
+                },
+                /**
+                 * Method, that closes live output stream.
+                 */
+                stopLiveOutput() {
+                    if(this.event_source) {
+                        this.event_source.close();
+                        this.event_source = undefined;
+                    }
+                },
                 /**
                  * Method, that updates data on scroll event.
                  */